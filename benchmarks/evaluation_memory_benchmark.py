@@ -0,0 +1,100 @@
+# This script measures the peak memory of the evaluation of synthetic captures of growing size, reading each capture
+# at once and in chunks, to show that the memory of the chunked evaluation does not grow with the capture size.
+# Run it from the project root, with the trained models of the chosen delta in rf_models/ and xgb_models/, with:
+# python -m benchmarks.evaluation_memory_benchmark
+
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from colorama import Fore, Style
+from benchmarks.synthetic_capture import write_synthetic_capture
+from evaluation_modules.evaluation_module import device_names, get_device_ip_addresses
+
+# Capture durations (in seconds) of the synthetic captures
+capture_durations = [900, 3600, 14400]
+
+# Average number of packets per second in the synthetic captures
+packet_rate = 100
+
+# Window duration, used to load the models
+delta = 5
+
+# Chunk sizes compared (None reads each capture at once)
+chunk_sizes = [None, 16 * 1024 * 1024]
+
+
+# This function evaluates the captures of a folder and returns the elapsed time, the number of windows and the peak memory
+def run_evaluation(folder_path, chunk_size):
+    """
+    Runs in a new process, so that its peak resident set size only depends on this evaluation.
+
+    :param folder_path: the folder with the capture to evaluate.
+    :param chunk_size: the number of bytes of the capture read at a time (None to read it at once).
+
+    :return: tuple (elapsed time in seconds, number of windows written, peak resident set size in MiB).
+    """
+    # Imported here so that the parent process does not load the models
+    import evaluation_modules.evaluation_module as evaluation_module
+    from evaluation_modules.evaluation_utilities import write_window_results
+
+    evaluation_module.evaluation_chunk_size = chunk_size
+    windows_written = 0
+
+    # Count the windows while they are written, without keeping them
+    def count_windows(windows):
+        nonlocal windows_written
+        for window in windows:
+            windows_written += 1
+            yield window
+
+    results = ((file_path, count_windows(windows)) for file_path, windows in evaluation_module.iter_user_scenarios(folder_path, delta))
+
+    start = time.perf_counter()
+
+    # The predictions are not printed, only written to the output file
+    with open(os.devnull, 'w') as devnull:
+        standard_output, sys.stdout = sys.stdout, devnull
+        try:
+            write_window_results(folder_path, 'benchmark', delta, results)
+        finally:
+            sys.stdout = standard_output
+
+    elapsed_time = time.perf_counter() - start
+
+    # On Linux ru_maxrss is in KiB
+    return elapsed_time, windows_written, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+if __name__ == '__main__':
+    device_ip_addresses = get_device_ip_addresses(device_names)
+    benchmark_folder = tempfile.mkdtemp(prefix='evaluation_memory_benchmark_')
+
+    print(f'\n{Fore.MAGENTA}Benchmarking the peak memory of the evaluation with delta = {delta}{Style.RESET_ALL}')
+
+    try:
+        for duration in capture_durations:
+            folder_path = os.path.join(benchmark_folder, str(duration))
+            os.makedirs(folder_path)
+            capture_path = os.path.join(folder_path, 'synthetic.pcapng')
+            packets_number = write_synthetic_capture(capture_path, device_ip_addresses, duration, packet_rate)
+
+            print(f'\n{Fore.YELLOW}Capture duration: {Style.RESET_ALL}{duration} s '
+                  f'({packets_number} packets, {os.path.getsize(capture_path) / 2 ** 20:.1f} MiB)')
+
+            for chunk_size in chunk_sizes:
+                # A new process for each run, so that the peak memory of a run does not hide the next ones
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    elapsed_time, windows_number, peak_memory = executor.submit(run_evaluation, folder_path, chunk_size).result()
+
+                reading = 'whole capture' if chunk_size is None else f'{chunk_size / 2 ** 20:.0f} MiB chunks'
+                print(f'{Fore.YELLOW}{reading}: {Style.RESET_ALL}{elapsed_time:.2f} s, {windows_number} windows, '
+                      f'peak memory {peak_memory:.1f} MiB')
+
+            os.remove(capture_path)
+    finally:
+        shutil.rmtree(benchmark_folder)
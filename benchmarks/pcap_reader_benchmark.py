@@ -0,0 +1,150 @@
+# This script checks that the raw pcapng / pcap reader returns the same packets as scapy and compares their speed.
+# Run it from the project root with: python -m benchmarks.pcap_reader_benchmark [--check] [<capture file> ...]
+# Without capture files, the check runs on a synthetic capture with 802.1Q VLAN frames, which both readers must drop.
+# The packets must be identical, timestamps included: the raw timestamps must equal the float of scapy's Decimal ones.
+# With --check, the readers are not timed, so the output only depends on the captures, and the script exits with 1
+# on the first capture whose packets differ (e.g. to run it in a scheduled job).
+
+import os
+import sys
+import time
+import argparse
+import shutil
+import tempfile
+from colorama import Fore, Style
+from scapy.all import sniff
+from scapy.layers.inet import IP
+from benchmarks.synthetic_capture import write_synthetic_capture
+from common_modules.ip_addresses import get_ip_address
+from common_modules.packet_table import PacketTableBuilder
+from common_modules.pcap_reader import read_capture
+
+# Devices whose packets are kept by both readers
+device_names = ['sonos-smart-speaker', 'tplink-tapo-camera']
+
+# Define the duration in seconds, the packet rate and the fraction of 802.1Q frames of the synthetic capture
+synthetic_duration = 60
+synthetic_rate = 200
+synthetic_vlan_fraction = 0.1
+
+
+# This function reads a capture with scapy, keeping the packets that match the 'ip host' filter of the devices
+def read_capture_with_scapy(file_path, device_ip_addresses):
+    """
+    Dissects every packet of the capture with scapy and keeps the packets sent or received by the devices.
+    The filter is applied in Python, so that the check does not depend on tcpdump being installed. As the BPF filter,
+    it only matches IPv4 carried directly by the link layer: a frame with an 802.1Q VLAN tag is not matched.
+
+    :param file_path: path of the .pcapng or .pcap file.
+    :param device_ip_addresses: list of IP addresses of the devices.
+
+    :return: the table of the packets sent or received by the devices.
+    """
+    builder = PacketTableBuilder()
+
+    def add_device_packet(packet):
+        # The IPv4 header is the packet itself (raw IP link types) or the payload of the link layer header
+        ip_layer = packet if isinstance(packet, IP) else packet.payload
+        if isinstance(ip_layer, IP) and (ip_layer.src in device_ip_addresses or ip_layer.dst in device_ip_addresses):
+            builder.add_scapy_packet(packet)
+
+    sniff(offline=file_path, store=False, prn=add_device_packet)
+
+    return builder.build()
+
+
+# This function returns the execution time of the given function in seconds
+def measure(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+# This function returns the description of the first difference between the packets of the two readers, or None
+def find_mismatch(raw_packets, scapy_packets):
+    if len(raw_packets) != len(scapy_packets):
+        return f'{len(raw_packets)} and {len(scapy_packets)} packets'
+
+    # The columns are compared exactly: a timestamp rounded differently is a mismatch
+    for column in ('time', 'length', 'src', 'dst'):
+        raw_values, scapy_values = getattr(raw_packets, column), getattr(scapy_packets, column)
+        different = (raw_values != scapy_values).nonzero()[0]
+        if len(different):
+            index = different[0]
+            return (f'{len(different)} packets with a different {column}, the first one is packet {index} '
+                    f'({raw_values[index]!r} and {scapy_values[index]!r})')
+
+    return None
+
+
+# This function reads a capture with both readers and returns True if they returned the same packets
+def check_parity(file_path, device_ip_addresses, timed=True):
+    """
+    :param file_path: path of the .pcapng or .pcap file.
+    :param device_ip_addresses: list of IP addresses of the devices.
+    :param timed: if True, the reading times of both readers are printed.
+
+    :return: True if both readers returned the same packets, with the same timestamps, lengths and addresses.
+    """
+    scapy_time, scapy_packets = measure(read_capture_with_scapy, file_path, device_ip_addresses)
+    raw_time, raw_packets = measure(read_capture, file_path, device_ip_addresses)
+
+    print(f'\n{Fore.YELLOW}Capture: {Style.RESET_ALL}{file_path} ({len(raw_packets)} device packets)')
+
+    mismatch = find_mismatch(raw_packets, scapy_packets)
+    if mismatch is not None:
+        print(f'{Fore.RED}ERROR: the raw reader and scapy returned different packets: {mismatch}!{Style.RESET_ALL}')
+        return False
+
+    print(f'{Fore.GREEN}Same packets returned by both readers!{Style.RESET_ALL}')
+
+    if not timed:
+        return True
+
+    print(f'{Fore.YELLOW}scapy reader: {Style.RESET_ALL}{scapy_time:.4f} s')
+    print(f'{Fore.YELLOW}Raw reader: {Style.RESET_ALL}{raw_time:.4f} s ({scapy_time / raw_time:.1f}x faster)')
+
+    return True
+
+
+# This function checks the parity of the readers on a synthetic capture of the devices with 802.1Q VLAN frames
+def check_synthetic_parity(device_ip_addresses, timed=True):
+    folder_path = tempfile.mkdtemp(prefix='pcap_reader_benchmark_')
+
+    try:
+        file_path = os.path.join(folder_path, 'synthetic.pcapng')
+        packets_written = write_synthetic_capture(file_path, device_ip_addresses, synthetic_duration, synthetic_rate,
+                                                  vlan_fraction=synthetic_vlan_fraction)
+        print(f'\n{Fore.YELLOW}Synthetic capture: {Style.RESET_ALL}{packets_written} packets, '
+              f'{synthetic_vlan_fraction:.0%} of them with a VLAN tag')
+
+        return check_parity(file_path, device_ip_addresses, timed)
+    finally:
+        shutil.rmtree(folder_path)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Check that the raw capture reader returns the same packets as scapy and compare their speed.')
+    parser.add_argument('captures', nargs='*', help='.pcapng / .pcap files to check (default: a synthetic capture with VLAN frames)')
+    parser.add_argument('--check', action='store_true', help='only check the packets, without timing the readers, and stop at the first mismatch')
+    arguments = parser.parse_args(arguments)
+
+    device_ip_addresses = [get_ip_address(device_name) for device_name in device_names]
+    timed = not arguments.check
+
+    if not arguments.captures:
+        parity = check_synthetic_parity(device_ip_addresses, timed)
+    elif arguments.check:
+        parity = all(check_parity(file_path, device_ip_addresses, timed) for file_path in arguments.captures)
+    else:
+        parity = all([check_parity(file_path, device_ip_addresses, timed) for file_path in arguments.captures])
+
+    if not parity:
+        print(f'{Fore.RED}\nERROR: the raw reader does not match scapy!{Style.RESET_ALL}')
+        sys.exit(1)
+
+    print(f'\n{Fore.GREEN}The raw reader matches scapy on all the captures{Style.RESET_ALL}')
+
+
+if __name__ == '__main__':
+    main()
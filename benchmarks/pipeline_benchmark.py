@@ -0,0 +1,235 @@
+# This script benchmarks the stages of the pipeline on a synthetic dataset laid out as the real one, and writes the
+# elapsed time, the throughput and the peak memory of each stage to a JSON file, so that runs of different commits
+# can be compared. It runs offline: the dataset is generated, and small models are trained on it with fixed
+# hyperparameters, in a temporary folder (the models of the project are not touched).
+# Run it from the project root with:
+# python -m benchmarks.pipeline_benchmark --output benchmark_results.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from colorama import Fore, Style
+from benchmarks.synthetic_capture import write_synthetic_dataset
+from common_modules.device_registry import get_device_registry
+
+# Define the stages of the benchmark, in the order in which they run
+benchmark_stages = ['read_training_files', 'train_models', 'window_packets', 'compute_statistical_features',
+                    'classify_window', 'evaluate_user_scenarios']
+
+# Define the hyperparameters of the models trained on the synthetic dataset (no hyperparameter search)
+benchmark_model_parameters = {'n_estimators': 100, 'random_state': 42, 'n_jobs': 1}
+
+# Define the IP network of the synthetic devices added to the registry when more devices than the registered ones are asked
+synthetic_device_network = '10.0.{}.{}'
+
+
+# This function returns the names of the devices of the benchmark, registering synthetic devices if needed
+def register_benchmark_devices(devices_number):
+    """
+    The devices of the registry are used first; the other ones are registered as 'synthetic-device-<n>', with the
+    activities of the registry assigned in turn, so that get_ip_address returns their addresses as for real devices.
+
+    :param devices_number: number of devices.
+    :return: list of the names of the devices.
+    """
+    registry = get_device_registry()
+    device_names = list(registry.devices)[:devices_number]
+    activity_names = list(registry.activities)
+
+    for device_index in range(len(device_names), devices_number):
+        device_name = f'synthetic-device-{device_index + 1}'
+        address = synthetic_device_network.format(device_index // 250, device_index % 250 + 1)
+        registry.add_device(device_name, [address], activities=[activity_names[device_index % len(activity_names)]])
+        device_names.append(device_name)
+
+    return device_names
+
+
+# This function runs a stage of the benchmark and returns its measurements
+def run_stage(stage, dataset_path, arguments, counts):
+    """
+    Runs in a new process, so that its peak resident set size only depends on this stage. The inputs of a stage
+    (e.g. the windows classified by classify_window) are prepared before its timer starts.
+
+    :param stage: the name of the stage.
+    :param dataset_path: the folder of the synthetic dataset, also used as working directory (models are saved there).
+    :param arguments: the command line arguments of the benchmark.
+    :param counts: the numbers of files and packets of the dataset.
+
+    :return: dictionary with the elapsed time, the processed items and the peak resident set size of the stage.
+    """
+    # Imported here so that the parent process does not load the pipeline modules
+    import evaluation_modules.evaluation_module as evaluation_module
+    from common_modules.ip_addresses import get_ip_address
+    from common_modules.model_registry import load_model
+    from common_modules.utilities import compute_statistical_features, read_evaluation_pcapng_files
+    from evaluation_modules.evaluation_utilities import window_packets, classify_window
+    from training_test_modules.classifier_module import classifiers, save_model
+    from training_test_modules.dataset_formatter import read_training_files
+
+    os.chdir(dataset_path)
+    device_names = register_benchmark_devices(arguments.devices)
+    device_ip_addresses = [get_ip_address(device_name) for device_name in device_names]
+    evaluation_module.device_names = device_names
+
+    training_folder_path = os.path.join(dataset_path, 'training - test set')
+    evaluation_folder_path = os.path.join(dataset_path, 'evaluation set')
+    evaluation_files = sorted(os.path.join(evaluation_folder_path, file_name) for file_name in os.listdir(evaluation_folder_path))
+    measures = {}
+
+    # The pipeline prints every file and window: only the measurements are printed
+    with open(os.devnull, 'w') as devnull:
+        standard_output, sys.stdout = sys.stdout, devnull
+        try:
+            if stage in ('window_packets', 'compute_statistical_features', 'classify_window'):
+                packets = [read_evaluation_pcapng_files(file_path, device_ip_addresses) for file_path in evaluation_files]
+
+            if stage in ('compute_statistical_features', 'classify_window'):
+                windows = [window['packets'] for file_packets in packets
+                           for window in window_packets(file_packets, arguments.delta, evaluation_module.overlap)]
+
+            if stage == 'compute_statistical_features':
+                flows = [_split_window_flows(window, device_ip_addresses) for window in windows]
+                flows = [flow for flow in flows if flow is not None]
+
+            if stage == 'classify_window':
+                load_model('rf', arguments.delta)
+                load_model('xgb', arguments.delta)
+
+            start = time.perf_counter()
+
+            if stage == 'read_training_files':
+                X, _ = read_training_files(training_folder_path, 'benchmark', arguments.delta, workers=1, use_cache=False)
+                measures = {'files': counts['training_files'], 'packets': counts['training_packets'], 'flows': len(X)}
+
+            elif stage == 'train_models':
+                X, y = read_training_files(training_folder_path, 'benchmark', arguments.delta, workers=1, use_cache=False)
+                start = time.perf_counter()
+
+                for classifier_type, (estimator_class, _, _) in classifiers.items():
+                    model = estimator_class(**benchmark_model_parameters).fit(X, y)
+                    save_model(model, f'{classifier_type}_models', f'trained_{classifier_type}_classifier_{arguments.delta}.pkl')
+                measures = {'flows': len(X)}
+
+            elif stage == 'window_packets':
+                windows_number = sum(len(window_packets(file_packets, arguments.delta, evaluation_module.overlap)) for file_packets in packets)
+                measures = {'packets': sum(len(file_packets) for file_packets in packets), 'windows': windows_number}
+
+            elif stage == 'compute_statistical_features':
+                for lengths, incoming_lengths, outgoing_lengths in flows:
+                    compute_statistical_features(lengths, incoming_lengths, outgoing_lengths)
+                measures = {'windows': len(flows)}
+
+            elif stage == 'classify_window':
+                predictions = [classify_window(window, device_ip_addresses, arguments.delta) for window in windows]
+                measures = {'windows': len(windows), 'predictions': sum(prediction is not None for prediction in predictions)}
+
+            elif stage == 'evaluate_user_scenarios':
+                results = evaluation_module.evaluate_user_scenarios(evaluation_folder_path, arguments.delta)
+                measures = {'files': counts['evaluation_files'], 'packets': counts['evaluation_packets'],
+                            'windows': sum(len(file_results) for file_results in results.values())}
+
+            elapsed_time = time.perf_counter() - start
+        finally:
+            sys.stdout = standard_output
+
+    # Throughput of every item processed by the stage (e.g. packets_per_second)
+    throughput = {f'{item}_per_second': number / elapsed_time for item, number in measures.items() if elapsed_time > 0}
+
+    # On Linux ru_maxrss is in KiB
+    return {'seconds': elapsed_time, **measures, **throughput, 'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+# This function returns the packet lengths of a window and of its incoming and outgoing flows, or None if one is empty
+def _split_window_flows(window, device_ip_addresses):
+    outgoing_lengths = window.length[window.outgoing_mask(device_ip_addresses)]
+    incoming_lengths = window.length[window.incoming_mask(device_ip_addresses)]
+
+    if not len(outgoing_lengths) or not len(incoming_lengths):
+        return None
+
+    return window.length, incoming_lengths, outgoing_lengths
+
+
+# This function returns the commit of the project, so that the results of different commits can be told apart
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on a synthetic dataset and write the results to a JSON file.')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file receiving the results (default: benchmark_results.json)')
+    parser.add_argument('--devices', type=int, default=2, help='number of devices (default: 2, the registered ones; more are added as synthetic devices)')
+    parser.add_argument('--traces', type=int, default=10, help='number of training traces of each activity (default: 10)')
+    parser.add_argument('--trace-duration', type=float, default=60, help='duration of each training trace in seconds (default: 60)')
+    parser.add_argument('--evaluation-files', type=int, default=2, help='number of evaluation captures (default: 2)')
+    parser.add_argument('--evaluation-duration', type=float, default=600, help='duration of each evaluation capture in seconds (default: 600)')
+    parser.add_argument('--rate', type=float, default=50, help='average number of packets per second of each device (default: 50)')
+    parser.add_argument('--delta', type=int, default=5, help='window duration in seconds (default: 5)')
+    parser.add_argument('--seed', type=int, default=42, help='seed of the synthetic dataset (default: 42)')
+    parser.add_argument('--stages', nargs='+', choices=benchmark_stages, default=benchmark_stages,
+                        help='stages to run (train_models is always run before the classification stages)')
+    arguments = parser.parse_args(arguments)
+
+    # Every activity label must be in the training set, as XGBoost requires consecutive labels
+    if arguments.devices < len(get_device_registry().devices):
+        parser.error(f'--devices must be at least {len(get_device_registry().devices)}, so that every activity is in the dataset')
+
+    stages = [stage for stage in benchmark_stages if stage in arguments.stages or
+              (stage == 'train_models' and {'classify_window', 'evaluate_user_scenarios'} & set(arguments.stages))]
+
+    dataset_path = tempfile.mkdtemp(prefix='pipeline_benchmark_')
+    results = {
+        'commit': get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'configuration': {name: value for name, value in vars(arguments).items() if name not in ('output', 'stages')},
+        'stages': {}
+    }
+
+    print(f'\n{Fore.MAGENTA}Benchmarking the pipeline on a synthetic dataset with delta = {arguments.delta}{Style.RESET_ALL}')
+
+    try:
+        start = time.perf_counter()
+        counts = write_synthetic_dataset(dataset_path, register_benchmark_devices(arguments.devices), arguments.traces,
+                                         arguments.trace_duration, arguments.evaluation_files, arguments.evaluation_duration,
+                                         arguments.rate, arguments.seed)
+        results['dataset'] = {**counts, 'seconds': time.perf_counter() - start}
+
+        print(f'\n{Fore.YELLOW}Synthetic dataset: {Style.RESET_ALL}{counts["training_files"]} training traces '
+              f'({counts["training_packets"]} packets), {counts["evaluation_files"]} evaluation captures '
+              f'({counts["evaluation_packets"]} packets)')
+
+        for stage in stages:
+            # A new process for each stage, so that the peak memory of a stage does not hide the next ones
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                results['stages'][stage] = executor.submit(run_stage, stage, dataset_path, arguments, counts).result()
+
+            throughput = ', '.join(f'{value:.1f} {name.replace("_per_second", "")}/s'
+                                   for name, value in results['stages'][stage].items() if name.endswith('_per_second'))
+            print(f'{Fore.YELLOW}{stage}: {Style.RESET_ALL}{results["stages"][stage]["seconds"]:.3f} s ({throughput}), '
+                  f'peak memory {results["stages"][stage]["peak_rss_mib"]:.1f} MiB')
+    finally:
+        shutil.rmtree(dataset_path)
+
+    with open(arguments.output, 'w') as file:
+        json.dump(results, file, indent=2)
+
+    print(f'\n{Fore.GREEN}Benchmark results written to: {Style.RESET_ALL}{arguments.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# This script benchmarks the incremental feature engine against the per-window batch computation.
+# Run it from the project root with: python -m benchmarks.rolling_features_benchmark
+
+import time
+import numpy as np
+from colorama import Fore, Style
+from common_modules.packet_table import PacketTable, ip_to_int
+from evaluation_modules.evaluation_utilities import iter_window_features
+
+# Window duration and overlaps (the smaller the step delta - overlap, the more packets consecutive windows share)
+delta = 5
+overlaps = [0, 2, 4, 4.5, 4.9]
+
+# Synthetic capture parameters
+capture_duration = 600
+packet_rate = 200
+device_ip_address = '192.168.1.153'
+remote_ip_address = '34.120.0.1'
+
+
+# This function creates a time-sorted table of synthetic packets exchanged by the device and a remote host
+def generate_packet_table(duration, rate, seed=42):
+    """
+    Generates a synthetic packet table with exponentially distributed inter-arrival times.
+
+    :param duration: duration of the synthetic capture in seconds.
+    :param rate: average number of packets per second.
+    :param seed: seed of the random generator.
+
+    :return: the packet table.
+    """
+    generator = np.random.default_rng(seed)
+    packets_number = int(duration * rate)
+
+    timestamps = 1700000000.0 + np.cumsum(generator.exponential(1 / rate, packets_number))
+    lengths = generator.integers(54, 1514, packets_number)
+    outgoing = generator.random(packets_number) < 0.5
+    device, remote = ip_to_int(device_ip_address), ip_to_int(remote_ip_address)
+
+    return PacketTable(timestamps, lengths, np.where(outgoing, device, remote), np.where(outgoing, remote, device))
+
+
+# This function returns the time needed to compute the features of all the windows and the feature matrix
+def measure(packets, overlap, engine):
+    start = time.perf_counter()
+    features = [flow_features for _, flow_features in iter_window_features(packets, [device_ip_address], delta, overlap, engine)]
+    return time.perf_counter() - start, np.vstack(features)
+
+
+if __name__ == '__main__':
+    packets = generate_packet_table(capture_duration, packet_rate)
+
+    print(f'\n{Fore.MAGENTA}Benchmarking the feature engines on {len(packets)} packets with delta = {delta}{Style.RESET_ALL}')
+
+    for overlap in overlaps:
+        batch_time, batch_features = measure(packets, overlap, 'batch')
+        incremental_time, incremental_features = measure(packets, overlap, 'incremental')
+
+        if not np.allclose(batch_features, incremental_features, rtol=1e-9, equal_nan=True):
+            print(f'{Fore.RED}ERROR: features differ with overlap = {overlap}!{Style.RESET_ALL}')
+            continue
+
+        print(f'\n{Fore.YELLOW}Overlap: {Style.RESET_ALL}{overlap} s ({len(batch_features)} windows)')
+        print(f'{Fore.YELLOW}Batch engine: {Style.RESET_ALL}{batch_time:.4f} s')
+        print(f'{Fore.YELLOW}Incremental engine: {Style.RESET_ALL}{incremental_time:.4f} s '
+              f'({batch_time / incremental_time:.1f}x faster)')
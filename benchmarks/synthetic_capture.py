@@ -0,0 +1,166 @@
+# This file writes synthetic .pcapng captures, used by the benchmarks to test the pipeline on captures of any size.
+# The packets are Ethernet / IPv4 frames exchanged by the devices and remote hosts, with random sizes and
+# exponentially distributed inter-arrival times; only the headers are meaningful, the payload is zero-filled.
+
+import os
+import struct
+import pytz
+import numpy as np
+from datetime import datetime
+from common_modules.device_registry import get_device_registry
+from common_modules.packet_table import ip_to_int
+
+# Remote hosts exchanging packets with the devices
+remote_ip_addresses = ['34.120.0.1', '52.94.236.248', '104.16.85.20']
+
+# Captured packet sizes (in bytes) of the synthetic packets
+min_packet_length = 60
+max_packet_length = 300
+
+# Number of packets generated and written at a time
+write_batch_size = 100000
+
+# UNIX time of the first packet of the synthetic datasets (summer, so that the timestamps are in MDT)
+dataset_start_time = 1688212800.0
+
+# Seconds between the start of a training trace and its activity timestamp
+activity_offset = 2.0
+
+# Ethernet header of the synthetic frames (zero MAC addresses, IPv4 EtherType)
+_ethernet_header = bytes(12) + b'\x08\x00'
+
+# Ethernet header of the synthetic 802.1Q frames (zero MAC addresses, VLAN 1, IPv4 EtherType)
+_vlan_ethernet_header = bytes(12) + b'\x81\x00\x00\x01\x08\x00'
+
+
+# This function writes a synthetic .pcapng capture of the given duration
+def write_synthetic_capture(file_path, device_ip_addresses, duration, rate, start_time=1700000000.0, seed=42, packet_lengths=None,
+                            vlan_fraction=0.0):
+    """
+    Writes a pcapng capture (one section, one Ethernet interface with microsecond timestamps) in which the devices
+    exchange packets with remote hosts.
+
+    :param file_path: path of the .pcapng file.
+    :param device_ip_addresses: list of IP addresses of the devices.
+    :param duration: duration of the capture in seconds.
+    :param rate: average number of packets per second.
+    :param start_time: UNIX time of the first packet.
+    :param seed: seed of the random generator.
+    :param packet_lengths: optional (minimum, maximum) captured length of the packets in bytes.
+    :param vlan_fraction: fraction of the frames carrying an 802.1Q VLAN tag (not matched by the 'ip host' filter).
+
+    :return: the number of packets written.
+    """
+    min_length, max_length = packet_lengths or (min_packet_length, max_packet_length)
+    generator = np.random.default_rng(seed)
+    devices = np.array([ip_to_int(ip) for ip in device_ip_addresses], dtype=np.uint32)
+    remotes = np.array([ip_to_int(ip) for ip in remote_ip_addresses], dtype=np.uint32)
+
+    packets_written = 0
+    current_time = start_time
+
+    with open(file_path, 'wb') as file:
+        # Section Header Block and Interface Description Block
+        file.write(struct.pack('<IIIHHqI', 0x0A0D0D0A, 28, 0x1A2B3C4D, 1, 0, -1, 28))
+        file.write(struct.pack('<IIHHII', 0x00000001, 20, 1, 0, 0xffff, 20))
+
+        while current_time < start_time + duration:
+            timestamps = current_time + np.cumsum(generator.exponential(1 / rate, write_batch_size))
+            timestamps = timestamps[timestamps < start_time + duration]
+            if not len(timestamps):
+                break
+            current_time = timestamps[-1]
+
+            packets_number = len(timestamps)
+            lengths = generator.integers(min_length, max_length + 1, packets_number)
+            device = devices[generator.integers(0, len(devices), packets_number)]
+            remote = remotes[generator.integers(0, len(remotes), packets_number)]
+            outgoing = generator.random(packets_number) < 0.5
+            sources = np.where(outgoing, device, remote)
+            destinations = np.where(outgoing, remote, device)
+            microseconds = np.round(timestamps * 1000000).astype(np.uint64)
+
+            # The tags are drawn only when asked, so that the other captures do not change for a given seed
+            tagged = generator.random(packets_number) < vlan_fraction if vlan_fraction else np.zeros(packets_number, dtype=bool)
+
+            file.write(b''.join(_enhanced_packet_block(int(timestamp), int(length), int(src), int(dst), bool(vlan))
+                                for timestamp, length, src, dst, vlan in zip(microseconds, lengths, sources, destinations, tagged)))
+            packets_written += packets_number
+
+    return packets_written
+
+
+# This function writes a synthetic dataset laid out as the real one (training / test set and evaluation set)
+def write_synthetic_dataset(folder_path, device_names, traces_per_activity, trace_duration, evaluation_files,
+                            evaluation_duration, rate, seed=42):
+    """
+    Writes, for each device and each of its activities in the device registry, traces_per_activity traces in
+    '<folder_path>/training - test set/<device>/<activity>/traces/' and their activity timestamps in
+    '<activity>/timestamps/timestamps.txt', and evaluation_files captures of all the devices in
+    '<folder_path>/evaluation set/'. The packet sizes of a trace depend on its activity, so the models can learn them.
+
+    :param folder_path: the folder of the dataset.
+    :param device_names: names of the devices, registered in the device registry.
+    :param traces_per_activity: number of training traces of each activity.
+    :param trace_duration: duration of each training trace in seconds.
+    :param evaluation_files: number of evaluation captures.
+    :param evaluation_duration: duration of each evaluation capture in seconds.
+    :param rate: average number of packets per second of each device.
+    :param seed: seed of the random generators.
+
+    :return: dictionary with the number of 'training_files', 'training_packets', 'evaluation_files' and 'evaluation_packets'.
+    """
+    registry = get_device_registry()
+    denver_timezone = pytz.timezone('America/Denver')
+    counts = {'training_files': 0, 'training_packets': 0, 'evaluation_files': 0, 'evaluation_packets': 0}
+    trace_start = dataset_start_time
+
+    for device_name in device_names:
+        device_ip_address = registry.get_ip_address(device_name)
+
+        for activity_name in registry.devices[registry.match_device(device_name)]['activities']:
+            activity_folder = os.path.join(folder_path, 'training - test set', device_name, activity_name)
+            os.makedirs(os.path.join(activity_folder, 'traces'))
+            os.makedirs(os.path.join(activity_folder, 'timestamps'))
+
+            label = registry.get_flow_label(activity_name)
+            timestamps = []
+
+            for trace_index in range(1, traces_per_activity + 1):
+                trace_path = os.path.join(activity_folder, 'traces', f'trace_{trace_index}.pcapng')
+                counts['training_packets'] += write_synthetic_capture(trace_path, [device_ip_address], trace_duration, rate,
+                                                                      trace_start, seed + counts['training_files'],
+                                                                      (min_packet_length + 40 * label, max_packet_length + 200 * label))
+                counts['training_files'] += 1
+
+                activity_time = datetime.fromtimestamp(trace_start + activity_offset, denver_timezone)
+                timestamps.append(activity_time.strftime('%Y-%m-%d %H:%M:%S.%f MDT'))
+                trace_start += trace_duration
+
+            with open(os.path.join(activity_folder, 'timestamps', 'timestamps.txt'), 'w') as file:
+                file.write('\n'.join(timestamps) + '\n')
+
+    device_ip_addresses = [registry.get_ip_address(device_name) for device_name in device_names]
+    os.makedirs(os.path.join(folder_path, 'evaluation set'))
+
+    for file_index in range(1, evaluation_files + 1):
+        capture_path = os.path.join(folder_path, 'evaluation set', f'user-scenario-{file_index}.pcapng')
+        counts['evaluation_packets'] += write_synthetic_capture(capture_path, device_ip_addresses, evaluation_duration,
+                                                                rate * len(device_ip_addresses), trace_start, seed + file_index)
+        counts['evaluation_files'] += 1
+        trace_start += evaluation_duration
+
+    return counts
+
+
+# This function returns the Enhanced Packet Block of a synthetic Ethernet / IPv4 frame (802.1Q tagged if vlan is True)
+def _enhanced_packet_block(timestamp, length, src, dst, vlan=False):
+    padding = -length % 4
+    block_length = 32 + length + padding
+    ethernet_header = _vlan_ethernet_header if vlan else _ethernet_header
+
+    ip_header = struct.pack('!BBHHHBBHII', 0x45, 0, length - len(ethernet_header), 0, 0, 64, 6, 0, src, dst)
+    frame = ethernet_header + ip_header + bytes(length - len(ethernet_header) - 20 + padding)
+
+    return (struct.pack('<IIIIIII', 0x00000006, block_length, 0, timestamp >> 32, timestamp & 0xffffffff, length, length)
+            + frame + struct.pack('<I', block_length))
@@ -0,0 +1,110 @@
+# This script benchmarks the single-pass windowing engine against the original rescanning implementation.
+# Run it from the project root with: python -m benchmarks.window_packets_benchmark
+
+import random
+import time
+from types import SimpleNamespace
+from colorama import Fore, Style
+from common_modules.packet_table import PacketTable
+from evaluation_modules.evaluation_utilities import window_packets
+
+# Capture lengths (in seconds) used to show how the two implementations scale
+capture_durations = [60, 300, 900, 1800]
+
+# Average number of packets per second in the synthetic captures
+packet_rate = 50
+
+# Window parameters (the same defaults used in the evaluation phase)
+delta = 5
+overlap = 2
+
+
+# This function creates a time-sorted list of synthetic packets with a 'time' attribute
+def generate_packets(duration, rate, seed=42):
+    """
+    Generates synthetic packets with exponentially distributed inter-arrival times.
+
+    :param duration: duration of the synthetic capture in seconds.
+    :param rate: average number of packets per second.
+    :param seed: seed of the random generator.
+
+    :return: list of packets sorted by timestamp.
+    """
+    generator = random.Random(seed)
+    packets = []
+    current_time = 1700000000.0
+
+    while current_time < 1700000000.0 + duration:
+        packets.append(SimpleNamespace(time=current_time))
+        current_time += generator.expovariate(rate)
+
+    return packets
+
+
+# This function checks that the windows of the packet table contain exactly the packets of the original windows
+def same_windows(legacy_windows, table_windows):
+    if len(legacy_windows) != len(table_windows):
+        return False
+
+    for legacy_window, table_window in zip(legacy_windows, table_windows):
+        if legacy_window['start_time'] != table_window['start_time'] or legacy_window['end_time'] != table_window['end_time']:
+            return False
+        if [packet.time for packet in legacy_window['packets']] != table_window['packets'].time.tolist():
+            return False
+
+    return True
+
+
+# This function is the original implementation of window_packets, which rescans all the packets for every window
+def legacy_window_packets(packets, delta, overlap=2):
+    if not packets:
+        return []
+
+    windows = []
+    start_time = packets[0].time
+    end_time = packets[-1].time
+    step = delta - overlap
+
+    current_start = start_time
+    while current_start <= end_time:
+        current_end = current_start + delta
+        window_pkts = [pkt for pkt in packets if current_start <= pkt.time < current_end]
+
+        if window_pkts:
+            windows.append({
+                'packets': window_pkts,
+                'start_time': current_start,
+                'end_time': current_end
+            })
+        current_start += step
+    return windows
+
+
+# This function returns the execution time of the given function in seconds
+def measure(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    print(f'\n{Fore.MAGENTA}Benchmarking window_packets with delta = {delta} and overlap = {overlap}{Style.RESET_ALL}')
+
+    for duration in capture_durations:
+        packets = generate_packets(duration, packet_rate)
+        packet_table = PacketTable([packet.time for packet in packets], [0] * len(packets),
+                                   [0] * len(packets), [0] * len(packets))
+
+        legacy_time, legacy_windows = measure(legacy_window_packets, packets, delta, overlap)
+        new_time, new_windows = measure(window_packets, packet_table, delta, overlap)
+
+        # Both implementations must produce exactly the same windows
+        if not same_windows(legacy_windows, new_windows):
+            print(f'{Fore.RED}ERROR: windows differ for a capture of {duration} seconds!{Style.RESET_ALL}')
+            continue
+
+        print(f'\n{Fore.YELLOW}Capture duration: {Style.RESET_ALL}{duration} s '
+              f'({len(packets)} packets, {len(new_windows)} windows)')
+        print(f'{Fore.YELLOW}Original implementation: {Style.RESET_ALL}{legacy_time:.4f} s')
+        print(f'{Fore.YELLOW}Single-pass implementation: {Style.RESET_ALL}{new_time:.4f} s '
+              f'({legacy_time / new_time:.1f}x faster)')
@@ -0,0 +1,186 @@
+# This file contains the time index of the captures: a sidecar file, next to each capture, that maps coarse time
+# buckets to the offsets of the first packet record of each bucket. The index is built once, by walking the record
+# headers of the capture, and reused as long as the capture does not change, so that a reader can seek straight to
+# the packets of a given time instead of parsing the capture from its beginning.
+# Building the index costs about as much as reading the whole capture, so the readers that can do without it (see
+# find_capture_shard(..., lazy=True)) only build it for large captures read again: until then, the sidecar file
+# only counts the reads of the capture.
+
+import os
+import json
+import mmap
+import math
+from bisect import bisect_right
+from common_modules.pcap_reader import CaptureParser
+
+# Define the extension of the index file written next to each capture
+capture_index_extension = '.tidx'
+
+# Define the duration in seconds of the time buckets of the index
+capture_index_bucket_seconds = 1.0
+
+# Define the minimum size in bytes of the captures indexed by the lazy readers (smaller captures are read from their
+# beginning, which costs little, and no sidecar file is written for them)
+capture_index_min_size = 16 * 1024 * 1024
+
+# Define the read of a capture on which the lazy readers build its index (None -> they never build it, and only use
+# the indexes already saved)
+capture_index_build_reads = 2
+
+# Version of the index file format -> increase it whenever the content of the index changes
+capture_index_version = 1
+
+
+# This function builds the time index of a capture by walking its record headers
+def build_capture_index(file_path, bucket_seconds=capture_index_bucket_seconds):
+    """
+    :param file_path: path of the .pcapng or .pcap file.
+    :param bucket_seconds: duration in seconds of the time buckets.
+
+    :return: dictionary with the size and modification time of the capture, the parser states, and for each bucket
+             with packets its number, the offset of its first packet record and the index of the parser state there.
+             'monotonic' is False when a packet is older than a previous bucket, so the index cannot be used to seek.
+    """
+    file_stat = os.stat(file_path)
+    index = {
+        'version': capture_index_version,
+        'file_size': file_stat.st_size,
+        'file_mtime_ns': file_stat.st_mtime_ns,
+        'bucket_seconds': bucket_seconds,
+        'monotonic': True,
+        'states': [],
+        'buckets': [],
+        'offsets': [],
+        'state_indexes': []
+    }
+
+    # Empty files cannot be memory-mapped
+    if file_stat.st_size == 0:
+        return index
+
+    parser = CaptureParser()
+    states = {}
+
+    with open(file_path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            with memoryview(mapped_file) as buffer:
+                for offset, timestamp in parser.iter_packet_records(buffer):
+                    bucket = math.floor(timestamp / bucket_seconds)
+
+                    if index['buckets'] and bucket <= index['buckets'][-1]:
+                        index['monotonic'] = index['monotonic'] and bucket == index['buckets'][-1]
+                        continue
+
+                    # The states are stored once, as JSON lists (a new state only follows a new section or interface)
+                    state = json.dumps(parser.get_state())
+                    state_index = states.setdefault(state, len(states))
+                    if state_index == len(index['states']):
+                        index['states'].append(json.loads(state))
+
+                    index['buckets'].append(bucket)
+                    index['offsets'].append(offset)
+                    index['state_indexes'].append(state_index)
+
+    return index
+
+
+# This function returns the time index of a capture, reading its sidecar file or building (and saving) it
+def load_capture_index(file_path, bucket_seconds=capture_index_bucket_seconds):
+    """
+    The sidecar file is used only if it was built with the same bucket duration for the capture of the same size
+    and modification time. When it cannot be written (e.g. a read-only dataset), the index is still returned.
+
+    :param file_path: path of the .pcapng or .pcap file.
+    :param bucket_seconds: duration in seconds of the time buckets.
+
+    :return: the index, as returned by build_capture_index.
+    """
+    index = _read_index_file(file_path, bucket_seconds)
+
+    if index is None or 'buckets' not in index:
+        index = build_capture_index(file_path, bucket_seconds)
+        _write_index_file(file_path, index)
+
+    return index
+
+
+# This function returns the content of the sidecar file of a capture, or None if it is missing or outdated
+def _read_index_file(file_path, bucket_seconds):
+    file_stat = os.stat(file_path)
+
+    try:
+        with open(file_path + capture_index_extension) as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError):
+        return None
+
+    if (index.get('version') == capture_index_version and index.get('bucket_seconds') == bucket_seconds
+            and index.get('file_size') == file_stat.st_size and index.get('file_mtime_ns') == file_stat.st_mtime_ns):
+        return index
+    return None
+
+
+# This function saves the sidecar file of a capture (nothing is saved if it cannot be written, e.g. a read-only dataset)
+def _write_index_file(file_path, index):
+    index_path = file_path + capture_index_extension
+
+    try:
+        # Written to a temporary file first, so that concurrent readers never see a partial index
+        temporary_path = f'{index_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as index_file:
+            json.dump(index, index_file, separators=(',', ':'))
+        os.replace(temporary_path, index_path)
+    except OSError:
+        pass
+
+
+# This function returns the saved index of a capture, building it only for a large capture read again
+def _load_lazy_capture_index(file_path, bucket_seconds):
+    index = _read_index_file(file_path, bucket_seconds)
+
+    if index is not None and 'buckets' in index:
+        return index
+
+    file_stat = os.stat(file_path)
+    if capture_index_build_reads is None or file_stat.st_size < capture_index_min_size:
+        return None
+
+    # Until the index is built, the sidecar file only counts the reads of the capture
+    reads = (index['reads'] if index is not None else 0) + 1
+    if reads < capture_index_build_reads:
+        _write_index_file(file_path, {'version': capture_index_version, 'file_size': file_stat.st_size,
+                                      'file_mtime_ns': file_stat.st_mtime_ns, 'bucket_seconds': bucket_seconds,
+                                      'reads': reads})
+        return None
+
+    index = build_capture_index(file_path, bucket_seconds)
+    _write_index_file(file_path, index)
+    return index
+
+
+# This function returns the shard from which a capture can be read to get all its packets captured at or after a time
+def find_capture_shard(file_path, start_time, bucket_seconds=capture_index_bucket_seconds, lazy=False):
+    """
+    :param file_path: path of the .pcapng or .pcap file.
+    :param start_time: UNIX timestamp of the first packet needed.
+    :param bucket_seconds: duration in seconds of the time buckets.
+    :param lazy: if True, a capture without a saved index is indexed only if it is at least capture_index_min_size
+                 bytes and this is its capture_index_build_reads-th read, otherwise None is returned (the reader can
+                 stop reading once past the packets it needs, which costs less than building the index).
+
+    :return: dictionary with the 'offset' of the first packet record of the bucket of start_time (or of the last
+             bucket before it) and the parser 'state' at that offset, to be passed to read_capture(..., shard=shard);
+             None if the capture must be read from its beginning.
+    """
+    index = _load_lazy_capture_index(file_path, bucket_seconds) if lazy else load_capture_index(file_path, bucket_seconds)
+
+    if index is None or not index['monotonic']:
+        return None
+
+    # The packets before the bucket of start_time all belong to earlier buckets, so they are older than start_time
+    position = bisect_right(index['buckets'], math.floor(start_time / bucket_seconds)) - 1
+    if position <= 0:
+        return None
+
+    state = index['states'][index['state_indexes'][position]]
+    return {'offset': index['offsets'][position], 'state': state}
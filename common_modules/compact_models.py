@@ -0,0 +1,209 @@
+# This file contains the compact export of the trained models and the lightweight predictors that load it
+# The Random Forest is stored as flat NumPy arrays (one .npy file per array, so that they can be memory-mapped) and is
+# predicted with NumPy only, while XGBoost is stored in its native booster format and predicted by the booster alone.
+# Both predictors return exactly the same predictions and probabilities as the scikit-learn / XGBClassifier models.
+
+import os
+import json
+import hashlib
+import numpy as np
+
+# Version of the compact Random Forest format
+forest_format_version = 1
+
+# Name of the file describing the arrays of a compact Random Forest, written after the arrays
+forest_manifest_name = 'manifest.json'
+
+# Arrays of a compact Random Forest: the nodes of all the trees are concatenated, and the children indexes point
+# to the concatenated nodes (-1 for the leaves)
+_forest_arrays = ('feature', 'threshold', 'children_left', 'children_right', 'missing_go_to_left', 'values', 'roots', 'classes')
+
+# Child index of the leaves, as in scikit-learn
+_TREE_LEAF = -1
+
+
+# This function exports a trained Random Forest as flat NumPy arrays
+def export_random_forest(model, directory_path):
+    """
+    Writes the trees of a trained RandomForestClassifier as flat NumPy arrays.
+
+    :param model: the trained RandomForestClassifier.
+    :param directory_path: the directory where the arrays are written (created if it does not exist).
+    """
+    trees = [estimator.tree_ for estimator in model.estimators_]
+
+    # Index of the root of each tree in the concatenated nodes
+    roots = np.zeros(len(trees), dtype=np.int64)
+    np.cumsum([tree.node_count for tree in trees[:-1]], out=roots[1:])
+
+    def concatenate_children(children):
+        return np.concatenate([np.where(tree_children == _TREE_LEAF, _TREE_LEAF, tree_children + root)
+                               for tree_children, root in zip(children, roots)]).astype(np.int64)
+
+    arrays = {
+        'feature': np.concatenate([tree.feature for tree in trees]).astype(np.int64),
+        'threshold': np.concatenate([tree.threshold for tree in trees]).astype(np.float64),
+        'children_left': concatenate_children([tree.children_left for tree in trees]),
+        'children_right': concatenate_children([tree.children_right for tree in trees]),
+        'missing_go_to_left': np.concatenate([tree.missing_go_to_left for tree in trees]).astype(bool),
+        # Fraction of the training samples of each class in each node, as returned by the tree predict_proba
+        'values': np.concatenate([tree.value[:, 0, :model.n_classes_] for tree in trees]).astype(np.float64),
+        'roots': roots,
+        'classes': np.asarray(model.classes_)
+    }
+
+    os.makedirs(directory_path, exist_ok=True)
+
+    digest = hashlib.sha256()
+    for name in _forest_arrays:
+        np.save(os.path.join(directory_path, f'{name}.npy'), arrays[name], allow_pickle=False)
+        digest.update(arrays[name].tobytes())
+
+    # The manifest is written last and changes whenever the arrays change
+    manifest = {
+        'format_version': forest_format_version,
+        'n_trees': len(trees),
+        'n_features': int(model.n_features_in_),
+        'n_classes': int(model.n_classes_),
+        'digest': digest.hexdigest()
+    }
+
+    with open(os.path.join(directory_path, forest_manifest_name), 'w') as file:
+        json.dump(manifest, file, indent=4)
+
+
+# This function exports a trained XGBoost classifier in the native booster format
+def export_xgboost(model, file_path):
+    """
+    Writes the booster of a trained XGBClassifier in the native XGBoost format (UBJSON for a .ubj file, JSON for a .json file).
+
+    :param model: the trained XGBClassifier.
+    :param file_path: the path of the booster file.
+    """
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    model.get_booster().save_model(file_path)
+
+
+class RandomForestPredictor:
+    """
+    Random Forest predictor that only requires NumPy, loaded from the arrays written by export_random_forest.
+    The probabilities are the mean of the leaf values of the trees, accumulated in the order of the trees as
+    scikit-learn does, so that they are identical to the ones of the exported model.
+    """
+
+    def __init__(self, directory_path, mmap_mode='r'):
+        """
+        :param directory_path: the directory containing the arrays of the forest.
+        :param mmap_mode: the memory-map mode of the arrays (None to read them into memory).
+        """
+        with open(os.path.join(directory_path, forest_manifest_name)) as file:
+            self.manifest = json.load(file)
+
+        if self.manifest['format_version'] != forest_format_version:
+            raise ValueError(f'unsupported compact forest format version: {self.manifest["format_version"]}')
+
+        for name in _forest_arrays:
+            setattr(self, name, np.load(os.path.join(directory_path, f'{name}.npy'), mmap_mode=mmap_mode, allow_pickle=False))
+
+        self.classes_ = self.classes
+        self.n_features_in_ = self.manifest['n_features']
+
+    # This method returns the index of the leaf reached by each sample in each tree
+    def apply(self, X):
+        """
+        :param X: array of shape (n_samples, n_features).
+        :return: array of shape (n_trees, n_samples) with the indexes of the leaves in the concatenated nodes.
+        """
+        X = np.asarray(X, dtype=np.float32)
+        n_samples = len(X)
+
+        # Walk all the (tree, sample) pairs at once, dropping the pairs that reached a leaf
+        nodes = np.repeat(np.asarray(self.roots), n_samples)
+        positions = np.arange(len(nodes))
+        leaves = np.empty_like(nodes)
+
+        while len(positions):
+            left_children = self.children_left[nodes]
+            is_leaf = left_children == _TREE_LEAF
+            leaves[positions[is_leaf]] = nodes[is_leaf]
+
+            is_split = ~is_leaf
+            positions, nodes, left_children = positions[is_split], nodes[is_split], left_children[is_split]
+
+            # Same split rule as scikit-learn: missing values follow the learned direction, the others are compared
+            # (as float32 values promoted to float64) with the threshold
+            feature_values = X[positions % n_samples, self.feature[nodes]]
+            go_left = np.where(np.isnan(feature_values), self.missing_go_to_left[nodes], feature_values <= self.threshold[nodes])
+            nodes = np.where(go_left, left_children, self.children_right[nodes])
+
+        return leaves.reshape(len(self.roots), n_samples)
+
+    # This method returns the probability of each class for each sample
+    def predict_proba(self, X):
+        leaves = self.apply(X)
+        probabilities = np.zeros((leaves.shape[1], len(self.classes_)), dtype=np.float64)
+
+        for tree_leaves in leaves:
+            probabilities += self.values[tree_leaves]
+
+        probabilities /= len(leaves)
+        return probabilities
+
+    # This method returns the predicted class of each sample
+    def predict(self, X):
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+
+
+class XGBoostPredictor:
+    """
+    XGBoost predictor that loads the native booster file written by export_xgboost, without the scikit-learn
+    wrapper, and applies the same post-processing of the probabilities as XGBClassifier.
+    """
+
+    def __init__(self, file_path):
+        """
+        :param file_path: the path of the booster file.
+        """
+        # XGBoost is imported only when an XGBoost model is loaded
+        from xgboost import Booster
+
+        self.booster = Booster(model_file=file_path)
+
+        learner_config = json.loads(self.booster.save_config())['learner']
+        self.objective = learner_config['objective']['name']
+
+        if self.objective not in ('binary:logistic', 'multi:softprob'):
+            raise ValueError(f'unsupported XGBoost objective: {self.objective}')
+
+        self.n_classes = max(int(learner_config['learner_model_param']['num_class']), 2)
+        self.classes_ = np.arange(self.n_classes)
+        self.n_features_in_ = self.booster.num_features()
+
+        # Models trained with early stopping predict with the trees up to the best iteration
+        best_iteration = self.booster.attr('best_iteration')
+        self.iteration_range = (0, int(best_iteration) + 1) if best_iteration is not None else (0, 0)
+
+    # This method returns the raw output of the booster
+    def _predict(self, X):
+        return self.booster.inplace_predict(np.asarray(X), iteration_range=self.iteration_range, missing=np.nan)
+
+    # This method returns the probability of each class for each sample
+    def predict_proba(self, X):
+        probabilities = self._predict(X)
+        if probabilities.ndim == 2:
+            return probabilities
+
+        # Binary objective: the booster returns the probability of the positive class
+        return np.vstack((1.0 - probabilities, probabilities)).T
+
+    # This method returns the predicted class of each sample
+    def predict(self, X):
+        probabilities = self._predict(X)
+
+        if probabilities.ndim > 1:
+            return np.argmax(probabilities, axis=1)
+
+        # Binary objective: positive class when its probability is greater than 0.5
+        predictions = np.repeat(0, probabilities.shape[0])
+        predictions[probabilities > 0.5] = 1
+        return predictions
@@ -0,0 +1,221 @@
+# This file contains the registry of the devices: their names, addresses and activities, loaded from a configuration file
+# The configuration can be a JSON, YAML or CSV file, so devices and activities are added without changing the code.
+# Addresses are indexed as integers (a hash table for the single addresses and one per prefix length for the networks),
+# so finding the device of a packet address costs a few dictionary lookups however many devices there are.
+
+import os
+import csv
+import sys
+import json
+import ipaddress
+from colorama import Fore, Style
+
+# Define the configuration file of the devices (.json, .yaml / .yml or .csv)
+device_registry_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'devices.json')
+
+# Registry loaded from device_registry_path, shared by the whole process
+_device_registry = None
+
+
+class DeviceRegistry:
+    """
+    Maps the device names to their IPv4 addresses / networks and MAC addresses, and the activity names to their labels.
+    Names are matched exactly first and then, as the original lookup tables did, by substring (e.g. a dataset folder
+    name containing the device name); the results of the substring matches are cached.
+    """
+
+    def __init__(self, devices, activities):
+        """
+        :param devices: dictionary mapping each device name to a dictionary with its 'addresses' (IPv4 addresses or
+                        CIDR networks), 'macs' (MAC addresses) and 'activities' (activity names), all optional.
+        :param activities: dictionary mapping each activity name to its integer label.
+        """
+        self.devices = {}
+        self.activities = {}
+        self.activity_names = {}
+
+        # Single addresses, networks (netmask and networks of each prefix length, longest first) and MAC addresses, all as integers
+        self._addresses = {}
+        self._networks = {}
+        self._macs = {}
+
+        self._device_matches = {}
+        self._activity_matches = {}
+
+        for activity_name, label in activities.items():
+            self.add_activity(activity_name, label)
+
+        for device_name, device in devices.items():
+            self.add_device(device_name, device.get('addresses', []), device.get('macs', []), device.get('activities', []))
+
+    # This method registers an activity and its label
+    def add_activity(self, activity_name, label):
+        label = int(label)
+        activity_name = activity_name.lower()
+
+        if self.activity_names.get(label, activity_name) != activity_name or self.activities.get(activity_name, label) != label:
+            raise ValueError(f'conflicting label {label} for activity {activity_name}')
+
+        self.activities[activity_name] = label
+        self.activity_names[label] = activity_name
+        self._activity_matches.clear()
+
+    # This method registers a device with its addresses, networks, MAC addresses and activities
+    def add_device(self, device_name, addresses=(), macs=(), activities=()):
+        device_name = device_name.lower()
+        device = self.devices.setdefault(device_name, {'addresses': [], 'networks': [], 'macs': [], 'activities': []})
+
+        for address in addresses:
+            network = ipaddress.IPv4Network(address, strict=False)
+
+            if network.prefixlen == 32:
+                self._register(self._addresses, int(network.network_address), device_name, address)
+                device['addresses'].append(str(network.network_address))
+            else:
+                _, networks = self._networks.setdefault(network.prefixlen, (int(network.netmask), {}))
+                self._register(networks, int(network.network_address), device_name, address)
+                device['networks'].append(str(network))
+
+        for mac in macs:
+            self._register(self._macs, mac_to_int(mac), device_name, mac)
+            device['macs'].append(mac.lower())
+
+        for activity_name in activities:
+            if activity_name.lower() not in self.activities:
+                raise ValueError(f'unknown activity {activity_name} for device {device_name}')
+            device['activities'].append(activity_name.lower())
+
+        # Longest prefixes are checked first
+        self._networks = dict(sorted(self._networks.items(), reverse=True))
+        self._device_matches.clear()
+
+    # This method adds an address to an index, rejecting the addresses already assigned to another device
+    @staticmethod
+    def _register(index, key, device_name, address):
+        if index.get(key, device_name) != device_name:
+            raise ValueError(f'address {address} of device {device_name} is already assigned to device {index[key]}')
+        index[key] = device_name
+
+    # This method returns the name of the registered device matching the given name, or None
+    def match_device(self, device_name):
+        device_name = device_name.lower()
+
+        if device_name in self.devices:
+            return device_name
+
+        if device_name not in self._device_matches:
+            self._device_matches[device_name] = next((name for name in self.devices if name in device_name), None)
+        return self._device_matches[device_name]
+
+    # This method returns the first IP address of the device, or -1 if the device or its address is unknown
+    def get_ip_address(self, device_name):
+        addresses = self.get_ip_addresses(device_name)
+        return addresses[0] if addresses else -1
+
+    # This method returns the IP addresses of the device (empty if the device is unknown)
+    def get_ip_addresses(self, device_name):
+        matched_name = self.match_device(device_name)
+        return [] if matched_name is None else list(self.devices[matched_name]['addresses'])
+
+    # This method returns the name of the device owning an IPv4 address (integer or dotted string), or None
+    def lookup_address(self, address):
+        if isinstance(address, str):
+            address = int(ipaddress.IPv4Address(address))
+
+        device_name = self._addresses.get(address)
+        if device_name is not None:
+            return device_name
+
+        for netmask, networks in self._networks.values():
+            device_name = networks.get(address & netmask)
+            if device_name is not None:
+                return device_name
+
+        return None
+
+    # This method returns the name of the device owning a MAC address (integer or 'aa:bb:cc:dd:ee:ff' string), or None
+    def lookup_mac(self, mac):
+        return self._macs.get(mac_to_int(mac) if isinstance(mac, str) else mac)
+
+    # This method returns the label of the activity, or -1 if the activity is unknown
+    def get_flow_label(self, activity):
+        activity = activity.lower()
+
+        if activity in self.activities:
+            return self.activities[activity]
+
+        if activity not in self._activity_matches:
+            self._activity_matches[activity] = next((label for name, label in self.activities.items() if name in activity), -1)
+        return self._activity_matches[activity]
+
+    # This method returns the name of the activity with the given label, or -1 if the label is unknown
+    def get_activity_name(self, label):
+        return self.activity_names.get(label, -1)
+
+
+# This function converts a MAC address into its integer representation
+def mac_to_int(mac):
+    return int(mac.replace(':', '').replace('-', ''), 16)
+
+
+# This function reads a device registry from a JSON, YAML or CSV configuration file
+def read_device_registry(file_path):
+    """
+    JSON and YAML files contain an 'activities' mapping (activity name -> label) and a 'devices' mapping
+    (device name -> 'addresses', 'macs' and 'activities' lists). CSV files have one row per device with the columns
+    'device', 'addresses', 'macs' and 'activities', where the values are separated by ';' and each activity is
+    written as name:label.
+
+    :param file_path: path of the configuration file.
+    :return: the DeviceRegistry.
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+
+    with open(file_path, newline='') as file:
+        if extension == '.csv':
+            return _read_csv_registry(file)
+
+        if extension in ('.yaml', '.yml'):
+            # PyYAML is only needed for YAML configurations
+            import yaml
+            configuration = yaml.safe_load(file)
+        else:
+            configuration = json.load(file)
+
+    return DeviceRegistry(configuration.get('devices', {}), configuration.get('activities', {}))
+
+
+# This function reads the rows of a CSV device registry
+def _read_csv_registry(file):
+    registry = DeviceRegistry({}, {})
+
+    def split_values(value):
+        return [item.strip() for item in (value or '').split(';') if item.strip()]
+
+    for row in csv.DictReader(file):
+        activities = [activity.rpartition(':') for activity in split_values(row.get('activities'))]
+
+        for activity_name, _, label in activities:
+            registry.add_activity(activity_name, label)
+
+        registry.add_device(row['device'], split_values(row.get('addresses')), split_values(row.get('macs')),
+                            [activity_name for activity_name, _, _ in activities])
+
+    return registry
+
+
+# This function returns the device registry of device_registry_path, loading it on first use
+def get_device_registry():
+    global _device_registry
+
+    if _device_registry is None:
+        try:
+            _device_registry = read_device_registry(device_registry_path)
+        except ImportError:
+            print(f'{Fore.RED}\nERROR: PyYAML is required to read the device registry: {Style.RESET_ALL}{device_registry_path}')
+            sys.exit(1)
+        except (OSError, ValueError, KeyError, AttributeError) as error:
+            print(f'{Fore.RED}\nERROR: unable to read the device registry {device_registry_path}: {Style.RESET_ALL}{error}')
+            sys.exit(1)
+
+    return _device_registry
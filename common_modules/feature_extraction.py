@@ -0,0 +1,230 @@
+# This file contains the batched extraction of the statistical features used by the classifiers
+# The features of many windows are computed at once from offset-indexed arrays of packet lengths, where the lengths
+# of window i are values[offsets[i]:offsets[i + 1]]. Every window must contain at least one packet for each flow.
+
+import hashlib
+import numpy as np
+from common_modules.instrumentation import stage
+
+# Features in the column order expected by the trained models: (feature name, flow, statistic)
+# The statistics follow the pandas / NumPy semantics of the original implementation: unbiased variance and standard
+# deviation, bias-corrected skew and kurtosis as in pandas, linearly interpolated percentiles as in np.percentile.
+feature_columns = [
+    ('Complete Maximum', 'complete', 'max'),
+    ('Outgoing Maximum', 'outgoing', 'max'),
+    ('Complete Skew', 'complete', 'skew'),
+    ('Outgoing Variance', 'outgoing', 'var'),
+    ('Outgoing Standard Deviation', 'outgoing', 'std'),
+    ('Outgoing Kurtosis', 'outgoing', 'kurtosis'),
+    ('Outgoing Skew', 'outgoing', 'skew'),
+    ('Outgoing Median Absolute Deviation', 'outgoing', 'mad'),
+    ('Outgoing 90th Percentile', 'outgoing', 90),
+    ('Complete Mean', 'complete', 'mean'),
+    ('Complete Kurtosis', 'complete', 'kurtosis'),
+    ('Outgoing Mean', 'outgoing', 'mean'),
+    ('Variance', 'complete', 'var'),
+    ('Standard Deviation', 'complete', 'std'),
+    ('Complete 90th Percentile', 'complete', 90),
+    ('Outgoing 80th Percentile', 'outgoing', 80),
+    ('Complete Median Absolute Deviation', 'complete', 'mad'),
+    ('Incoming Variance', 'incoming', 'var'),
+    ('Incoming Skew', 'incoming', 'skew'),
+    ('Incoming Standard Deviation', 'incoming', 'std'),
+    ('Incoming Kurtosis', 'incoming', 'kurtosis'),
+    ('Incoming Median Absolute Deviation', 'incoming', 'mad'),
+    ('Complete Number of packets', 'complete', 'count'),
+    ('Outgoing 70th Percentile', 'outgoing', 70),
+    ('Outgoing Number of packets', 'outgoing', 'count'),
+    ('Incoming Number of packets', 'incoming', 'count'),
+    ('Incoming Mean', 'incoming', 'mean'),
+    ('Incoming 30th Percentile', 'incoming', 30),
+    ('Incoming 40th Percentile', 'incoming', 40),
+    ('Incoming 60th Percentile', 'incoming', 60),
+    ('Complete 10th Percentile', 'complete', 10),
+    ('Complete 20th Percentile', 'complete', 20),
+    ('Incoming 50th Percentile', 'incoming', 50),
+    ('Incoming 20th Percentile', 'incoming', 20),
+    ('Complete 80th Percentile', 'complete', 80),
+    ('Complete 30th Percentile', 'complete', 30),
+    ('Incoming 10th Percentile', 'incoming', 10),
+    ('Outgoing 60th Percentile', 'outgoing', 60),
+    ('Incoming 80th Percentile', 'incoming', 80)
+]
+
+# Names of the features in column order
+feature_names = [name for name, _, _ in feature_columns]
+
+# Version of the feature schema -> increase it whenever the way the features are computed changes,
+# so that the features stored in the on-disk cache are computed again
+# (2: the training flows only contain the packets captured in [t, t + delta], not the ones before the activity)
+feature_schema_version = 2
+
+# Identifier of the feature schema, which also changes when the feature columns change
+_feature_columns_digest = hashlib.sha256('\n'.join(feature_names).encode()).hexdigest()[:16]
+feature_schema_id = f'{feature_schema_version}:{_feature_columns_digest}'
+
+# Values below this threshold are treated as floating point noise, as pandas does for skew and kurtosis
+_FLOATING_POINT_TOLERANCE = 1e-14
+
+
+# This function concatenates a list of per-window length arrays into offset-indexed values
+def concatenate_segments(segments):
+    """
+    Concatenates the packet lengths of many windows into a single array with the offsets of each window.
+
+    :param segments: list of arrays of packet lengths, one per window.
+    :return: tuple (values, offsets), where the lengths of window i are values[offsets[i]:offsets[i + 1]].
+    """
+    offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+    np.cumsum([len(segment) for segment in segments], out=offsets[1:])
+
+    values = np.concatenate(segments).astype(np.int64, copy=False) if segments else np.empty(0, dtype=np.int64)
+
+    return values, offsets
+
+
+# This function sorts the values of every segment with a single sort
+def _sort_segments(values, segment_ids):
+    # The segment id in the high bits keeps every segment in place, while the low bits sort its values
+    keys = (segment_ids << 32) | values
+    keys.sort()
+    return keys & 0xffffffff
+
+
+# This function returns the given percentile of every sorted segment, interpolated as in np.percentile
+def _segment_percentile(sorted_values, offsets, counts, percentile):
+    virtual_index = (counts - 1) * np.true_divide(percentile, 100)
+    previous_index = np.floor(virtual_index).astype(np.int64)
+    next_index = np.minimum(previous_index + 1, counts - 1)
+    gamma = virtual_index - previous_index
+
+    previous_value = sorted_values[offsets[:-1] + previous_index]
+    next_value = sorted_values[offsets[:-1] + next_index]
+
+    # Same interpolation as NumPy's _lerp, which is exact at both ends of the interval
+    difference = next_value - previous_value
+    return np.where(gamma >= 0.5, next_value - difference * (1 - gamma), previous_value + difference * gamma)
+
+
+# This function returns the median of every sorted segment
+def _segment_median(sorted_values, offsets, counts):
+    lower = sorted_values[offsets[:-1] + (counts - 1) // 2]
+    upper = sorted_values[offsets[:-1] + counts // 2]
+    return (lower + upper) / 2
+
+
+# This function computes the requested statistics of every segment of a flow
+def compute_segment_statistics(values, offsets, statistics):
+    """
+    Computes statistics of many segments at once, sharing the sort and the central moments between them.
+
+    :param values: integer array with the packet lengths of all the segments.
+    :param offsets: array of n_segments + 1 offsets delimiting the segments (every segment must be non-empty).
+    :param statistics: set of statistics to compute ('max', 'mean', 'var', 'std', 'skew', 'kurtosis', 'mad', 'count' or a percentile).
+
+    :return: dictionary mapping each statistic to the array of its values for every segment.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    segment_ids = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+    results = {}
+
+    if 'count' in statistics:
+        results['count'] = counts.astype(np.float64)
+
+    # Order statistics share one sort of the segments
+    percentiles = [statistic for statistic in statistics if not isinstance(statistic, str)]
+    if percentiles or 'max' in statistics or 'mad' in statistics:
+        sorted_values = _sort_segments(values, segment_ids)
+
+        if 'max' in statistics:
+            results['max'] = sorted_values[offsets[1:] - 1].astype(np.float64)
+
+        for percentile in percentiles:
+            results[percentile] = _segment_percentile(sorted_values, offsets, counts, percentile)
+
+        if 'mad' in statistics:
+            # Twice the absolute deviation from the median is an integer, so it can be sorted like the lengths
+            doubled_median = sorted_values[offsets[:-1] + (counts - 1) // 2] + sorted_values[offsets[:-1] + counts // 2]
+            doubled_deviations = np.abs(2 * values - doubled_median[segment_ids])
+            results['mad'] = _segment_median(_sort_segments(doubled_deviations, segment_ids), offsets, counts) / 2
+
+    # Moment statistics share the mean and the central power sums
+    moments = {'mean', 'var', 'std', 'skew', 'kurtosis'} & set(statistics)
+    if moments:
+        mean = np.add.reduceat(values, offsets[:-1]) / counts
+        results['mean'] = mean
+
+    if moments - {'mean'}:
+        deviations = values - mean[segment_ids]
+        squared_deviations = deviations ** 2
+        m2 = np.add.reduceat(squared_deviations, offsets[:-1])
+        n = counts.astype(np.float64)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if 'var' in statistics or 'std' in statistics:
+                variance = np.where(counts > 1, m2 / (n - 1), np.nan)
+                results['var'] = variance
+                results['std'] = np.sqrt(variance)
+
+            if 'skew' in statistics:
+                m3 = np.add.reduceat(squared_deviations * deviations, offsets[:-1])
+                m2_skew = np.where(np.abs(m2) < _FLOATING_POINT_TOLERANCE, 0, m2)
+                m3 = np.where(np.abs(m3) < _FLOATING_POINT_TOLERANCE, 0, m3)
+                skew = (n * (n - 1) ** 0.5 / (n - 2)) * (m3 / m2_skew ** 1.5)
+                skew = np.where(m2_skew == 0, 0, skew)
+                results['skew'] = np.where(counts < 3, np.nan, skew)
+
+            if 'kurtosis' in statistics:
+                m4 = np.add.reduceat(squared_deviations ** 2, offsets[:-1])
+                adjustment = 3 * (n - 1) ** 2 / ((n - 2) * (n - 3))
+                numerator = n * (n + 1) * (n - 1) * m4
+                denominator = (n - 2) * (n - 3) * m2 ** 2
+                numerator = np.where(np.abs(numerator) < _FLOATING_POINT_TOLERANCE, 0, numerator)
+                denominator = np.where(np.abs(denominator) < _FLOATING_POINT_TOLERANCE, 0, denominator)
+                kurtosis = np.where(denominator == 0, 0, numerator / denominator - adjustment)
+                results['kurtosis'] = np.where(counts < 4, np.nan, kurtosis)
+
+    return results
+
+
+# This function computes the feature matrix of many windows at once
+def compute_window_features(complete_lengths, complete_offsets, incoming_lengths, incoming_offsets,
+                            outgoing_lengths, outgoing_offsets, columns=None):
+    """
+    Computes the statistical features of many windows at once.
+
+    :param complete_lengths: packet lengths of the complete flow of all the windows.
+    :param complete_offsets: offsets delimiting the complete flow of each window.
+    :param incoming_lengths: packet lengths of the incoming flow of all the windows.
+    :param incoming_offsets: offsets delimiting the incoming flow of each window.
+    :param outgoing_lengths: packet lengths of the outgoing flow of all the windows.
+    :param outgoing_offsets: offsets delimiting the outgoing flow of each window.
+    :param columns: optional list of feature names to compute (default: all the features, in model order).
+
+    :return: NumPy array of shape (n_windows, n_columns) with the features of each window.
+    """
+    with stage('compute_features'):
+        selected_columns = feature_columns if columns is None else [feature_columns[feature_names.index(name)] for name in columns]
+
+        flows = {
+            'complete': (complete_lengths, complete_offsets),
+            'incoming': (incoming_lengths, incoming_offsets),
+            'outgoing': (outgoing_lengths, outgoing_offsets)
+        }
+
+        # Compute only the statistics required by the selected columns, grouped by flow
+        flow_statistics = {}
+        for flow in flows:
+            required_statistics = {statistic for _, column_flow, statistic in selected_columns if column_flow == flow}
+            if required_statistics:
+                flow_statistics[flow] = compute_segment_statistics(*flows[flow], required_statistics)
+
+        n_windows = len(complete_offsets) - 1
+        features = np.empty((n_windows, len(selected_columns)), dtype=np.float64)
+
+        for index, (_, flow, statistic) in enumerate(selected_columns):
+            features[:, index] = flow_statistics[flow][statistic]
+
+        return features
@@ -1,4 +1,8 @@
 # This file contains the code used to label the flows in the dataset
+# The activities and their labels are defined in the device registry (see common_modules/device_registry.py)
+
+from common_modules.device_registry import get_device_registry
+
 
 def get_flow_label(activity):
     """
@@ -7,23 +11,8 @@ def get_flow_label(activity):
     :return: the integer label associated with the activity.
     """
 
-    # Dictionary containing the label for each activity
-    label_dictionary = {
-        'speaker-startup': 0,
-        'camera-startup': 1,
-        'play-music': 2,
-        'volume-adjust': 3,
-        'video-stream': 4,
-        'call': 5
-    }
-
-    # Iterate over the dictionary and return the label if the activity is found
-    for label, value in label_dictionary.items():
-        if label in activity.lower():
-            return value
-
     # Return -1 if no matching label is found
-    return -1
+    return get_device_registry().get_flow_label(activity)
 
 def get_activity_name_from_label(label):
     """
@@ -32,15 +21,5 @@ def get_activity_name_from_label(label):
     :return: the string name of the activity associated with the label.
     """
 
-    # Dictionary containing the label for each activity
-    label_dictionary = {
-        0: 'speaker-startup',
-        1: 'camera-startup',
-        2: 'play-music',
-        3: 'volume-adjust',
-        4: 'video-stream',
-        5: 'call'
-    }
-
     # Return the activity name if the label is found
-    return label_dictionary.get(label, -1)
+    return get_device_registry().get_activity_name(label)
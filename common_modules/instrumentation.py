@@ -0,0 +1,243 @@
+# This file contains the instrumentation of the pipeline: per-stage timers and counters (files, packets, windows,
+# predictions, ...), with an optional cProfile or tracemalloc capture, summarized as JSON at the end of a run.
+# It is disabled by default: stage() then returns a shared no-op context and count() returns at once, so the
+# instrumented code runs at the same speed. Enable it with the environment variables (or with enable_metrics):
+#   PIPELINE_METRICS=1 python main.py <dataset>                  -> summary written to pipeline_metrics.json
+#   PIPELINE_METRICS=run.json python main.py <dataset>           -> summary written to run.json
+#   PIPELINE_PROFILE=cprofile,tracemalloc PIPELINE_METRICS=1 ... -> also profile the run
+
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+import multiprocessing
+from colorama import Fore, Style
+
+# Define the environment variable enabling the metrics (1 or the path of the JSON summary)
+metrics_variable = 'PIPELINE_METRICS'
+
+# Define the environment variable choosing the profilers ('cprofile', 'tracemalloc' or both, separated by commas)
+profile_variable = 'PIPELINE_PROFILE'
+
+# Define the file of the JSON summary when the metrics are enabled without a path
+default_metrics_path = 'pipeline_metrics.json'
+
+# Define the number of functions (cProfile) and allocation sites (tracemalloc) listed in the summary
+profile_top_entries = 15
+
+_lock = threading.Lock()
+_null_stage = contextlib.nullcontext()
+
+_enabled = False
+_metrics_path = None
+_profilers = ()
+_profiler = None
+_start_time = None
+
+# Stage name -> [total seconds, calls], counter name -> value
+_stages = {}
+_counters = {}
+
+
+# This function enables the metrics (and the chosen profilers) from now until the summary is emitted
+def enable_metrics(metrics_path=None, profilers=()):
+    """
+    :param metrics_path: path of the JSON summary (default: default_metrics_path).
+    :param profilers: profilers to run, among 'cprofile' and 'tracemalloc'.
+    """
+    global _enabled, _metrics_path, _profilers, _profiler, _start_time
+
+    unknown_profilers = set(profilers) - {'cprofile', 'tracemalloc'}
+    if unknown_profilers:
+        print(f'{Fore.RED}\nERROR: unknown profiler: {Style.RESET_ALL}{", ".join(sorted(unknown_profilers))}')
+        sys.exit(1)
+
+    _enabled = True
+    _metrics_path = metrics_path or default_metrics_path
+    _profilers = tuple(profilers)
+    _start_time = time.perf_counter()
+    reset_metrics()
+
+    if 'tracemalloc' in _profilers:
+        import tracemalloc
+        tracemalloc.start()
+
+    if 'cprofile' in _profilers:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+# This function returns True if the metrics are enabled
+def metrics_enabled():
+    return _enabled
+
+
+# This function returns a context manager adding the time spent inside it to the given stage
+def stage(name):
+    if not _enabled:
+        return _null_stage
+    return _Stage(name)
+
+
+class _Stage:
+    """
+    Times a stage; the times of the stages running in several threads at once are summed.
+    """
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        elapsed_time = time.perf_counter() - self.start
+
+        with _lock:
+            totals = _stages.setdefault(self.name, [0.0, 0])
+            totals[0] += elapsed_time
+            totals[1] += 1
+
+
+# This function adds value to the given counter
+def count(name, value=1):
+    if not _enabled:
+        return
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+# This function empties the timers and counters
+def reset_metrics():
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+
+
+# This function returns the timers and counters recorded until now, or None if the metrics are disabled
+def get_metrics():
+    if not _enabled:
+        return None
+
+    with _lock:
+        return {'stages': {name: list(totals) for name, totals in _stages.items()}, 'counters': dict(_counters)}
+
+
+# This function adds the timers and counters recorded by another process (see run_with_metrics)
+def merge_metrics(metrics):
+    if not _enabled or metrics is None:
+        return
+
+    with _lock:
+        for name, (seconds, calls) in metrics['stages'].items():
+            totals = _stages.setdefault(name, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += calls
+
+        for name, value in metrics['counters'].items():
+            _counters[name] = _counters.get(name, 0) + value
+
+
+# This function runs a task of a process pool and returns its result with the metrics it recorded
+def run_with_metrics(function, *args):
+    """
+    The worker processes inherit the metrics settings, but their timers and counters stay in the worker: submit
+    run_with_metrics(function, ...) instead of function(...) and pass the returned metrics to merge_metrics.
+
+    :return: tuple (result of the function, metrics recorded by the task or None if the metrics are disabled).
+    """
+    # The profilers only run in the main process (a forked worker inherits them)
+    if multiprocessing.parent_process() is not None:
+        if _profiler is not None:
+            _profiler.disable()
+        if 'tracemalloc' in _profilers:
+            import tracemalloc
+            tracemalloc.stop()
+
+    reset_metrics()
+    result = function(*args)
+    return result, get_metrics()
+
+
+# This function writes the JSON summary of the run and stops the profilers (nothing is done if the metrics are disabled)
+def emit_metrics_summary(run_name='pipeline'):
+    """
+    :param run_name: name of the run, written in the summary.
+    :return: the summary, or None if the metrics are disabled.
+    """
+    global _profiler
+
+    if not _enabled:
+        return None
+
+    metrics = get_metrics()
+    summary = {
+        'run': run_name,
+        'wall_seconds': time.perf_counter() - _start_time,
+        'stages': {name: {'seconds': seconds, 'calls': calls} for name, (seconds, calls) in sorted(metrics['stages'].items())},
+        'counters': dict(sorted(metrics['counters'].items()))
+    }
+
+    if _profiler is not None:
+        _profiler.disable()
+        summary['cprofile'] = _summarize_profile(_profiler)
+        _profiler = None
+
+    if 'tracemalloc' in _profilers:
+        summary['tracemalloc'] = _summarize_allocations()
+
+    with open(_metrics_path, 'w') as file:
+        json.dump(summary, file, indent=2)
+
+    print(f'\n{Fore.GREEN}Metrics summary written to: {Style.RESET_ALL}{_metrics_path}')
+
+    return summary
+
+
+# This function saves the cProfile statistics next to the summary and returns the functions with the highest cumulative time
+def _summarize_profile(profiler):
+    import pstats
+
+    profile_path = os.path.splitext(_metrics_path)[0] + '.prof'
+    profiler.dump_stats(profile_path)
+
+    statistics = pstats.Stats(profiler)
+    functions = sorted(statistics.stats.items(), key=lambda item: item[1][3], reverse=True)[:profile_top_entries]
+
+    return {
+        'file': profile_path,
+        'top_cumulative': [{'function': f'{file_name}:{line}({function_name})', 'calls': calls, 'total_seconds': total_time,
+                            'cumulative_seconds': cumulative_time}
+                           for (file_name, line, function_name), (_, calls, total_time, cumulative_time, _) in functions]
+    }
+
+
+# This function returns the peak traced memory and the allocation sites holding the most memory, and stops tracemalloc
+def _summarize_allocations():
+    import tracemalloc
+
+    current_size, peak_size = tracemalloc.get_traced_memory()
+    allocations = tracemalloc.take_snapshot().statistics('lineno')[:profile_top_entries]
+    tracemalloc.stop()
+
+    return {
+        'current_mib': current_size / 2 ** 20,
+        'peak_mib': peak_size / 2 ** 20,
+        'top_allocations': [{'location': str(allocation.traceback), 'size_mib': allocation.size / 2 ** 20, 'blocks': allocation.count}
+                            for allocation in allocations]
+    }
+
+
+# The metrics are enabled by the environment variables when the module is first imported (the worker processes,
+# which inherit the variables, record the metrics of their tasks but do not run the profilers)
+if os.environ.get(metrics_variable):
+    enable_metrics(None if os.environ[metrics_variable] == '1' else os.environ[metrics_variable],
+                   [profiler.strip() for profiler in os.environ.get(profile_variable, '').split(',') if profiler.strip()]
+                   if multiprocessing.parent_process() is None else ())
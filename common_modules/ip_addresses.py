@@ -1,4 +1,8 @@
 # This file contains the code used to map the device names to the corresponding IP addresses
+# The devices and their addresses are defined in the device registry (see common_modules/device_registry.py)
+
+from common_modules.device_registry import get_device_registry
+
 
 # This function returns the IP address associated with the device name passed as parameter
 def get_ip_address(device_name):
@@ -9,16 +13,5 @@ def get_ip_address(device_name):
     :return: the IP address associated with the device name.
     """
 
-    # Dictionary containing the IP address for each device name
-    device_ip_dictionary = {
-        'tplink-tapo-camera': '192.168.1.153',
-        'sonos-smart-speaker': '192.168.1.173'
-    }
-
-    # Iterate over the dictionary and return the IP address if the device name is found
-    for device, ip in device_ip_dictionary.items():
-        if device in device_name.lower():
-            return ip
-
     # Return -1 if no matching IP address is found
-    return -1
+    return get_device_registry().get_ip_address(device_name)
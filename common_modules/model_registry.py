@@ -0,0 +1,192 @@
+# This file contains the registry of the trained models, so that each model file is loaded only once per process
+
+import os
+import sys
+import json
+import hashlib
+import threading
+import joblib
+from colorama import Fore, Style
+from common_modules.instrumentation import stage, count
+from common_modules.compact_models import RandomForestPredictor, XGBoostPredictor, forest_manifest_name
+
+# Folder and file name of the trained models of each classifier type
+model_locations = {
+    'rf': ('rf_models', 'trained_rf_classifier_{delta}.pkl'),
+    'xgb': ('xgb_models', 'trained_xgb_classifier_{delta}.pkl')
+}
+
+# Format of the models loaded by the registry: 'joblib' loads the pickled scikit-learn / XGBClassifier models,
+# 'compact' loads the compact exports saved next to them with the lightweight predictors of compact_models.py
+model_format = 'joblib'
+
+# Extension of the compact export of each classifier type (a directory of NumPy arrays for the Random Forest,
+# a native UBJSON booster for XGBoost)
+compact_model_extensions = {
+    'rf': '.forest',
+    'xgb': '.ubj'
+}
+
+# Predictor class of the compact export of each classifier type
+_compact_model_loaders = {
+    'rf': RandomForestPredictor,
+    'xgb': XGBoostPredictor
+}
+
+# Loaded models: (classifier type, delta, format) -> (file stamp, file digest, model)
+_model_cache = {}
+_model_cache_lock = threading.Lock()
+
+# Features of the models: delta -> (metadata file stamps, feature names)
+_feature_columns_cache = {}
+
+
+# This function returns the path of the model file of the given classifier type and delta
+def get_model_path(classifier_type, delta):
+    """
+    Returns the path of the model file of a classifier.
+
+    :param classifier_type: the type of classifier ('rf' or 'xgb').
+    :param delta: the delta value used to train the model.
+
+    :return: the path of the model file.
+    """
+    directory_name, file_name = model_locations[classifier_type]
+    return os.path.join(directory_name, file_name.format(delta=delta))
+
+
+# This function returns the path of the compact export saved next to the model file
+def get_compact_model_path(classifier_type, delta):
+    """
+    Returns the path of the compact export of a classifier.
+
+    :param classifier_type: the type of classifier ('rf' or 'xgb').
+    :param delta: the delta value used to train the model.
+
+    :return: the path of the compact export.
+    """
+    return os.path.splitext(get_model_path(classifier_type, delta))[0] + compact_model_extensions[classifier_type]
+
+
+# This function returns the path of the metadata file saved next to the model file
+def get_model_metadata_path(classifier_type, delta):
+    """
+    Returns the path of the metadata file (tuned hyperparameters, CV accuracy, dataset fingerprint) of a classifier.
+
+    :param classifier_type: the type of classifier ('rf' or 'xgb').
+    :param delta: the delta value used to train the model.
+
+    :return: the path of the metadata file.
+    """
+    return os.path.splitext(get_model_path(classifier_type, delta))[0] + '.json'
+
+
+# This function returns the SHA-256 digest of a file
+def _compute_file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# This function returns the trained model of the given classifier type and delta, loading it only when needed
+def load_model(classifier_type, delta, file_format=None):
+    """
+    Returns a trained model from the registry. The model file is loaded the first time the model is requested and
+    loaded again only if its content changed (e.g. after a retraining): the modification time and size of the file
+    are checked on every request, and the file digest only when they change.
+
+    :param classifier_type: the type of classifier ('rf' or 'xgb').
+    :param delta: the delta value used to train the model.
+    :param file_format: the format of the model, 'joblib' or 'compact' (default: model_format).
+
+    :return: the trained model (or its compact predictor, which has the same predict and predict_proba methods).
+    """
+    file_format = file_format or model_format
+
+    if file_format == 'compact':
+        model_path = get_compact_model_path(classifier_type, delta)
+        load = _compact_model_loaders[classifier_type]
+
+        # The manifest of a compact Random Forest changes whenever its arrays change
+        file_path = os.path.join(model_path, forest_manifest_name) if classifier_type == 'rf' else model_path
+    else:
+        model_path = file_path = get_model_path(classifier_type, delta)
+
+        # Memory-map the arrays stored in the file instead of reading them into memory
+        load = lambda path: joblib.load(path, mmap_mode='r')
+
+    file_stat = os.stat(file_path)
+    stamp = (file_stat.st_mtime_ns, file_stat.st_size)
+    key = (classifier_type, delta, file_format)
+
+    with _model_cache_lock:
+        cached = _model_cache.get(key)
+
+        if cached is not None and cached[0] == stamp:
+            return cached[2]
+
+        digest = _compute_file_digest(file_path)
+
+        if cached is not None and cached[1] == digest:
+            # The file was touched but its content did not change
+            _model_cache[key] = (stamp, digest, cached[2])
+            return cached[2]
+
+        with stage('load_model'):
+            model = load(model_path)
+        count('models_loaded')
+        _model_cache[key] = (stamp, digest, model)
+
+        return model
+
+
+# This function empties the registry, so that the models are loaded again on the next request
+def clear_model_cache():
+    with _model_cache_lock:
+        _model_cache.clear()
+        _feature_columns_cache.clear()
+
+
+# This function returns the names of the features the models of a delta value were trained on
+def get_model_feature_columns(delta):
+    """
+    Returns the reduced feature set saved in the metadata of the models by the feature selection, so that only the
+    statistics used by the models are computed. The metadata files are read again only if they changed.
+
+    :param delta: the delta value used to train the models.
+
+    :return: the list of feature names, in the column order of the models, or None if the models use all the features.
+    """
+    metadata_paths = [get_model_metadata_path(classifier_type, delta) for classifier_type in model_locations]
+    stamps = []
+    for metadata_path in metadata_paths:
+        try:
+            file_stat = os.stat(metadata_path)
+            stamps.append((file_stat.st_mtime_ns, file_stat.st_size))
+        except OSError:
+            stamps.append(None)
+
+    with _model_cache_lock:
+        cached = _feature_columns_cache.get(delta)
+
+        if cached is not None and cached[0] == stamps:
+            return cached[1]
+
+        model_columns = []
+        for metadata_path in metadata_paths:
+            try:
+                with open(metadata_path) as file:
+                    model_columns.append(json.load(file).get('feature_columns'))
+            except (OSError, ValueError):
+                model_columns.append(None)
+
+        # The features of a window are computed once for both models
+        if any(columns != model_columns[0] for columns in model_columns):
+            print(f'{Fore.RED}\nERROR: the models with delta = {delta} were trained on different features, train them again!{Style.RESET_ALL}')
+            sys.exit(1)
+
+        _feature_columns_cache[delta] = (stamps, model_columns[0])
+
+        return model_columns[0]
@@ -0,0 +1,184 @@
+# This file contains the compact columnar representation of the packets read from the .pcapng files
+
+import socket
+import struct
+from array import array
+import numpy as np
+
+
+# This function converts a dotted IPv4 address into its integer representation
+def ip_to_int(ip_address):
+    """
+    Converts a dotted IPv4 address into an unsigned 32-bit integer.
+
+    :param ip_address: the IPv4 address as a string (e.g. '192.168.1.153').
+    :return: the integer representation of the address.
+    """
+    return struct.unpack('!I', socket.inet_aton(ip_address))[0]
+
+
+# This function converts a list of dotted IPv4 addresses into a NumPy array of integers
+def ip_addresses_to_ints(ip_addresses):
+    """
+    Converts a list of dotted IPv4 addresses into a NumPy array of unsigned 32-bit integers.
+
+    :param ip_addresses: list of IPv4 addresses as strings.
+    :return: NumPy array with the integer representation of the addresses.
+    """
+    return np.array([ip_to_int(ip) for ip in ip_addresses], dtype=np.uint32)
+
+
+class PacketTable:
+    """
+    Columnar table holding only the packet fields used by the pipeline: timestamp, captured length and
+    IPv4 source / destination addresses (as integers, 0 for non-IPv4 packets). The tables built by the readers are
+    sorted by timestamp, the packets with the same timestamp being in capture order.
+    """
+
+    __slots__ = ('time', 'length', 'src', 'dst')
+
+    def __init__(self, time, length, src, dst):
+        self.time = np.asarray(time, dtype=np.float64)
+        self.length = np.asarray(length, dtype=np.uint32)
+        self.src = np.asarray(src, dtype=np.uint32)
+        self.dst = np.asarray(dst, dtype=np.uint32)
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, index):
+        # Slices and boolean masks return a new table with the selected rows (slices are views, not copies)
+        return PacketTable(self.time[index], self.length[index], self.src[index], self.dst[index])
+
+    def __eq__(self, other):
+        if not isinstance(other, PacketTable):
+            return NotImplemented
+        return all(np.array_equal(getattr(self, column), getattr(other, column)) for column in self.__slots__)
+
+    def __repr__(self):
+        return f'PacketTable({len(self)} packets)'
+
+    # This method returns the mask of the packets sent by one of the given devices
+    def outgoing_mask(self, device_ip_addresses):
+        return np.isin(self.src, ip_addresses_to_ints(device_ip_addresses))
+
+    # This method returns the mask of the packets received by one of the given devices
+    def incoming_mask(self, device_ip_addresses):
+        return np.isin(self.dst, ip_addresses_to_ints(device_ip_addresses))
+
+    # This method splits the table into one table per device, with the packets sent or received by the device
+    def split_by_device(self, device_ip_addresses):
+        """
+        :param device_ip_addresses: list of IP addresses of the devices.
+        :return: dictionary mapping each IP address to the table of its packets (a packet exchanged between two of
+                 the devices belongs to both tables).
+        """
+        tables = {}
+        for ip_address in device_ip_addresses:
+            ip_int = ip_to_int(ip_address)
+            tables[ip_address] = self[(self.src == ip_int) | (self.dst == ip_int)]
+        return tables
+
+    # This method returns the table sorted by timestamp (the table itself if it already is), keeping the capture order
+    # of the packets with the same timestamp
+    def sort_by_time(self):
+        if len(self) < 2 or not (self.time[1:] < self.time[:-1]).any():
+            return self
+        return self[np.argsort(self.time, kind='stable')]
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], [], [])
+
+    # This method returns a table with the rows of the given tables, in order
+    @classmethod
+    def concatenate(cls, tables):
+        tables = [table for table in tables if len(table)]
+
+        if len(tables) == 1:
+            return tables[0]
+        if not tables:
+            return cls.empty()
+
+        return cls(*(np.concatenate([getattr(table, column) for table in tables]) for column in cls.__slots__))
+
+
+class PacketTableBuilder:
+    """
+    Accumulates packet fields in compact typed buffers while the packets are read,
+    so that the dissected packets can be discarded immediately.
+    """
+
+    __slots__ = ('time', 'length', 'src', 'dst')
+
+    def __init__(self):
+        self.time = array('d')
+        self.length = array('I')
+        self.src = array('I')
+        self.dst = array('I')
+
+    def __len__(self):
+        return len(self.time)
+
+    # This method appends the fields of a single packet
+    def append(self, time, length, src, dst):
+        self.time.append(time)
+        self.length.append(length)
+        self.src.append(src)
+        self.dst.append(dst)
+
+    # This method appends the fields of a dissected scapy packet (used as 'prn' callback of scapy.sniff)
+    def add_scapy_packet(self, packet):
+        # Imported here so that the table can be used without loading scapy
+        from scapy.layers.inet import IP
+
+        if packet.haslayer(IP):
+            src = ip_to_int(packet[IP].src)
+            dst = ip_to_int(packet[IP].dst)
+        else:
+            src = dst = 0
+
+        self.append(float(packet.time), len(packet), src, dst)
+
+    # This method returns the packet table with the accumulated packets, sorted by timestamp
+    # (the packets of a capture, e.g. a pcapng with several interfaces, are not always written in time order).
+    # When they are in order, the table shares the buffers of the builder, so no packets can be appended afterwards.
+    def build(self):
+        return PacketTable(np.frombuffer(self.time, dtype=np.float64),
+                           np.frombuffer(self.length, dtype=np.uint32),
+                           np.frombuffer(self.src, dtype=np.uint32),
+                           np.frombuffer(self.dst, dtype=np.uint32)).sort_by_time()
+
+
+class DevicePacketTableBuilder:
+    """
+    Demultiplexes the packets of a capture into one packet table builder per device while the capture is read,
+    so that a single pass over the capture produces the packet stream of every device.
+    A packet exchanged between two of the devices is appended to both streams.
+    """
+
+    __slots__ = ('device_ip_addresses', 'builders')
+
+    def __init__(self, device_ip_addresses):
+        """
+        :param device_ip_addresses: list of IP addresses of the devices.
+        """
+        self.device_ip_addresses = list(device_ip_addresses)
+        self.builders = {ip_to_int(ip_address): PacketTableBuilder() for ip_address in self.device_ip_addresses}
+
+    def __len__(self):
+        return sum(len(builder) for builder in self.builders.values())
+
+    # This method appends the fields of a single packet to the builders of its devices
+    def append(self, time, length, src, dst):
+        builder = self.builders.get(src)
+        if builder is not None:
+            builder.append(time, length, src, dst)
+
+        builder = self.builders.get(dst)
+        if builder is not None and dst != src:
+            builder.append(time, length, src, dst)
+
+    # This method returns the dictionary mapping each device IP address to the table of its packets
+    def build(self):
+        return {ip_address: self.builders[ip_to_int(ip_address)].build() for ip_address in self.device_ip_addresses}
@@ -0,0 +1,385 @@
+# This file contains a fast reader for .pcapng and .pcap captures that bypasses the scapy dissection
+# Only the fields used by the pipeline (timestamp, captured length and IPv4 source / destination) are extracted
+# directly from the raw bytes of the capture.
+
+import os
+import mmap
+import struct
+from common_modules.packet_table import PacketTableBuilder, ip_to_int
+
+# Block types of the pcapng format
+SECTION_HEADER_BLOCK = 0x0A0D0D0A
+INTERFACE_DESCRIPTION_BLOCK = 0x00000001
+OBSOLETE_PACKET_BLOCK = 0x00000002
+ENHANCED_PACKET_BLOCK = 0x00000006
+
+# Magic numbers of the classic pcap format (microsecond and nanosecond resolution, in both byte orders)
+PCAP_MAGIC_NUMBERS = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1000000),
+    b'\xa1\xb2\xc3\xd4': ('>', 1000000),
+    b'\x4d\x3c\xb2\xa1': ('<', 1000000000),
+    b'\xa1\xb2\x3c\x4d': ('>', 1000000000)
+}
+
+# Link types whose IPv4 header can be located by the reader
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+
+# scapy reads at most MTU bytes of each packet, the same limit is applied to the captured length
+MAX_PACKET_LENGTH = 0xffff
+
+# Number of bytes of the capture parsed at a time by iter_capture_chunks
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+# This function returns the offset of the IPv4 header inside the packet data, or -1 if the packet is not IPv4
+def get_ipv4_offset(buffer, data_offset, captured_length, linktype):
+    """
+    Locates the IPv4 header of a packet based on the link type of its interface.
+
+    :param buffer: the buffer containing the raw capture.
+    :param data_offset: offset of the first byte of the packet data in the buffer.
+    :param captured_length: number of captured bytes of the packet.
+    :param linktype: the link type of the interface that captured the packet.
+
+    :return: the offset of the IPv4 header in the buffer, or -1 if the packet does not carry IPv4.
+    """
+
+    if linktype == LINKTYPE_ETHERNET:
+        header_length = 14
+        is_ipv4 = captured_length >= 34 and buffer[data_offset + 12] == 0x08 and buffer[data_offset + 13] == 0x00
+    elif linktype == LINKTYPE_RAW or linktype == LINKTYPE_IPV4:
+        header_length = 0
+        is_ipv4 = captured_length >= 20 and buffer[data_offset] >> 4 == 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        header_length = 16
+        is_ipv4 = captured_length >= 36 and buffer[data_offset + 14] == 0x08 and buffer[data_offset + 15] == 0x00
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        header_length = 20
+        is_ipv4 = captured_length >= 40 and buffer[data_offset] == 0x08 and buffer[data_offset + 1] == 0x00
+    elif linktype == LINKTYPE_NULL:
+        # the address family is stored in the byte order of the capturing host
+        header_length = 4
+        is_ipv4 = captured_length >= 24 and (buffer[data_offset] == 2 or buffer[data_offset + 3] == 2)
+    else:
+        return -1
+
+    return data_offset + header_length if is_ipv4 else -1
+
+
+class CaptureParser:
+    """
+    Incremental parser of classic pcap and pcapng captures. Packets are parsed from a buffer (a memory-mapped file
+    or the bytes received so far from a stream) and only the packets sent or received by the given devices are
+    appended to a packet table builder. Parsing stops at the first incomplete record, so it can be resumed when
+    more bytes are available.
+    """
+
+    def __init__(self, device_ip_addresses=None, stop_filter=None, builder=None):
+        """
+        :param device_ip_addresses: list of IP addresses used to filter the packets (None to keep every packet).
+        :param stop_filter: optional function of the packet timestamp; parsing stops after the first kept packet for which it returns True.
+        :param builder: the packet table builder receiving the packets (a new one is created if not provided).
+        """
+        self.device_ip_addresses = None if device_ip_addresses is None else {ip_to_int(ip) for ip in device_ip_addresses}
+        self.stop_filter = stop_filter
+        self.builder = builder if builder is not None else PacketTableBuilder()
+        self.capture_format = None
+        self.endian = '<'
+        self.pcap_resolution = 1000000
+        self.pcap_linktype = None
+        # list of (linktype, timestamp resolution) of the interfaces of the current pcapng section
+        self.interfaces = []
+        self.stopped = False
+
+    # This method parses all the complete records in buffer[offset:end] and returns the offset of the first unparsed byte
+    def parse(self, buffer, offset=0, end=None):
+        end = len(buffer) if end is None else end
+
+        if self.capture_format is None:
+            offset = self._read_file_header(buffer, offset, end)
+            if self.capture_format is None:
+                return offset
+
+        if self.capture_format == 'pcapng':
+            return self._parse_pcapng(buffer, offset, end)
+        return self._parse_pcap(buffer, offset, end)
+
+    # This method detects the capture format and returns the offset of the first record (unchanged if the header is incomplete)
+    def _read_file_header(self, buffer, offset, end):
+        if end - offset < 4:
+            return offset
+        magic = bytes(buffer[offset:offset + 4])
+        if magic == struct.pack('<I', SECTION_HEADER_BLOCK):
+            self.capture_format = 'pcapng'
+        elif magic in PCAP_MAGIC_NUMBERS:
+            if end - offset < 24:
+                return offset
+            self.endian, self.pcap_resolution = PCAP_MAGIC_NUMBERS[magic]
+            self.pcap_linktype = struct.unpack_from(self.endian + 'I', buffer, offset + 20)[0] & 0x0fffffff
+            self.capture_format = 'pcap'
+            offset += 24
+        else:
+            raise ValueError('the capture is neither a pcapng nor a pcap file')
+        return offset
+
+    # This method returns the state needed to resume the parsing at a record boundary (format, byte order and interfaces)
+    def get_state(self):
+        return self.capture_format, self.endian, self.pcap_resolution, self.pcap_linktype, list(self.interfaces)
+
+    # This method restores a state returned by get_state
+    def set_state(self, state):
+        self.capture_format, self.endian, self.pcap_resolution, self.pcap_linktype, interfaces = state
+        self.interfaces = list(interfaces)
+
+    # This method walks the record headers of buffer[offset:end], without reading the packets, and yields the offset
+    # and timestamp of each packet record (get_state returns the state needed to resume the parsing at that record)
+    def iter_packet_records(self, buffer, offset=0, end=None):
+        end = len(buffer) if end is None else end
+
+        if self.capture_format is None:
+            offset = self._read_file_header(buffer, offset, end)
+            if self.capture_format is None:
+                return
+
+        if self.capture_format == 'pcap':
+            record_header = struct.Struct(self.endian + 'IIII')
+            while end - offset >= 16:
+                seconds, fraction, captured_length, _ = record_header.unpack_from(buffer, offset)
+                if end - offset - 16 < captured_length:
+                    return
+                yield offset, (seconds * self.pcap_resolution + fraction) / self.pcap_resolution
+                offset += 16 + captured_length
+            return
+
+        while end - offset >= 12:
+            block_type, block_length = self._read_block_header(buffer, offset)
+            if end - offset < block_length:
+                return
+
+            if block_type in (ENHANCED_PACKET_BLOCK, OBSOLETE_PACKET_BLOCK):
+                # Both packet blocks store the interface at offset 8 (32 or 16 bits) and the timestamp at offset 12
+                interface_id = struct.unpack_from(self.endian + ('I' if block_type == ENHANCED_PACKET_BLOCK else 'H'), buffer, offset + 8)[0]
+                timestamp_high, timestamp_low = struct.unpack_from(self.endian + 'II', buffer, offset + 12)
+                yield offset, ((timestamp_high << 32) + timestamp_low) / self.interfaces[interface_id][1]
+            elif block_type == INTERFACE_DESCRIPTION_BLOCK:
+                self.interfaces.append(self._read_interface(buffer, offset, block_length))
+            elif block_type == SECTION_HEADER_BLOCK:
+                self.interfaces = []
+
+            offset += block_length
+
+    # This method splits the capture into shards of about shard_size bytes, each starting at a packet record
+    def scan_shards(self, buffer, shard_size, offset=0, end=None):
+        """
+        :return: list of shards, each a dictionary with the 'offset' of its first packet record, the 'start_time' of
+                 that packet, the parser 'state' at that offset and 'in_order', False if a packet of the shard is
+                 older than a packet before it.
+        """
+        shards = []
+        next_shard_offset = 0
+        latest_timestamp = float('-inf')
+
+        for record_offset, timestamp in self.iter_packet_records(buffer, offset, end):
+            if record_offset >= next_shard_offset:
+                shards.append({'offset': record_offset, 'start_time': timestamp, 'state': self.get_state(), 'in_order': True})
+                next_shard_offset = record_offset + shard_size
+
+            if timestamp < latest_timestamp:
+                shards[-1]['in_order'] = False
+            else:
+                latest_timestamp = timestamp
+
+        return shards
+
+    # This method appends a packet to the builder if it passes the device filter
+    def _add_packet(self, buffer, data_offset, captured_length, linktype, timestamp):
+        ip_offset = get_ipv4_offset(buffer, data_offset, captured_length, linktype)
+
+        if ip_offset >= 0:
+            src, dst = struct.unpack_from('!II', buffer, ip_offset + 12)
+        elif self.device_ip_addresses is not None:
+            return
+        else:
+            src = dst = 0
+
+        # Keep only packets sent or received by one of the devices (equivalent to the 'ip host' BPF filter)
+        if self.device_ip_addresses is not None and src not in self.device_ip_addresses and dst not in self.device_ip_addresses:
+            return
+
+        self.builder.append(timestamp, min(captured_length, MAX_PACKET_LENGTH), src, dst)
+
+        if self.stop_filter is not None and self.stop_filter(timestamp):
+            self.stopped = True
+
+    # This method parses the records of a classic pcap capture
+    def _parse_pcap(self, buffer, offset, end):
+        record_header = struct.Struct(self.endian + 'IIII')
+        resolution = self.pcap_resolution
+        linktype = self.pcap_linktype
+
+        while not self.stopped and end - offset >= 16:
+            seconds, fraction, captured_length, _ = record_header.unpack_from(buffer, offset)
+            if end - offset - 16 < captured_length:
+                break
+
+            timestamp = (seconds * resolution + fraction) / resolution
+            self._add_packet(buffer, offset + 16, captured_length, linktype, timestamp)
+            offset += 16 + captured_length
+
+        return offset
+
+    # This method parses the blocks of a pcapng capture
+    def _parse_pcapng(self, buffer, offset, end):
+        while not self.stopped and end - offset >= 12:
+            block_type, block_length = self._read_block_header(buffer, offset)
+            if end - offset < block_length:
+                break
+
+            if block_type == ENHANCED_PACKET_BLOCK:
+                interface_id, timestamp_high, timestamp_low, captured_length = struct.unpack_from(self.endian + 'IIII', buffer, offset + 8)
+                linktype, resolution = self.interfaces[interface_id]
+                timestamp = ((timestamp_high << 32) + timestamp_low) / resolution
+                self._add_packet(buffer, offset + 28, captured_length, linktype, timestamp)
+            elif block_type == OBSOLETE_PACKET_BLOCK:
+                interface_id, _, timestamp_high, timestamp_low, captured_length = struct.unpack_from(self.endian + 'HHIII', buffer, offset + 8)
+                linktype, resolution = self.interfaces[interface_id]
+                timestamp = ((timestamp_high << 32) + timestamp_low) / resolution
+                self._add_packet(buffer, offset + 28, captured_length, linktype, timestamp)
+            elif block_type == INTERFACE_DESCRIPTION_BLOCK:
+                self.interfaces.append(self._read_interface(buffer, offset, block_length))
+            elif block_type == SECTION_HEADER_BLOCK:
+                self.interfaces = []
+
+            offset += block_length
+
+        return offset
+
+    # This method returns the type and length of the pcapng block at offset
+    def _read_block_header(self, buffer, offset):
+        block_type = struct.unpack_from(self.endian + 'I', buffer, offset)[0]
+
+        # The byte order of each section is given by the byte-order magic of its Section Header Block
+        if block_type == SECTION_HEADER_BLOCK:
+            byte_order_magic = bytes(buffer[offset + 8:offset + 12])
+            if byte_order_magic == b'\x4d\x3c\x2b\x1a':
+                self.endian = '<'
+            elif byte_order_magic == b'\x1a\x2b\x3c\x4d':
+                self.endian = '>'
+            else:
+                raise ValueError('invalid byte-order magic in pcapng section header')
+
+        block_length = struct.unpack_from(self.endian + 'I', buffer, offset + 4)[0]
+        if block_length < 12:
+            raise ValueError(f'invalid pcapng block length {block_length}')
+
+        return block_type, block_length
+
+    # This method returns the link type and timestamp resolution of an Interface Description Block
+    def _read_interface(self, buffer, offset, block_length):
+        linktype = struct.unpack_from(self.endian + 'H', buffer, offset + 8)[0]
+        resolution = 1000000
+
+        # Look for the if_tsresol option (code 9)
+        option_offset = offset + 16
+        options_end = offset + block_length - 4
+        while options_end - option_offset >= 4:
+            code, length = struct.unpack_from(self.endian + 'HH', buffer, option_offset)
+            if code == 0:
+                break
+            if code == 9 and length == 1:
+                value = buffer[option_offset + 4]
+                resolution = (2 if value & 0x80 else 10) ** (value & 0x7f)
+            option_offset += 4 + length + (-length) % 4
+
+        return linktype, resolution
+
+
+# This function reads a .pcapng or .pcap file and returns the table of packets of the given devices
+def read_capture(file_path, device_ip_addresses=None, stop_filter=None, builder=None, shard=None):
+    """
+    Reads a capture file through a read-only memory map, parsing the records in place without copying them.
+
+    :param file_path: path of the .pcapng or .pcap file.
+    :param device_ip_addresses: list of IP addresses used to filter the packets (None to keep every packet).
+    :param stop_filter: optional function of the packet timestamp; reading stops after the first kept packet for which it returns True.
+    :param builder: the builder receiving the packets (default: a PacketTableBuilder).
+    :param shard: optional shard returned by scan_capture_shards; reading starts at its first packet record.
+
+    :return: the table of the packets sent or received by the devices (what the build method of the builder returns).
+    """
+    parser = CaptureParser(device_ip_addresses, stop_filter, builder)
+    offset = 0
+
+    if shard is not None:
+        parser.set_state(shard['state'])
+        offset = shard['offset']
+
+    with open(file_path, 'rb') as file:
+        # Empty files cannot be memory-mapped
+        if os.fstat(file.fileno()).st_size == 0:
+            return parser.builder.build()
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            with memoryview(mapped_file) as buffer:
+                parser.parse(buffer, offset)
+
+    return parser.builder.build()
+
+
+# This function splits a .pcapng or .pcap file into shards that can be read independently
+def scan_capture_shards(file_path, shard_size):
+    """
+    Walks the record headers of the capture, without reading the packets, and splits it into shards of about
+    shard_size bytes. Each shard starts at a packet record and can be read with read_capture(..., shard=shard).
+
+    :param file_path: path of the .pcapng or .pcap file.
+    :param shard_size: approximate number of bytes of each shard.
+
+    :return: list of shards, each a dictionary with the 'offset' of its first packet record, the 'start_time' of that
+             packet, the parser 'state' at that offset and 'in_order', False if a packet of the shard is older than a
+             packet before it (empty if the capture has no packets).
+    """
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return []
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            with memoryview(mapped_file) as buffer:
+                return CaptureParser().scan_shards(buffer, shard_size)
+
+
+# This function reads a .pcapng or .pcap file in chunks and yields the table of the packets of each chunk
+def iter_capture_chunks(file_path, device_ip_addresses=None, chunk_size=CHUNK_SIZE, builder_factory=PacketTableBuilder):
+    """
+    Reads the capture chunk_size bytes at a time, so that the memory used does not depend on the size of the capture.
+    The records cut by the end of a chunk are parsed with the next one.
+
+    :param file_path: path of the .pcapng or .pcap file.
+    :param device_ip_addresses: list of IP addresses used to filter the packets (None to keep every packet).
+    :param chunk_size: number of bytes read at a time.
+    :param builder_factory: function returning the builder receiving the packets of a chunk (default: PacketTableBuilder).
+
+    :return: generator of the tables of the packets of each chunk (what the build method of the builders returns).
+    """
+    parser = CaptureParser(device_ip_addresses)
+    pending_bytes = bytearray()
+
+    with open(file_path, 'rb') as file:
+        while True:
+            data = file.read(chunk_size)
+            if not data:
+                return
+
+            pending_bytes += data
+            del data
+
+            parser.builder = builder_factory()
+            parsed_bytes = parser.parse(pending_bytes)
+            del pending_bytes[:parsed_bytes]
+
+            yield parser.builder.build()
@@ -0,0 +1,215 @@
+# This file contains the incremental computation of the statistical features for sliding windows
+# Consecutive overlapping windows share most of their packets: instead of recomputing the statistics of every window
+# from scratch, the packets entering the window are added and the packets leaving it are removed.
+
+from bisect import bisect_left, bisect_right, insort
+from operator import mul
+import numpy as np
+from common_modules.feature_extraction import feature_columns, feature_names
+
+# Values below this threshold are treated as floating point noise, as pandas does for skew and kurtosis
+_FLOATING_POINT_TOLERANCE = 1e-14
+
+
+class RollingFlowStatistics:
+    """
+    Statistics of the packet lengths of a flow, updated packet by packet. Exact integer power sums give the moments
+    (mean, variance, standard deviation, skew and kurtosis) and a sorted list of the lengths gives the order statistics
+    (maximum, percentiles and median absolute deviation). The results follow the semantics of compute_segment_statistics.
+    """
+
+    __slots__ = ('count', 'power_sums', 'sorted_lengths')
+
+    def __init__(self):
+        self.count = 0
+        # sums of the first four powers of the lengths, kept as exact Python integers
+        self.power_sums = [0, 0, 0, 0]
+        self.sorted_lengths = []
+
+    # This method adds a list of packet lengths to the flow
+    def add(self, lengths):
+        self._update_power_sums(lengths, 1)
+
+        # Large batches are merged with a single (nearly linear) sort of the already sorted list
+        if len(lengths) > 64:
+            self.sorted_lengths.extend(lengths)
+            self.sorted_lengths.sort()
+        else:
+            for length in lengths:
+                insort(self.sorted_lengths, length)
+
+    # This method removes a list of packet lengths from the flow
+    def remove(self, lengths):
+        self._update_power_sums(lengths, -1)
+
+        sorted_lengths = self.sorted_lengths
+        for length in lengths:
+            del sorted_lengths[bisect_left(sorted_lengths, length)]
+
+    # This method adds (sign = 1) or subtracts (sign = -1) the powers of the lengths to the power sums
+    def _update_power_sums(self, lengths, sign):
+        squares = list(map(mul, lengths, lengths))
+        self.count += sign * len(lengths)
+        self.power_sums[0] += sign * sum(lengths)
+        self.power_sums[1] += sign * sum(squares)
+        self.power_sums[2] += sign * sum(map(mul, squares, lengths))
+        self.power_sums[3] += sign * sum(map(mul, squares, squares))
+
+    # This method returns the given percentile of the lengths, interpolated as in np.percentile
+    def percentile(self, percentile):
+        virtual_index = (self.count - 1) * (percentile / 100)
+        previous_index = int(virtual_index)
+        gamma = virtual_index - previous_index
+        previous_value = self.sorted_lengths[previous_index]
+        next_value = self.sorted_lengths[min(previous_index + 1, self.count - 1)]
+
+        difference = next_value - previous_value
+        if gamma >= 0.5:
+            return next_value - difference * (1 - gamma)
+        return previous_value + difference * gamma
+
+    # This method returns the k-th smallest doubled absolute deviation from the doubled median
+    def _doubled_deviation(self, k, doubled_median):
+        lengths = self.sorted_lengths
+
+        # Binary search of the smallest deviation d such that more than k lengths lie in [median - d/2, median + d/2]
+        low, high = 0, max(lengths[-1] * 2 - doubled_median, doubled_median - lengths[0] * 2, 0)
+        while low < high:
+            middle = (low + high) // 2
+            within = bisect_right(lengths, (doubled_median + middle) // 2) - bisect_left(lengths, -((middle - doubled_median) // 2))
+            if within > k:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    # This method returns the median absolute deviation of the lengths
+    def median_absolute_deviation(self):
+        lengths = self.sorted_lengths
+        n = self.count
+        doubled_median = lengths[(n - 1) // 2] + lengths[n // 2]
+        return (self._doubled_deviation((n - 1) // 2, doubled_median) + self._doubled_deviation(n // 2, doubled_median)) / 4
+
+    # This method returns the requested statistics of the current lengths
+    def statistics(self, statistics):
+        """
+        Computes the requested statistics of the lengths currently in the flow (the flow must not be empty).
+
+        :param statistics: set of statistics to compute ('max', 'mean', 'var', 'std', 'skew', 'kurtosis', 'mad', 'count' or a percentile).
+        :return: dictionary mapping each statistic to its value.
+        """
+        n = self.count
+        s1, s2, s3, s4 = self.power_sums
+        results = {}
+
+        for statistic in statistics:
+            if not isinstance(statistic, str):
+                results[statistic] = self.percentile(statistic)
+
+        if 'count' in statistics:
+            results['count'] = float(n)
+        if 'max' in statistics:
+            results['max'] = float(self.sorted_lengths[-1])
+        if 'mad' in statistics:
+            results['mad'] = self.median_absolute_deviation()
+        if 'mean' in statistics:
+            results['mean'] = s1 / n
+
+        # Central moments from the exact power sums: m_k = sum((x - mean) ** k) = numerator_k / n ** (k - 1)
+        numerator_2 = n * s2 - s1 * s1
+        m2 = numerator_2 / n
+
+        if 'var' in statistics or 'std' in statistics:
+            variance = numerator_2 / (n * (n - 1)) if n > 1 else float('nan')
+            results['var'] = variance
+            results['std'] = variance ** 0.5
+
+        if 'skew' in statistics:
+            if n < 3:
+                results['skew'] = float('nan')
+            else:
+                m3 = (n * n * s3 - 3 * n * s1 * s2 + 2 * s1 ** 3) / (n * n)
+                m2_skew = 0.0 if abs(m2) < _FLOATING_POINT_TOLERANCE else m2
+                m3 = 0.0 if abs(m3) < _FLOATING_POINT_TOLERANCE else m3
+                results['skew'] = 0.0 if m2_skew == 0 else (n * (n - 1) ** 0.5 / (n - 2)) * (m3 / m2_skew ** 1.5)
+
+        if 'kurtosis' in statistics:
+            if n < 4:
+                results['kurtosis'] = float('nan')
+            else:
+                m4 = (n ** 3 * s4 - 4 * n * n * s1 * s3 + 6 * n * s1 * s1 * s2 - 3 * s1 ** 4) / n ** 3
+                adjustment = 3 * (n - 1) ** 2 / ((n - 2) * (n - 3))
+                numerator = n * (n + 1) * (n - 1) * m4
+                denominator = (n - 2) * (n - 3) * m2 ** 2
+                numerator = 0.0 if abs(numerator) < _FLOATING_POINT_TOLERANCE else numerator
+                denominator = 0.0 if abs(denominator) < _FLOATING_POINT_TOLERANCE else denominator
+                results['kurtosis'] = 0.0 if denominator == 0 else numerator / denominator - adjustment
+
+        return results
+
+
+class RollingWindowFeatures:
+    """
+    Incremental feature engine for the sliding windows of a packet table. Windows must be visited in order of
+    increasing start and end: moving to the next window only adds the entering packets and removes the leaving ones.
+    """
+
+    def __init__(self, packets, device_ip_addresses, columns=None):
+        """
+        :param packets: table of packets, sorted by timestamp.
+        :param device_ip_addresses: list of IP addresses of the devices, used to split the incoming and outgoing flow.
+        :param columns: optional list of feature names to compute (default: all the features, in model order).
+        """
+        self.columns = feature_columns if columns is None else [feature_columns[feature_names.index(name)] for name in columns]
+        self.required_statistics = {
+            flow: {statistic for _, column_flow, statistic in self.columns if column_flow == flow}
+            for flow in ('complete', 'incoming', 'outgoing')
+        }
+
+        # For each flow, the positions of its packets in the table and their lengths (Python lists are faster than
+        # NumPy arrays for element-wise access)
+        flow_masks = {
+            'complete': np.ones(len(packets), dtype=bool),
+            'incoming': packets.incoming_mask(device_ip_addresses),
+            'outgoing': packets.outgoing_mask(device_ip_addresses)
+        }
+        self.positions = {flow: np.flatnonzero(mask).tolist() for flow, mask in flow_masks.items()}
+        self.lengths = {flow: packets.length[mask].tolist() for flow, mask in flow_masks.items()}
+
+        self.flows = {flow: RollingFlowStatistics() for flow in flow_masks}
+        self.first_index = 0
+        self.last_index = 0
+
+    # This method slides the engine to the window made of the packets in [first_index, last_index)
+    def move_to(self, first_index, last_index):
+        # Packets in [first_index, last_index) of the table leave the window, packets in [add_start, last_index) enter it
+        remove_end = min(first_index, self.last_index)
+        add_start = max(self.last_index, first_index)
+
+        for flow, statistics in self.flows.items():
+            positions = self.positions[flow]
+            lengths = self.lengths[flow]
+
+            # Translate the table ranges into ranges of the flow packets
+            remove_from = bisect_left(positions, self.first_index)
+            remove_to = bisect_left(positions, remove_end, remove_from)
+            add_from = bisect_left(positions, add_start)
+            add_to = bisect_left(positions, last_index, add_from)
+
+            if remove_to > remove_from:
+                statistics.remove(lengths[remove_from:remove_to])
+            if add_to > add_from:
+                statistics.add(lengths[add_from:add_to])
+
+        self.first_index = first_index
+        self.last_index = last_index
+
+    # This method returns the features of the current window, or None if one of the flows is empty
+    def features(self):
+        if not self.flows['incoming'].count or not self.flows['outgoing'].count:
+            return None
+
+        flow_statistics = {flow: self.flows[flow].statistics(statistics)
+                           for flow, statistics in self.required_statistics.items() if statistics}
+
+        return np.array([[flow_statistics[flow][statistic] for _, flow, statistic in self.columns]], dtype=np.float64)
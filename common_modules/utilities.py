@@ -8,6 +8,16 @@ import pandas as pd
 from scapy.all import sniff
 from datetime import datetime, timezone, timedelta
 from colorama import Fore, Style
+from common_modules.capture_index import find_capture_shard
+from common_modules.feature_extraction import compute_window_features
+from common_modules.instrumentation import stage, count
+from common_modules.packet_table import PacketTableBuilder, DevicePacketTableBuilder
+from common_modules.pcap_reader import read_capture, iter_capture_chunks
+
+# Define the backend used to read the .pcapng files:
+# 'raw' parses the capture blocks directly and filters the device packets by itself (fast),
+# 'scapy' dissects every packet with scapy.sniff and a BPF filter (slow, requires tcpdump to apply the filter)
+packet_reader_backend = 'raw'
 
 
 # This function reads a .timestamps file and returns a list of timestamps
@@ -63,6 +73,25 @@ def convert_timestamp(timestamp):
         sys.exit(1)
 
 
+# This function converts a list of timestamps at once, with the same result as convert_timestamp on each of them
+def convert_timestamps(timestamps):
+    """
+    Parses all the timestamps with a single vectorized call instead of one strptime and pytz localization each.
+
+    :param timestamps: list of timestamps in the YYYY-MM-DD HH:MM:SS.ssssss MDT format.
+    :return: NumPy array of UNIX timestamps (NaN for the timestamps whose format is not recognized).
+    """
+    mdt_datetimes = pd.to_datetime(pd.Series(timestamps, dtype=object), format="%Y-%m-%d %H:%M:%S.%f MDT", errors='coerce')
+
+    # Ambiguous and nonexistent local times are resolved as pytz localize does by default (standard time, shifted forward)
+    mdt_datetimes = mdt_datetimes.dt.tz_localize('America/Denver', ambiguous=np.zeros(len(mdt_datetimes), dtype=bool),
+                                                  nonexistent=pd.Timedelta(hours=1))
+
+    # Whole microseconds since the epoch divided by 10^6, exactly as datetime.timestamp computes them
+    microseconds = (mdt_datetimes - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(microseconds=1)
+    return microseconds.to_numpy(dtype=np.float64, na_value=np.nan) / 1e6
+
+
 # This function converts a UNIX timestamp to a formatted string in MDT
 def convert_timestamp_to_mdt(timestamp):
     """
@@ -87,84 +116,120 @@ def list_pcapng_files(folder_path):
     return [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith('.pcapng')]
 
 
-# This function reads a .pcapng file from the evaluation set and returns a list of packets
-def read_evaluation_pcapng_files(file_path, device_ip_addresses):
+# This function reads a .pcapng file from the evaluation set and returns a table of packets
+def read_evaluation_pcapng_files(file_path, device_ip_addresses, backend=None):
+
+    if (backend or packet_reader_backend) == 'raw':
+        return _read_raw_capture(file_path, device_ip_addresses)
 
     # filter packets by host ip addresses
     bpf_filter = ' or '.join([f'ip host {ip}' for ip in device_ip_addresses])
 
-    return sniff(filter=bpf_filter, store=True, offline=file_path)
+    # keep only the needed packet fields, so that the dissected packets are discarded right away
+    builder = PacketTableBuilder()
+    with stage('read_capture_scapy'):
+        sniff(filter=bpf_filter, store=False, offline=file_path, prn=builder.add_scapy_packet)
+
+    return builder.build()
 
 
-# This function reads a .pcapng file from the training / test set and returns a list of packets
-def read_training_pcapng_files(file_path, device_ip_address, formatted_timestamp, delta):
-    # filter packets by host ip address
-    bpf_filter = f'ip host {device_ip_address}'
+# This function reads a .pcapng file from the evaluation set and returns a table of packets for each device
+def read_evaluation_pcapng_files_by_device(file_path, device_ip_addresses, backend=None):
+    """
+    Reads the capture once and demultiplexes its packets into one table per device.
+
+    :param file_path: path of the .pcapng file.
+    :param device_ip_addresses: list of IP addresses of the devices.
+    :param backend: 'raw' or 'scapy' (default: packet_reader_backend).
+
+    :return: dictionary mapping each IP address to the table of the packets sent or received by the device.
+    """
+
+    if (backend or packet_reader_backend) == 'raw':
+        return _read_raw_capture(file_path, device_ip_addresses, builder=DevicePacketTableBuilder(device_ip_addresses))
 
-    return sniff(filter=bpf_filter, store=True, offline=file_path, stop_filter=lambda packet: stop_filter(packet, formatted_timestamp, delta))
+    return read_evaluation_pcapng_files(file_path, device_ip_addresses, backend).split_by_device(device_ip_addresses)
+
+
+# This function reads a .pcapng file from the evaluation set in chunks and yields the tables of packets of each chunk
+def iter_evaluation_pcapng_chunks(file_path, device_ip_addresses, chunk_size, by_device=False, backend=None):
+    """
+    Reads the capture chunk_size bytes at a time, so that captures larger than the memory can be evaluated.
+
+    :param file_path: path of the .pcapng file.
+    :param device_ip_addresses: list of IP addresses of the devices.
+    :param chunk_size: number of bytes read at a time (None, or the scapy backend, reads the whole capture at once).
+    :param by_device: if True, each chunk is a dictionary mapping each IP address to the table of the packets of the device.
+    :param backend: 'raw' or 'scapy' (default: packet_reader_backend).
+
+    :return: generator of the tables of packets (or of the dictionaries of tables) of each chunk.
+    """
+
+    if (backend or packet_reader_backend) != 'raw' or chunk_size is None:
+        reader = read_evaluation_pcapng_files_by_device if by_device else read_evaluation_pcapng_files
+        yield reader(file_path, device_ip_addresses, backend)
+        return
+
+    builder_factory = (lambda: DevicePacketTableBuilder(device_ip_addresses)) if by_device else PacketTableBuilder
+
+    try:
+        yield from iter_capture_chunks(file_path, device_ip_addresses, chunk_size, builder_factory)
+    except (ValueError, IndexError) as error:
+        print(f'{Fore.RED}\nERROR: unable to parse capture file {file_path}: {error}{Style.RESET_ALL}')
+        sys.exit(1)
+
+
+# This function reads a .pcapng file from the training / test set and returns the table of the packets in [t, t + delta]
+def read_training_pcapng_files(file_path, device_ip_address, formatted_timestamp, delta, backend=None):
+
+    if (backend or packet_reader_backend) == 'raw':
+        # The time index of the capture, if any, is used to seek to the activity, instead of parsing the capture from its
+        # beginning (see find_capture_shard for when it is built)
+        packets = _read_raw_capture(file_path, [device_ip_address], start_time=formatted_timestamp,
+                                    stop_filter=lambda packet_time: packet_time - formatted_timestamp > delta)
+    else:
+        # filter packets by host ip address
+        bpf_filter = f'ip host {device_ip_address}'
+
+        # keep only the needed packet fields, so that the dissected packets are discarded right away
+        builder = PacketTableBuilder()
+        with stage('read_capture_scapy'):
+            sniff(filter=bpf_filter, store=False, offline=file_path, prn=builder.add_scapy_packet,
+                  stop_filter=lambda packet: stop_filter(packet, formatted_timestamp, delta))
+        packets = builder.build()
+
+    count('training_packets', len(packets))
+    return packets[(packets.time >= formatted_timestamp) & (packets.time - formatted_timestamp <= delta)]
+
+
+# This function reads a capture with the raw pcapng / pcap reader, keeping only the packets of the given devices
+def _read_raw_capture(file_path, device_ip_addresses, stop_filter=None, builder=None, start_time=None):
+    try:
+        # With a start time, reading starts at the bucket of the time index containing it, when the capture has one
+        with stage('read_capture'):
+            shard = None if start_time is None else find_capture_shard(file_path, start_time, lazy=True)
+            return read_capture(file_path, device_ip_addresses, stop_filter, builder, shard)
+    except (ValueError, IndexError) as error:
+        print(f'{Fore.RED}\nERROR: unable to parse capture file {file_path}: {error}{Style.RESET_ALL}')
+        sys.exit(1)
 
 # This function filters packets based on the timestamp and delta
 def stop_filter(packet, formatted_timestamp, delta):
     return packet.time - formatted_timestamp > delta
 
 
-# This function computes the Median Absolute Deviation of the input data
-def _compute_mad(data):
-    # Compute the median of the data
-    median_value = np.median(data, axis=0)
-
-    # Return the median absolute deviation of the data
-    return np.median(np.abs(data - median_value))
-
-
-# This function takes the list of packets and returns some statistical features on it
-def compute_statistical_features(packets, incoming_packets, outgoing_packets):
-    # Create a list for the complete packet lengths
-    packet_lengths = [len(packet) for packet in packets]
-    incoming_packet_lengths = [len(packet) for packet in incoming_packets]
-    outgoing_packet_lengths = [len(packet) for packet in outgoing_packets]
-
-    # Create a Pandas data frame with statistical features for complete, incoming and outgoing flow
-    df = pd.DataFrame({
-        'Complete Maximum': [np.max(packet_lengths)],
-        'Outgoing Maximum': [np.max(outgoing_packet_lengths)],
-        'Complete Skew': [pd.Series(packet_lengths).skew()],
-        'Outgoing Variance': [pd.Series(outgoing_packet_lengths).var()],
-        'Outgoing Standard Deviation': [pd.Series(outgoing_packet_lengths).std()],
-        'Outgoing Kurtosis': [pd.Series(outgoing_packet_lengths).kurtosis()],
-        'Outgoing Skew': [pd.Series(outgoing_packet_lengths).skew()],
-        'Outgoing Median Absolute Deviation': [_compute_mad(np.array(outgoing_packet_lengths))],
-        'Outgoing 90th Percentile': [np.percentile(outgoing_packet_lengths, 90)],
-        'Complete Mean': [np.mean(packet_lengths)],
-        'Complete Kurtosis': [pd.Series(packet_lengths).kurtosis()],
-        'Outgoing Mean': [np.mean(outgoing_packet_lengths)],
-        'Variance': [pd.Series(packet_lengths).var()],
-        'Standard Deviation': [pd.Series(packet_lengths).std()],
-        'Complete 90th Percentile': [np.percentile(packet_lengths, 90)],
-        'Outgoing 80th Percentile': [np.percentile(outgoing_packet_lengths, 80)],
-        'Complete Median Absolute Deviation': [_compute_mad(np.array(packet_lengths))],
-        'Incoming Variance': [pd.Series(incoming_packet_lengths).var()],
-        'Incoming Skew': [pd.Series(incoming_packet_lengths).skew()],
-        'Incoming Standard Deviation': [pd.Series(incoming_packet_lengths).std()],
-        'Incoming Kurtosis': [pd.Series(incoming_packet_lengths).kurtosis()],
-        'Incoming Median Absolute Deviation': [_compute_mad(np.array(incoming_packet_lengths))],
-        'Complete Number of packets': [len(packet_lengths)],
-        'Outgoing 70th Percentile': [np.percentile(outgoing_packet_lengths, 70)],
-        'Outgoing Number of packets': [len(outgoing_packet_lengths)],
-        'Incoming Number of packets': [len(incoming_packet_lengths)],
-        'Incoming Mean': [np.mean(incoming_packet_lengths)],
-        'Incoming 30th Percentile': [np.percentile(incoming_packet_lengths, 30)],
-        'Incoming 40th Percentile': [np.percentile(incoming_packet_lengths, 40)],
-        'Incoming 60th Percentile': [np.percentile(incoming_packet_lengths, 60)],
-        'Complete 10th Percentile': [np.percentile(packet_lengths, 10)],
-        'Complete 20th Percentile': [np.percentile(packet_lengths, 20)],
-        'Incoming 50th Percentile': [np.percentile(incoming_packet_lengths, 50)],
-        'Incoming 20th Percentile': [np.percentile(incoming_packet_lengths, 20)],
-        'Complete 80th Percentile': [np.percentile(packet_lengths, 80)],
-        'Complete 30th Percentile': [np.percentile(packet_lengths, 30)],
-        'Incoming 10th Percentile': [np.percentile(incoming_packet_lengths, 10)],
-        'Outgoing 60th Percentile': [np.percentile(outgoing_packet_lengths, 60)],
-        'Incoming 80th Percentile': [np.percentile(incoming_packet_lengths, 80)]
-    })
-
-    return df.to_numpy()
+# This function takes the packet lengths of a flow and returns some statistical features on it
+def compute_statistical_features(packet_lengths, incoming_packet_lengths, outgoing_packet_lengths, columns=None):
+    """
+    Computes the statistical features of a single window for the complete, incoming and outgoing flow.
+
+    :param packet_lengths: packet lengths of the complete flow.
+    :param incoming_packet_lengths: packet lengths of the incoming flow.
+    :param outgoing_packet_lengths: packet lengths of the outgoing flow.
+    :param columns: optional list of feature names to compute (default: all the features, in model order).
+
+    :return: NumPy array of shape (1, n_columns) with the features in the column order expected by the models.
+    """
+    return compute_window_features(packet_lengths, [0, len(packet_lengths)],
+                                   incoming_packet_lengths, [0, len(incoming_packet_lengths)],
+                                   outgoing_packet_lengths, [0, len(outgoing_packet_lengths)], columns)
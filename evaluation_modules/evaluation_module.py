@@ -1,33 +1,60 @@
 # This module is responsible for evaluating the user scenarios by reading packets from two pcapng files in the evaluation set.
 
 import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from colorama import Fore, Style
 from common_modules.flow_labeling import get_activity_name_from_label
+from common_modules.instrumentation import stage, count
 from common_modules.ip_addresses import get_ip_address
-from common_modules.utilities import list_pcapng_files, read_evaluation_pcapng_files, convert_timestamp_to_mdt
-from evaluation_modules.evaluation_utilities import window_packets, classify_window
+from common_modules.model_registry import get_model_feature_columns
+from common_modules.utilities import list_pcapng_files, iter_evaluation_pcapng_chunks, convert_timestamp_to_mdt
+from evaluation_modules.evaluation_utilities import ChunkedWindowFeatures, classify_windows, chunk_reorder_tolerance
 
 # Define overlap time in seconds -> you can change it according to the model you are using
 # The overlap time is the time between two consecutive windows. It is used to ensure that the windows are not completely disjoint.
 # Be sure to set the overlap time to a value that is less than the delta time.
 overlap = 2
 
-# This function evaluates all the user scenarios by reading packets from a pcapng file in the evaluation set
-def evaluate_user_scenarios(folder_path, delta):
-    """
-    This function processes all .pcapng files in the folder, splits the packets into overlapping time windows,
-    and performs classification on each window.
+# Define how the window features are computed:
+# 'incremental' updates the statistics with the packets entering and leaving each window (fast when windows overlap a lot),
+# 'batch' recomputes the statistics of every window from scratch,
+# 'auto' chooses the incremental engine when the window step (delta - overlap) is at most a quarter of delta.
+feature_engine = 'auto'
 
-    :param folder_path: The path to the evaluation set folder.
-    :param delta: The delta value used for filtering packets.
+# Define the number of valid windows classified together -> larger batches are faster, smaller ones use less memory
+batch_size = 256
 
-    :return: A dictionary with, for each file, a list of predictions for each window.
+# Define the device names to be filtered
+device_names = ['sonos-smart-speaker', 'tplink-tapo-camera']
+
+# Define how the traffic of the devices is classified:
+# 'per-device' splits the capture into one packet stream per device and classifies the windows of each device separately,
+# so that every window gets the list of the activities of the devices (needed when the devices are active at the same time),
+# 'merged' classifies the packets of all the devices together, with a single activity per window
+evaluation_mode = 'per-device'
+
+# Define the number of threads running the per-device pipelines (None -> one per device)
+device_workers = None
+
+# Define the number of bytes of each capture read at a time -> the memory used by the evaluation depends on it and on delta,
+# not on the size of the captures, so captures larger than the memory can be evaluated (None reads each capture at once)
+evaluation_chunk_size = 16 * 1024 * 1024
+
+# Define the number of processes evaluating the captures -> 1 evaluates them in this process, while they are read,
+# more shards the captures across files and time ranges in a pool of processes (None -> number of cores)
+evaluation_workers = 1
+
+
+# This function returns the IP addresses of the given devices
+def get_device_ip_addresses(device_names):
     """
+    Looks up the IP address of each device, exiting with an error if a device is unknown.
 
-    # Define the device names to be filtered
-    device_names = ['sonos-smart-speaker', 'tplink-tapo-camera']
+    :param device_names: list of device names.
+    :return: list of IP addresses, in the order of the device names.
+    """
 
-    # Get device IP addresses
     device_ip_addresses = []
 
     for device_name in device_names:
@@ -37,58 +64,306 @@ def evaluate_user_scenarios(folder_path, delta):
             sys.exit(1)
         device_ip_addresses.append(device_ip)
 
-    results = {}
+    return device_ip_addresses
+
+
+# This function evaluates all the user scenarios by reading packets from a pcapng file in the evaluation set
+def evaluate_user_scenarios(folder_path, delta, mode=None):
+    """
+    This function processes all .pcapng files in the folder, splits the packets into overlapping time windows,
+    and performs classification on each window.
+
+    :param folder_path: The path to the evaluation set folder.
+    :param delta: The delta value used for filtering packets.
+    :param mode: 'per-device' or 'merged' (default: evaluation_mode).
+
+    :return: A dictionary with, for each file, a list of predictions for each window.
+             In 'per-device' mode, the predictions of each window are the list of the activities of the devices.
+    """
+
+    return {file_path: list(file_results) for file_path, file_results in iter_user_scenarios(folder_path, delta, mode)}
+
+
+# This function lazily evaluates the user scenarios, yielding the predictions of each window as soon as it is classified
+def iter_user_scenarios(folder_path, delta, mode=None, workers=None, file_paths=None):
+    """
+    Reads each .pcapng file in chunks of evaluation_chunk_size bytes and classifies its windows while it is read,
+    so that neither the packets nor the predictions of a whole capture are held in memory.
+    With more than one worker, the captures are evaluated in parallel (see parallel_evaluation.py), with the same results.
+
+    :param folder_path: The path to the evaluation set folder.
+    :param delta: The delta value used for filtering packets.
+    :param mode: 'per-device' or 'merged' (default: evaluation_mode).
+    :param workers: number of processes evaluating the captures (default: evaluation_workers).
+    :param file_paths: the captures to evaluate (default: all the .pcapng files of the folder).
+
+    :return: A generator of tuples (file path, generator of the predictions of the windows of the file).
+             The predictions of a file must be consumed before moving to the next file.
+    """
+
+    workers = evaluation_workers if workers is None else workers
+
+    if workers != 1:
+        # Imported here because the parallel evaluation is built on the functions of this module
+        from evaluation_modules.parallel_evaluation import iter_parallel_user_scenarios
+        yield from iter_parallel_user_scenarios(folder_path, delta, mode, workers, file_paths)
+        return
+
+    # Get device IP addresses
+    device_ip_addresses = get_device_ip_addresses(device_names)
 
     # Get the list of .pcapng files in the folder
-    pcapng_files = list_pcapng_files(folder_path)
+    pcapng_files = list_pcapng_files(folder_path) if file_paths is None else file_paths
 
     if not pcapng_files:
         print(f"{Fore.RED}No .pcapng files found in folder: {folder_path}{Style.RESET_ALL}")
-        return results
+        return
 
     for file_path in pcapng_files:
+        count('evaluation_files')
+
+        if (mode or evaluation_mode) == 'per-device':
+            yield file_path, evaluate_device_streams(file_path, device_ip_addresses, delta)
+        else:
+            yield file_path, evaluate_merged_stream(file_path, device_ip_addresses, delta)
+
+
+# This function prints the outcome of the reading of a capture
+def _print_packets_read(file_path, packets_read):
+    count('evaluation_packets', packets_read)
+
+    if packets_read:
+        print(f'\n{Fore.GREEN}Packets successfully read!{Style.RESET_ALL} ({packets_read} packets)')
+    else:
+        print(f"\n{Fore.RED}No packets read from {file_path.split('/')[-1]}{Style.RESET_ALL}")
+
+
+# This function classifies the windows of the packets of all the devices together
+def evaluate_merged_stream(file_path, device_ip_addresses, delta):
+    """
+    :param file_path: The path of the .pcapng file.
+    :param device_ip_addresses: list of IP addresses of the devices.
+    :param delta: The delta value used for the windows and to load the models.
+
+    :return: A generator of the prediction dictionary of each valid window.
+    """
+
+    # Read packets from the current .pcapng file
+    print(f'\n{Fore.BLUE}Reading packets from file: {Style.RESET_ALL}{file_path}')
+
+    # Split packets into time windows with 2 seconds overlap (windows and features are produced lazily in a single pass,
+    # while the capture is read chunk by chunk)
+    chunks = iter_evaluation_pcapng_chunks(file_path, device_ip_addresses, evaluation_chunk_size)
+    # Only the features used by the models are computed
+    window_features = ChunkedWindowFeatures(device_ip_addresses, delta, overlap, feature_engine, batch_size,
+                                            columns=get_model_feature_columns(delta))
 
-        # Get file name
-        file_name = file_path.split('/')[-1]
+    # Valid windows waiting to be classified: (window index, start time, end time, features)
+    pending_windows = []
 
-        # Read packets from the current .pcapng file
-        print(f'\n{Fore.BLUE}Reading packets from file: {Style.RESET_ALL}{file_path}')
+    for idx, (window, flow_features) in enumerate(window_features.iter_chunks(chunks)):
+        count('windows')
+        print(f"\nProcessing window {idx + 1}\n")
 
-        packets = read_evaluation_pcapng_files(file_path, device_ip_addresses)
+        # Convert window start and end times to MDT format
+        start_mdt = convert_timestamp_to_mdt(window['start_time'])
+        end_mdt = convert_timestamp_to_mdt(window['end_time'])
 
-        print(f'{Fore.GREEN}Packets successfully read!{Style.RESET_ALL}')
+        print(f"{Fore.YELLOW}Window start time: {Style.RESET_ALL}{start_mdt}")
+        print(f"{Fore.YELLOW}Window end time: {Style.RESET_ALL}{end_mdt}")
 
-        if not packets:
-            print(f"{Fore.RED}No packets read from {file_name}{Style.RESET_ALL}")
+        if flow_features is None:
+            count('skipped_windows')
+            print(f"{Fore.RED}Window {idx + 1} is not valid!\nNo incoming or outgoing packets to analyze!{Style.RESET_ALL}")
             continue
 
-        # Split packets into time windows with 2 seconds overlap
-        windows = window_packets(packets, delta, overlap)
-        file_results = []
-        for idx, window in enumerate(windows):
-            print(f"\nProcessing window {idx + 1}/{len(windows)}\n")
+        pending_windows.append((idx, start_mdt, end_mdt, flow_features))
 
-            # Convert window start and end times to MDT format
-            start_mdt = convert_timestamp_to_mdt(window['start_time'])
-            end_mdt = convert_timestamp_to_mdt(window['end_time'])
+        # Classify the valid windows in batches, so that memory stays bounded on very long captures
+        if len(pending_windows) == batch_size:
+            yield from classify_pending_windows(pending_windows, delta)
+            pending_windows = []
 
-            print(f"{Fore.YELLOW}Window start time: {Style.RESET_ALL}{start_mdt}")
-            print(f"{Fore.YELLOW}Window end time: {Style.RESET_ALL}{end_mdt}")
+    if pending_windows:
+        yield from classify_pending_windows(pending_windows, delta)
 
-            # Classify the window
-            prediction = classify_window(window['packets'], device_ip_addresses, delta)
+    _print_packets_read(file_path, window_features.packets_read)
 
-            if prediction is None:
-                print(f"{Fore.RED}Window {idx + 1} is not valid!\nNo incoming or outgoing packets to analyze!{Style.RESET_ALL}")
+
+# This function classifies the windows of each device separately and merges them into per-window activity lists
+def evaluate_device_streams(file_path, device_ip_addresses, delta):
+    """
+    Demultiplexes each chunk of the capture into one packet stream per device and runs one window pipeline per device,
+    in parallel. The windows of all the devices start at the oldest packet of the capture, so the window with the same
+    index covers the same time range for every device, and a window is complete for all the devices at the same chunk.
+
+    :param file_path: The path of the .pcapng file.
+    :param device_ip_addresses: list of IP addresses of the devices, in the order of device_names.
+    :param delta: The delta value used for the windows and to load the models.
+
+    :return: A generator with, for each window where at least one device is active, a dictionary with the window index,
+             start and end time and the list of the activities of the devices ('activities').
+    """
+
+    # Read packets from the current .pcapng file (a single pass demultiplexes the packets of each device)
+    print(f'\n{Fore.BLUE}Reading packets from file: {Style.RESET_ALL}{file_path}')
+
+    chunks = iter_evaluation_pcapng_chunks(file_path, device_ip_addresses, evaluation_chunk_size, by_device=True)
+    columns = get_model_feature_columns(delta)
+    device_windows = [ChunkedWindowFeatures([ip_address], delta, overlap, feature_engine, batch_size, columns=columns)
+                      for ip_address in device_ip_addresses]
+    origin = None
+    earliest_time = last_time = None
+
+    # The pipelines share the models of the registry, so they run in threads instead of processes
+    with ThreadPoolExecutor(max_workers=device_workers or len(device_ip_addresses)) as executor:
+        for device_packets in chunks:
+            tables = [device_packets[ip_address] for ip_address in device_ip_addresses]
+            read_tables = [table for table in tables if len(table)]
+
+            if not read_tables:
                 continue
 
-            file_results.append({
-                "window_index": idx,
-                "start_time_mdt": start_mdt,
-                "end_time_mdt": end_mdt,
-                "rf_prediction": get_activity_name_from_label(prediction[0]),
-                "xgb_prediction": get_activity_name_from_label(prediction[1])
+            # Time of the oldest and of the latest packet read, of any device
+            chunk_earliest_time = min(table.time[0] for table in read_tables)
+            chunk_last_time = max(table.time[-1] for table in read_tables)
+            earliest_time = chunk_earliest_time if earliest_time is None else min(earliest_time, chunk_earliest_time)
+            last_time = chunk_last_time if last_time is None else max(last_time, chunk_last_time)
+
+            # Common origin of the windows of all the devices, the oldest packet once no older packet can be read
+            # (until then, the pipelines keep the packets without yielding windows)
+            if origin is None and earliest_time <= last_time - chunk_reorder_tolerance:
+                origin = earliest_time
+                for windows in device_windows:
+                    windows.window_start = origin
+
+            device_results = executor.map(lambda windows, table: classify_device_windows(windows.feed(table, last_time), delta),
+                                          device_windows, tables)
+            yield from merge_device_results(device_results)
+
+        if origin is None and earliest_time is not None:
+            for windows in device_windows:
+                windows.window_start = earliest_time
+
+        device_results = executor.map(lambda windows: classify_device_windows(windows.finish(), delta), device_windows)
+        yield from merge_device_results(device_results)
+
+    _print_packets_read(file_path, sum(windows.packets_read for windows in device_windows))
+
+
+# This function gathers the activities of the devices in each window, in the order of the devices
+def merge_device_results(device_results, names=None, verbose=True):
+    """
+    :param device_results: iterable with the list of the results of each device (see classify_device_windows).
+    :param names: the names of the devices, in the order of the results (default: device_names).
+    :param verbose: If True, the windows and the activities of the devices are printed.
+
+    :return: A list with, for each window where at least one device is active, a dictionary with the window index,
+             start and end time and the list of the activities of the devices ('activities').
+    """
+
+    windows = {}
+
+    for device_name, results in zip(names or device_names, device_results):
+        for result in results:
+            window = windows.setdefault(result['window_index'], {
+                'window_index': result['window_index'],
+                'start_time_mdt': result['start_time_mdt'],
+                'end_time_mdt': result['end_time_mdt'],
+                'activities': []
+            })
+            window['activities'].append({
+                'device': device_name,
+                'rf_prediction': result['rf_prediction'],
+                'xgb_prediction': result['xgb_prediction'],
+                'rf_confidence': result['rf_confidence'],
+                'xgb_confidence': result['xgb_confidence']
             })
-        results[file_path] = file_results
 
-    return results
\ No newline at end of file
+    merged_windows = [windows[idx] for idx in sorted(windows)]
+
+    if not verbose:
+        return merged_windows
+
+    for window in merged_windows:
+        print(f"\nProcessing window {window['window_index'] + 1}\n")
+        print(f"{Fore.YELLOW}Window start time: {Style.RESET_ALL}{window['start_time_mdt']}")
+        print(f"{Fore.YELLOW}Window end time: {Style.RESET_ALL}{window['end_time_mdt']}")
+
+        for activity in window['activities']:
+            print(f"\n{Fore.YELLOW}{activity['device']} Random Forest prediction: {Style.RESET_ALL}{activity['rf_prediction']}")
+            print(f"{Fore.YELLOW}{activity['device']} XGBoost prediction: {Style.RESET_ALL}{activity['xgb_prediction']}")
+
+    return merged_windows
+
+
+# This function classifies the windows of the packets of a single device
+def classify_device_windows(windows, delta):
+    """
+    :param windows: iterable of tuples (window, flow_features) of the device, with windows numbered from the common origin.
+    :param delta: The delta value used to load the models.
+
+    :return: A list with the prediction dictionary of each valid window of the device, indexed by window position.
+    """
+
+    device_results = []
+
+    # Valid windows waiting to be classified: (window position, start time, end time, features)
+    pending_windows = []
+
+    for window, flow_features in windows:
+        count('windows')
+
+        if flow_features is None:
+            count('skipped_windows')
+            continue
+
+        pending_windows.append((window['position'], convert_timestamp_to_mdt(window['start_time']),
+                                convert_timestamp_to_mdt(window['end_time']), flow_features))
+
+        if len(pending_windows) == batch_size:
+            device_results.extend(classify_pending_windows(pending_windows, delta, verbose=False))
+            pending_windows = []
+
+    if pending_windows:
+        device_results.extend(classify_pending_windows(pending_windows, delta, verbose=False))
+
+    return device_results
+
+
+# This function classifies a batch of valid windows and returns their results
+def classify_pending_windows(pending_windows, delta, verbose=True):
+    """
+    Classifies a batch of windows with a single call per model and maps the predictions back to the windows.
+
+    :param pending_windows: list of tuples (window index, start time MDT, end time MDT, features) of valid windows.
+    :param delta: The delta value used to load the correct models.
+    :param verbose: If True, the predictions are printed.
+
+    :return: A list with the prediction dictionary of each window.
+    """
+
+    with stage('classify_windows'):
+        predictions = classify_windows(np.vstack([window[3] for window in pending_windows]), delta)
+    count('predictions', len(pending_windows))
+
+    batch_results = []
+    for position, (idx, start_mdt, end_mdt, _) in enumerate(pending_windows):
+        rf_prediction = get_activity_name_from_label(predictions['rf_predictions'][position])
+        xgb_prediction = get_activity_name_from_label(predictions['xgb_predictions'][position])
+
+        if verbose:
+            print(f'\n{Fore.YELLOW}Window {idx + 1} Random Forest prediction: {Style.RESET_ALL}{rf_prediction}')
+            print(f'{Fore.YELLOW}Window {idx + 1} XGBoost prediction: {Style.RESET_ALL}{xgb_prediction}')
+
+        batch_results.append({
+            "window_index": idx,
+            "start_time_mdt": start_mdt,
+            "end_time_mdt": end_mdt,
+            "rf_prediction": rf_prediction,
+            "xgb_prediction": xgb_prediction,
+            "rf_confidence": float(predictions['rf_confidences'][position]),
+            "xgb_confidence": float(predictions['xgb_confidences'][position])
+        })
+
+    return batch_results
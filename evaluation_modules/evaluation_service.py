@@ -0,0 +1,205 @@
+# This module runs the evaluation as a service that classifies many capture sources at once.
+# The sources can be capture files (optionally followed while they grow), named pipes, the standard input or the
+# connections received on a local TCP socket, each carrying a .pcapng / .pcap stream. The sources are read by an
+# asyncio event loop, the parsing, feature computation and classification run in a pool of threads sharing the same
+# model registry, and the predictions are written as JSON lines as soon as the windows are complete.
+#
+# Usage (from the project root, with the trained models of the chosen delta in rf_models/ and xgb_models/):
+#   python -m evaluation_modules.evaluation_service capture1.pcapng capture2.pcapng --delta 5
+#   python -m evaluation_modules.evaluation_service --listen 127.0.0.1:9999 --delta 5
+#   (then, for each segment: tcpdump -i <interface> -U -w - | nc 127.0.0.1 9999)
+
+import os
+import sys
+import json
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from colorama import Fore, Style
+from common_modules.model_registry import load_model
+from evaluation_modules.evaluation_module import overlap, device_names, evaluation_mode, get_device_ip_addresses
+from evaluation_modules.stream_classifier import StreamClassifier, chunk_size, poll_interval
+
+
+class EvaluationService:
+    """
+    Classifies many capture sources concurrently. Each source has its own StreamClassifier, whose chunks are
+    processed in order by the executor, while the models are loaded once and shared by all the sources.
+    Every classified window, and the end (or failure) of every source, is written as a JSON line.
+    """
+
+    def __init__(self, device_ip_addresses, delta, overlap=2, output=None, workers=None, mode=None, names=None):
+        """
+        :param device_ip_addresses: list of IP addresses of the devices to be filtered.
+        :param delta: duration of each window in seconds, used to load the models.
+        :param overlap: overlapping time between windows in seconds (default: 2).
+        :param output: text file object receiving the JSON lines (default: standard output).
+        :param workers: number of threads processing the captures (default: number of cores).
+        :param mode: 'per-device' or 'merged' (default: evaluation_mode), as in StreamClassifier.
+        :param names: the names of the devices, in the order of their IP addresses (default: device_names).
+        """
+        self.device_ip_addresses = device_ip_addresses
+        self.delta = delta
+        self.overlap = overlap
+        self.mode = mode
+        self.names = names
+        self.output = output or sys.stdout
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+
+    # This method writes a JSON line (always called from the event loop, so lines are never interleaved)
+    def emit(self, record):
+        self.output.write(json.dumps(record) + '\n')
+        self.output.flush()
+
+    # This method classifies a capture stream, reading its chunks with the given coroutine function
+    async def classify_source(self, source_name, read_chunk):
+        """
+        :param source_name: the name of the source, written in every JSON line.
+        :param read_chunk: coroutine function returning the next chunk of the stream, or b'' at its end.
+        """
+        loop = asyncio.get_running_loop()
+        classifier = StreamClassifier(self.device_ip_addresses, self.delta, self.overlap, verbose=False, mode=self.mode,
+                                      names=self.names)
+
+        try:
+            while True:
+                data = await read_chunk()
+                if not data:
+                    break
+
+                for result in await loop.run_in_executor(self.executor, classifier.feed, data):
+                    self.emit({'source': source_name, **result})
+
+            for result in await loop.run_in_executor(self.executor, classifier.finish):
+                self.emit({'source': source_name, **result})
+
+        except (ValueError, IndexError, OSError) as error:
+            # An invalid stream stops only its own source
+            self.emit({'source': source_name, 'event': 'error', 'message': str(error)})
+            return
+
+        self.emit({'source': source_name, 'event': 'end', **classifier.latency_report()})
+
+    # This method classifies a capture file or named pipe (or the standard input for '-')
+    async def classify_file(self, file_path, follow=False):
+        """
+        :param file_path: the path of the capture file or named pipe, or '-' for the standard input.
+        :param follow: if True, keep waiting for new packets at the end of a regular file, as 'tail -f' does.
+        """
+        loop = asyncio.get_running_loop()
+
+        try:
+            # Opening a named pipe blocks until a writer opens it
+            source = sys.stdin.buffer if file_path == '-' else await loop.run_in_executor(None, open, file_path, 'rb')
+        except OSError as error:
+            self.emit({'source': file_path, 'event': 'error', 'message': str(error)})
+            return
+
+        is_regular_file = source.seekable()
+
+        async def read_chunk():
+            while True:
+                data = await loop.run_in_executor(None, source.read1, chunk_size)
+                if data or not (follow and is_regular_file):
+                    return data
+                await asyncio.sleep(poll_interval)
+
+        try:
+            await self.classify_source(file_path, read_chunk)
+        finally:
+            if source is not sys.stdin.buffer:
+                source.close()
+
+    # This method classifies the capture streams received on a TCP connection
+    async def classify_connection(self, reader, writer):
+        host, port = writer.get_extra_info('peername')[:2]
+
+        async def read_chunk():
+            return await reader.read(chunk_size)
+
+        try:
+            await self.classify_source(f'tcp://{host}:{port}', read_chunk)
+        finally:
+            writer.close()
+
+    # This method runs the service until all the sources end (forever when listening on a TCP socket)
+    async def run(self, file_paths, listen_address=None, follow=False):
+        """
+        :param file_paths: list of capture files, named pipes or '-' for the standard input.
+        :param listen_address: optional (host, port) of the TCP socket accepting capture streams.
+        :param follow: if True, keep waiting for new packets at the end of the capture files.
+        """
+        loop = asyncio.get_running_loop()
+
+        # Load the models once, before the first packet arrives: all the sources share them
+        await loop.run_in_executor(self.executor, load_model, 'rf', self.delta)
+        await loop.run_in_executor(self.executor, load_model, 'xgb', self.delta)
+
+        server = None
+        if listen_address is not None:
+            try:
+                server = await asyncio.start_server(self.classify_connection, *listen_address)
+            except OSError as error:
+                print(f'{Fore.RED}\nERROR: Cannot listen on {listen_address[0]}:{listen_address[1]}: {Style.RESET_ALL}{error}', file=sys.stderr)
+                sys.exit(1)
+
+            print(f'{Fore.BLUE}Listening for capture streams on: {Style.RESET_ALL}{listen_address[0]}:{listen_address[1]}', file=sys.stderr)
+
+        tasks = [asyncio.create_task(self.classify_file(file_path, follow)) for file_path in file_paths]
+
+        if server is not None:
+            async with server:
+                await asyncio.gather(server.serve_forever(), *tasks)
+        else:
+            await asyncio.gather(*tasks)
+
+        self.executor.shutdown()
+
+
+# This function parses a HOST:PORT address
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Classify the device activities of many captures at once, writing the predictions as JSON lines.')
+    parser.add_argument('captures', nargs='*', help='capture files or named pipes (- for the standard input)')
+    parser.add_argument('--listen', metavar='HOST:PORT', help='also accept capture streams on this local TCP socket')
+    parser.add_argument('--delta', type=float, default=5, help='window duration in seconds, used to load the models (default: 5)')
+    parser.add_argument('--overlap', type=float, default=overlap, help=f'overlap between windows in seconds (default: {overlap})')
+    parser.add_argument('--devices', nargs='+', default=device_names, help='names of the devices to classify')
+    parser.add_argument('--evaluation-mode', choices=['per-device', 'merged'], default=evaluation_mode,
+                        help=f'classify the windows of each device or of all the devices together (default: {evaluation_mode})')
+    parser.add_argument('--follow', action='store_true', help='keep waiting for new packets at the end of the capture files')
+    parser.add_argument('--workers', type=int, help='number of threads processing the captures (default: number of cores)')
+    parser.add_argument('--output', help='file receiving the JSON lines (default: standard output)')
+    arguments = parser.parse_args(arguments)
+
+    if not arguments.captures and arguments.listen is None:
+        parser.error('at least one capture or --listen is required')
+
+    # Models are saved with the delta in their file name (e.g. 5, not 5.0)
+    delta = int(arguments.delta) if float(arguments.delta).is_integer() else arguments.delta
+
+    # Ensure delta is greater than overlap
+    if delta <= arguments.overlap:
+        print(f"\n{Fore.RED}ERROR: Delta must be greater than the overlap value to avoid infinite loops!{Style.RESET_ALL}")
+        sys.exit(1)
+
+    output = open(arguments.output, 'a') if arguments.output else None
+    service = EvaluationService(get_device_ip_addresses(arguments.devices), delta, arguments.overlap, output, arguments.workers,
+                                arguments.evaluation_mode, arguments.devices)
+    listen_address = parse_address(arguments.listen) if arguments.listen else None
+
+    try:
+        asyncio.run(service.run(arguments.captures, listen_address, arguments.follow))
+    except KeyboardInterrupt:
+        print(f'\n{Fore.YELLOW}Service stopped{Style.RESET_ALL}', file=sys.stderr)
+    finally:
+        if output is not None:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
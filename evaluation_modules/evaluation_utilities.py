@@ -2,23 +2,52 @@
 
 import os
 import sys
-import joblib
+import numpy as np
 from colorama import Style, Fore
-from scapy.layers.inet import IP
+from common_modules.feature_extraction import compute_window_features, concatenate_segments
 from common_modules.flow_labeling import get_activity_name_from_label
+from common_modules.instrumentation import stage, count
+from common_modules.model_registry import load_model, get_model_feature_columns
+from common_modules.packet_table import PacketTable
+from common_modules.rolling_features import RollingWindowFeatures
 from common_modules.utilities import compute_statistical_features
 
+# Define the number of seconds a packet of a capture read in chunks can be written after later packets (e.g. in a
+# pcapng with several interfaces) and still be put in its windows: the windows are complete only this long after their end
+chunk_reorder_tolerance = 5.0
 
-# This function creates packet windows from the given list of packets based on the specified delta and overlap.
+
+# This function creates packet windows from the given table of packets based on the specified delta and overlap.
 def window_packets(packets, delta, overlap=2):
     """
     Splits packets within the analyzed .pcapng file into time windows.
 
-    :param packets: list of packets from pcapng file.
+    :param packets: table of packets from pcapng file.
+    :param delta: duration of each window in seconds.
+    :param overlap: overlapping time between windows in seconds (default: 2).
+
+    :return: list of windows, where each window is a table of packets.
+    """
+
+    return list(iter_windows(packets, delta, overlap))
+
+
+# This function lazily yields the packet windows of a time-sorted table of packets in a single pass.
+def iter_windows(packets, delta, overlap=2, origin=None, stop_time=None):
+    """
+    Bisects the precomputed timestamp array to find the packets of each window and yields the same windows
+    as window_packets. Each window is a view over the packet table, so no packet is copied.
+
+    :param packets: table of packets from pcapng file, sorted by timestamp.
     :param delta: duration of each window in seconds.
     :param overlap: overlapping time between windows in seconds (default: 2).
+    :param origin: start time of the first window, not after the first packet (default: the time of the first packet).
+                   Tables windowed with the same origin have aligned windows.
+    :param stop_time: if given, only the windows starting before this time are yielded.
 
-    :return: list of windows, where each window is a list of packets.
+    :return: generator of windows, where each window is a dictionary with its packets, start and end time,
+             the range [first_index, last_index) of its packets in the table and its position (the number of
+             window steps from the origin).
     """
 
     # Ensure delta is greater than overlap
@@ -26,53 +55,287 @@ def window_packets(packets, delta, overlap=2):
         print(f"\n{Fore.RED}ERROR: Delta must be greater than the overlap value to avoid infinite loops!{Style.RESET_ALL}")
         sys.exit(1)
 
-    if not packets:
-        return []
+    if not len(packets):
+        return
 
-    windows = []
-    start_time = packets[0].time
-    end_time = packets[-1].time
+    timestamps = packets.time
+    start_time = timestamps[0] if origin is None else origin
+    end_time = timestamps[-1]
     step = delta - overlap  # window shift
 
+    # The window starts are accumulated step by step, so tables windowed with the same origin share the exact same windows
+    position = 0
     current_start = start_time
-    while current_start <= end_time:
+    while current_start <= end_time and (stop_time is None or current_start < stop_time):
         current_end = current_start + delta
+
         # Select all packets with timestamp in [current_start, current_end)
-        window_pkts = [pkt for pkt in packets if current_start <= pkt.time < current_end]
+        first = np.searchsorted(timestamps, current_start, side='left')
+        last = np.searchsorted(timestamps, current_end, side='left')
 
-        if window_pkts:
-            windows.append({
-                'packets': window_pkts,
+        if last > first:
+            yield {
+                'packets': packets[first:last],
                 'start_time': current_start,
-                'end_time': current_end
-            })
+                'end_time': current_end,
+                'first_index': int(first),
+                'last_index': int(last),
+                'position': position
+            }
         current_start += step
-    return windows
+        position += 1
+
+# This function lazily yields the packet windows together with their features.
+def iter_window_features(packets, device_ip_addresses, delta, overlap=2, engine='auto', batch_size=256, origin=None, stop_time=None,
+                         columns=None):
+    """
+    Splits the packets into time windows and computes the features of each window.
+
+    :param packets: table of packets from pcapng file, sorted by timestamp.
+    :param device_ip_addresses: list of IP addresses of the devices to be filtered.
+    :param delta: duration of each window in seconds.
+    :param overlap: overlapping time between windows in seconds (default: 2).
+    :param engine: 'incremental' updates the statistics with the packets entering and leaving each window,
+                   'batch' recomputes the statistics of every window from scratch, batch_size windows at a time,
+                   'auto' uses the incremental engine only when consecutive windows share most of their packets.
+    :param batch_size: number of windows whose features are computed together by the batch engine.
+    :param origin: start time of the first window (default: the time of the oldest packet).
+    :param stop_time: if given, only the windows starting before this time are yielded.
+    :param columns: optional list of the feature names used by the models (default: all the features): only the
+                    statistics of these features are computed.
+
+    :return: generator of tuples (window, flow_features), where flow_features is None if the window is not valid.
+    """
+
+    # The incremental engine pays off when the window step is small compared to the window duration
+    if engine == 'auto':
+        engine = 'incremental' if delta - overlap <= delta / 4 else 'batch'
+
+    if engine == 'incremental':
+        rolling_features = RollingWindowFeatures(packets, device_ip_addresses, columns)
+
+        for window in iter_windows(packets, delta, overlap, origin, stop_time):
+            rolling_features.move_to(window['first_index'], window['last_index'])
+            yield window, rolling_features.features()
+        return
+
+    # The flow of each packet is computed once for the whole table
+    outgoing_mask = packets.outgoing_mask(device_ip_addresses)
+    incoming_mask = packets.incoming_mask(device_ip_addresses)
+
+    batch = []
+    for window in iter_windows(packets, delta, overlap, origin, stop_time):
+        batch.append(window)
+        if len(batch) == batch_size:
+            yield from zip(batch, _compute_batch_features(packets, batch, outgoing_mask, incoming_mask, columns))
+            batch = []
+
+    if batch:
+        yield from zip(batch, _compute_batch_features(packets, batch, outgoing_mask, incoming_mask, columns))
+
+
+class ChunkedWindowFeatures:
+    """
+    Splits a capture read in chunks into the same windows as iter_window_features on the whole capture.
+    Each chunk yields the windows that are complete (no later packet can belong to them), and the packets that
+    still belong to the next windows (the overlap tail) are carried to the next chunk, so only the packets of a
+    chunk and of a window are held in memory. A packet older than the packets of the previous chunks is put in its
+    windows if it is at most chunk_reorder_tolerance seconds older than the latest packet read before it.
+    """
+
+    def __init__(self, device_ip_addresses, delta, overlap=2, engine='auto', batch_size=256, origin=None, columns=None):
+        """
+        :param device_ip_addresses: list of IP addresses of the devices to be filtered.
+        :param delta: duration of each window in seconds.
+        :param overlap: overlapping time between windows in seconds (default: 2).
+        :param engine: the feature engine, as in iter_window_features.
+        :param batch_size: number of windows whose features are computed together by the batch engine.
+        :param origin: start time of the first window (default: the time of the oldest packet).
+        :param columns: optional list of the feature names to compute, as in iter_window_features.
+        """
+        self.device_ip_addresses = device_ip_addresses
+        self.delta = delta
+        self.overlap = overlap
+        self.engine = engine
+        self.batch_size = batch_size
+        self.columns = columns
+
+        # Start time and position of the first window not yielded yet, and the packets that can belong to it
+        self.window_start = origin
+        self.position = 0
+        self.tail = PacketTable.empty()
+        self.packets_read = 0
+
+    # This method adds the packets of a chunk and yields the windows completed by them
+    def feed(self, packets, last_time=None):
+        """
+        :param packets: table of the packets of the chunk, sorted by timestamp.
+        :param last_time: time up to which the capture has been read (default: the time of the latest packet read).
+                          Windows ending at or before chunk_reorder_tolerance seconds before it are complete.
+
+        :return: generator of tuples (window, flow_features), as iter_window_features.
+        """
+        self.packets_read += len(packets)
+
+        # The packets of the windows already yielded cannot be put in them any more
+        if self.window_start is not None and len(packets) and packets.time[0] < self.window_start:
+            late_packets = int(np.count_nonzero(packets.time < self.window_start))
+            count('late_packets', late_packets)
+            print(f'{Fore.RED}\nWARNING: {late_packets} packets are more than {chunk_reorder_tolerance} s older than the '
+                  f'packets read before them and are not in their windows (increase chunk_reorder_tolerance){Style.RESET_ALL}')
+            packets = packets[packets.time >= self.window_start]
+
+        # The chunk can contain packets older than the tail carried from the previous chunks
+        packets = PacketTable.concatenate([self.tail, packets]).sort_by_time()
+
+        if last_time is None:
+            if not len(packets):
+                return
+            last_time = packets.time[-1]
+
+        # The first window starts at the oldest packet, known once no older packet can be read
+        if self.window_start is None:
+            if not len(packets) or packets.time[0] > last_time - chunk_reorder_tolerance:
+                self.tail = packets
+                return
+            self.window_start = packets.time[0]
+
+        # Start of the first incomplete window, accumulated step by step as iter_windows does
+        step = self.delta - self.overlap
+        next_start = self.window_start
+        steps = 0
+        while next_start + self.delta <= last_time - chunk_reorder_tolerance:
+            next_start += step
+            steps += 1
+
+        yield from self._iter_windows(packets, next_start)
+
+        # Keep only the packets that can belong to the next windows
+        self.tail = packets[int(np.searchsorted(packets.time, next_start, side='left')):]
+        self.window_start = next_start
+        self.position += steps
+
+    # This method yields the remaining windows at the end of the capture
+    def finish(self):
+        if self.window_start is None and len(self.tail):
+            self.window_start = self.tail.time[0]
+        if len(self.tail):
+            yield from self._iter_windows(self.tail, None)
+        self.tail = PacketTable.empty()
+
+    # This method yields the complete windows of all the chunks
+    def iter_chunks(self, chunks):
+        """
+        :param chunks: iterable of the tables of packets of each chunk.
+        :return: generator of tuples (window, flow_features) of the whole capture.
+        """
+        for packets in chunks:
+            yield from self.feed(packets)
+        yield from self.finish()
+
+    # This method yields the windows of the table starting before stop_time, numbered from the first window of the capture
+    def _iter_windows(self, packets, stop_time):
+        if not len(packets):
+            return
+
+        windows = iter_window_features(packets, self.device_ip_addresses, self.delta, self.overlap, self.engine,
+                                       self.batch_size, self.window_start, stop_time, self.columns)
+
+        for window, flow_features in windows:
+            window['position'] += self.position
+            yield window, flow_features
+
+
+# This function computes the features of a batch of windows with a single call of the batched extractor.
+def _compute_batch_features(packets, windows, outgoing_mask, incoming_mask, columns=None):
+    complete_segments, incoming_segments, outgoing_segments = [], [], []
+    valid_windows = []
+
+    for window in windows:
+        window_range = slice(window['first_index'], window['last_index'])
+        lengths = packets.length[window_range]
+        outgoing_lengths = lengths[outgoing_mask[window_range]]
+        incoming_lengths = lengths[incoming_mask[window_range]]
+
+        # Windows without incoming or outgoing packets are not valid
+        is_valid = len(outgoing_lengths) > 0 and len(incoming_lengths) > 0
+        valid_windows.append(is_valid)
+
+        if is_valid:
+            complete_segments.append(lengths)
+            incoming_segments.append(incoming_lengths)
+            outgoing_segments.append(outgoing_lengths)
+
+    if not complete_segments:
+        return [None] * len(windows)
+
+    features = compute_window_features(*concatenate_segments(complete_segments),
+                                       *concatenate_segments(incoming_segments),
+                                       *concatenate_segments(outgoing_segments), columns=columns)
+
+    # Map the feature rows back to the windows, keeping the (1, n_features) shape of a single window
+    rows = iter(features)
+    return [next(rows)[np.newaxis, :] if is_valid else None for is_valid in valid_windows]
+
+
+# This function computes the features of a window of packets.
+def compute_window_flow_features(window, device_ip_addresses, columns=None):
+    """
+    Splits the window into incoming and outgoing flow and computes its features.
+
+    :param window: table of packets in a window.
+    :param device_ip_addresses: list of IP addresses of the devices to be filtered.
+    :param columns: optional list of the feature names to compute (default: all the features).
+
+    :return: NumPy array of shape (1, n_features) with the window features, or None if window is not valid.
+    """
+
+    outgoing_packets = window.length[window.outgoing_mask(device_ip_addresses)]
+    incoming_packets = window.length[window.incoming_mask(device_ip_addresses)]
+
+    # If there are no valid packets for one of the flows, skip the window
+    if not len(outgoing_packets) or not len(incoming_packets):
+        return None
+
+    return compute_statistical_features(window.length, incoming_packets, outgoing_packets, columns)
+
 
 # This function classifies a window of packets using pre-trained models.
 def classify_window(window, device_ip_addresses, delta):
     """
     Computes the features of the window and returns the model predictions.
 
-    :param window: list of packets in a window.
+    :param window: table of packets in a window.
     :param device_ip_addresses: list of IP addresses of the devices to be filtered.
     :param delta: delta value to load the correct model.
 
     :return: tuple (rf_prediction, xgb_prediction) or None if window is not valid.
     """
 
-    outgoing_packets = [pkt for pkt in window if pkt.haslayer(IP) and pkt[IP].src in device_ip_addresses]
-    incoming_packets = [pkt for pkt in window if pkt.haslayer(IP) and pkt[IP].dst in device_ip_addresses]
+    # Only the features used by the models are computed
+    flow_features = compute_window_flow_features(window, device_ip_addresses, get_model_feature_columns(delta))
 
     # If there are no valid packets for one of the flows, skip the window
-    if not outgoing_packets or not incoming_packets:
+    if flow_features is None:
         return None
 
-    flow_features = compute_statistical_features(window, incoming_packets, outgoing_packets)
+    return predict_window(flow_features, delta)
 
-    # Load the models
-    rf_model = joblib.load(f'rf_models/trained_rf_classifier_{delta}.pkl')
-    xgb_model = joblib.load(f'xgb_models/trained_xgb_classifier_{delta}.pkl')
+
+# This function returns the model predictions for the features of a window.
+def predict_window(flow_features, delta):
+    """
+    Classifies the features of a window using pre-trained models.
+
+    :param flow_features: NumPy array of shape (1, n_features) with the window features used by the models.
+    :param delta: delta value to load the correct model.
+
+    :return: tuple (rf_prediction, xgb_prediction).
+    """
+
+    # Get the models from the registry (each model file is loaded only once)
+    rf_model = load_model('rf', delta)
+    xgb_model = load_model('xgb', delta)
 
     # Make predictions
     rf_prediction = rf_model.predict(flow_features)
@@ -85,6 +348,31 @@ def classify_window(window, device_ip_addresses, delta):
     return rf_prediction[0], xgb_prediction[0]
 
 
+# This function returns the model predictions for the features of a batch of windows.
+def classify_windows(flow_features, delta):
+    """
+    Classifies the features of many windows at once, with a single predict and predict_proba call per model.
+
+    :param flow_features: NumPy array of shape (n_windows, n_features) with the features of the windows used by the models.
+    :param delta: delta value to load the correct model.
+
+    :return: dictionary with the predicted labels ('rf_predictions', 'xgb_predictions') and the probabilities
+             of the predicted labels ('rf_confidences', 'xgb_confidences') of each window.
+    """
+
+    results = {}
+
+    for classifier_type in ('rf', 'xgb'):
+        # Get the model from the registry (each model file is loaded only once)
+        model = load_model(classifier_type, delta)
+
+        probabilities = model.predict_proba(flow_features)
+        results[f'{classifier_type}_predictions'] = model.predict(flow_features)
+        results[f'{classifier_type}_confidences'] = probabilities.max(axis=1)
+
+    return results
+
+
 # This function writes the evaluation results for each file and each window to an output file.
 def write_window_results(output_evaluation_folder_path, main_folder_name, delta, window_results):
     """
@@ -93,8 +381,14 @@ def write_window_results(output_evaluation_folder_path, main_folder_name, delta,
     :param output_evaluation_folder_path: The folder path where the evaluation file will be saved.
     :param main_folder_name: The name of the main evaluation folder.
     :param delta: The delta value used (e.g., window duration).
-    :param window_results: Dictionary mapping file paths to lists of window prediction dictionaries.
-                           Each prediction dictionary should contain "window_index", "rf_prediction", and "xgb_prediction".
+    :param window_results: Dictionary mapping file paths to lists of window prediction dictionaries, or iterable of
+                           (file path, iterable of window prediction dictionaries) tuples, such as the generator returned
+                           by iter_user_scenarios: the predictions are then written while the windows are classified.
+                           Each prediction dictionary should contain "window_index", "rf_prediction", and "xgb_prediction",
+                           and optionally "rf_confidence" and "xgb_confidence", or, for the per-device evaluation,
+                           "window_index" and the list of the predictions of each device ("activities").
+
+    :return: The number of files whose results were written.
     """
     output_file_path = os.path.join(output_evaluation_folder_path, f'evaluation_{main_folder_name}_{delta}_results.txt')
 
@@ -103,22 +397,50 @@ def write_window_results(output_evaluation_folder_path, main_folder_name, delta,
 
         file.write(f'Evaluation results for folder {main_folder_name} with delta = {delta}:\n\n')
 
+        files_written = 0
+
         # Iterate over each file and write the results for each window
-        for file_path, windows in window_results.items():
+        for file_path, windows in (window_results.items() if isinstance(window_results, dict) else window_results):
 
             # Get the file name
             file_name = file_path.split('/')[-1]
 
             file.write(f'File: {file_name}\n\n')
-            if not windows:
+            windows_written = 0
+
+            # The windows are classified while they are read, so only the writing of each window is timed
+            for window in windows:
+                with stage('write_results'):
+                    windows_written += 1
+                    _write_window(file, window)
+
+            if not windows_written:
                 file.write('\tNo valid windows were processed.\n')
-            else:
-                for window in windows:
-                    file.write(f'\tWindow {window["window_index"] + 1}:\n')
-                    file.write(f'\t\tStart Time (MDT): {window["start_time_mdt"]}\n')
-                    file.write(f'\t\tEnd Time (MDT): {window["end_time_mdt"]}\n\n')
-                    file.write(f'\t\tRandom Forest prediction: {window["rf_prediction"]}\n')
-                    file.write(f'\t\tXGBoost prediction: {window["xgb_prediction"]}\n')
             file.write('\n')
+            files_written += 1
 
         print(f'\n{Fore.GREEN}Results successfully written!{Style.RESET_ALL}')
+
+    return files_written
+
+
+# This function writes the predictions of a window
+def _write_window(file, window):
+    file.write(f'\tWindow {window["window_index"] + 1}:\n')
+    file.write(f'\t\tStart Time (MDT): {window["start_time_mdt"]}\n')
+    file.write(f'\t\tEnd Time (MDT): {window["end_time_mdt"]}\n\n')
+
+    if 'activities' not in window:
+        file.write(f'\t\tRandom Forest prediction: {window["rf_prediction"]}{_format_confidence(window.get("rf_confidence"))}\n')
+        file.write(f'\t\tXGBoost prediction: {window["xgb_prediction"]}{_format_confidence(window.get("xgb_confidence"))}\n')
+        return
+
+    for activity in window['activities']:
+        file.write(f'\t\t{activity["device"]}:\n')
+        file.write(f'\t\t\tRandom Forest prediction: {activity["rf_prediction"]}{_format_confidence(activity.get("rf_confidence"))}\n')
+        file.write(f'\t\t\tXGBoost prediction: {activity["xgb_prediction"]}{_format_confidence(activity.get("xgb_confidence"))}\n')
+
+
+# This function formats the confidence of a prediction, if available
+def _format_confidence(confidence):
+    return '' if confidence is None else f' (confidence: {confidence:.3f})'
@@ -0,0 +1,215 @@
+# This module evaluates the user scenarios with a pool of processes, sharding the work across the .pcapng files and,
+# within a large file, across time ranges. The results are the same as the ones of the serial evaluation.
+#
+# Each capture is split into shards of about evaluation_shard_size bytes, each starting at a packet record. A shard is
+# assigned the windows starting between its first packet and the first packet of the next shard, and reads past its
+# end until delta seconds after it, so the windows that cross the boundary get all their packets. The window starts
+# are accumulated from the first packet of the capture, as in the serial evaluation, so they are exactly the same.
+
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from colorama import Fore, Style
+from common_modules.instrumentation import count, run_with_metrics, merge_metrics
+from common_modules.model_registry import load_model, get_model_feature_columns
+from common_modules.packet_table import DevicePacketTableBuilder
+from common_modules.pcap_reader import read_capture, scan_capture_shards
+from common_modules.utilities import list_pcapng_files, convert_timestamp_to_mdt
+from evaluation_modules import evaluation_module
+from evaluation_modules.evaluation_utilities import iter_window_features
+
+# Define the approximate number of bytes of each time shard of a capture
+evaluation_shard_size = 64 * 1024 * 1024
+
+
+# This function prepares a worker process: the models are loaded once per worker, before its first shard
+def _initialize_worker(delta):
+    # The workers do not print the windows (they classify them with verbose=False): the results are printed and
+    # written by the main process. Anything else a worker prints, such as the error message before it exits, goes to
+    # the standard error, so that it is not mixed with the results but the cause of a failed shard is still shown.
+    sys.stdout = sys.stderr
+
+    load_model('rf', delta)
+    load_model('xgb', delta)
+
+
+# This function evaluates the user scenarios in parallel and yields the results of each file, in the order of the files
+def iter_parallel_user_scenarios(folder_path, delta, mode=None, workers=None, file_paths=None):
+    """
+    :param folder_path: The path to the evaluation set folder.
+    :param delta: The delta value used for the windows and to load the models.
+    :param mode: 'per-device' or 'merged' (default: evaluation_mode).
+    :param workers: number of worker processes (default: number of cores).
+    :param file_paths: the captures to evaluate (default: all the .pcapng files of the folder).
+
+    :return: A generator of tuples (file path, list of the predictions of the windows of the file).
+    """
+    mode = mode or evaluation_module.evaluation_mode
+    device_ip_addresses = evaluation_module.get_device_ip_addresses(evaluation_module.device_names)
+    pcapng_files = list_pcapng_files(folder_path) if file_paths is None else file_paths
+
+    if not pcapng_files:
+        print(f"{Fore.RED}No .pcapng files found in folder: {folder_path}{Style.RESET_ALL}")
+        return
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, initializer=_initialize_worker, initargs=(delta,)) as executor:
+        # All the shards of all the files are submitted at once, so that the workers are never idle between files
+        file_shards = [(file_path, _submit_file_shards(executor, file_path, device_ip_addresses, delta, mode)) for file_path in pcapng_files]
+
+        for file_path, futures in file_shards:
+            print(f'\n{Fore.BLUE}Evaluating file: {Style.RESET_ALL}{file_path} ({len(futures)} shards)')
+
+            # The metrics recorded by the workers are added to the ones of this process
+            shard_results = []
+            for future in futures:
+                shard_result, metrics = future.result()
+                merge_metrics(metrics)
+                shard_results.append(shard_result)
+
+            count('evaluation_files')
+            file_results = _merge_shard_results(shard_results, mode)
+            _print_file_results(file_results)
+
+            yield file_path, file_results
+
+
+# This function splits a capture into time shards and submits them to the pool
+def _submit_file_shards(executor, file_path, device_ip_addresses, delta, mode):
+    try:
+        shards = scan_capture_shards(file_path, evaluation_shard_size)
+
+        # The windows start at the first packet of the devices, as in the serial evaluation
+        first_packet = read_capture(file_path, device_ip_addresses, stop_filter=lambda packet_time: True)
+    except (ValueError, IndexError) as error:
+        print(f'{Fore.RED}\nERROR: unable to parse capture file {file_path}: {error}{Style.RESET_ALL}')
+        sys.exit(1)
+
+    if not len(first_packet):
+        print(f"{Fore.RED}No packets read from {file_path.split('/')[-1]}{Style.RESET_ALL}")
+        return []
+
+    # The packets of a window of a capture that is not in time order (e.g. a pcapng with several interfaces) can be in
+    # the byte range of any shard, so the capture is read as a single shard, sorted by timestamp
+    if not all(shard['in_order'] for shard in shards):
+        return [executor.submit(run_with_metrics, evaluate_capture_shard, file_path, None, None, None, None,
+                                device_ip_addresses, delta, mode)]
+
+    # Shards must cover increasing time ranges: a shard starting before the previous one is merged with it
+    time_shards = []
+    for shard in shards:
+        if not time_shards or shard['start_time'] > time_shards[-1]['start_time']:
+            time_shards.append(shard)
+
+    futures = []
+    for index, shard in enumerate(time_shards):
+        # The first shard starts at the beginning of the capture, the last one ends at its end
+        start_time = shard['start_time'] if index > 0 else None
+        stop_time = time_shards[index + 1]['start_time'] if index + 1 < len(time_shards) else None
+
+        futures.append(executor.submit(run_with_metrics, evaluate_capture_shard, file_path, shard if index > 0 else None, start_time, stop_time,
+                                       float(first_packet.time[0]), device_ip_addresses, delta, mode))
+
+    return futures
+
+
+# This function classifies the windows of a time shard of a capture
+def evaluate_capture_shard(file_path, shard, start_time, stop_time, origin, device_ip_addresses, delta, mode):
+    """
+    :param file_path: The path of the .pcapng file.
+    :param shard: the shard returned by scan_capture_shards (None to read from the beginning of the capture).
+    :param start_time: the windows starting before this time belong to the previous shards (None for the first shard).
+    :param stop_time: the windows starting at or after this time belong to the next shards (None for the last shard).
+    :param origin: start time of the first window of the capture (None: the time of the first packet read).
+    :param device_ip_addresses: list of IP addresses of the devices, in the order of device_names.
+    :param delta: The delta value used for the windows and to load the models.
+    :param mode: 'per-device' or 'merged'.
+
+    :return: tuple (number of windows with packets, list of the predictions of the windows), where the windows are
+             numbered from the first window of the shard in 'merged' mode and from the origin in 'per-device' mode.
+    """
+    overlap = evaluation_module.overlap
+    step = delta - overlap
+
+    # Accumulate the window starts from the origin, exactly as the serial evaluation does
+    window_start, position = origin, 0
+    while start_time is not None and window_start < start_time:
+        window_start += step
+        position += 1
+
+    # Read the packets of the shard and of the next delta seconds, needed by the windows crossing the end of the shard
+    stop_filter = None if stop_time is None else (lambda packet_time: packet_time >= stop_time + delta)
+    builder = DevicePacketTableBuilder(device_ip_addresses) if mode == 'per-device' else None
+    packets = read_capture(file_path, device_ip_addresses, stop_filter, builder, shard)
+
+    # The windows of all the devices start at the first packet of any of them, as in the serial evaluation
+    if origin is None:
+        tables = packets.values() if mode == 'per-device' else [packets]
+        window_start = min(float(table.time[0]) for table in tables if len(table))
+
+    # Only the features used by the models are computed
+    columns = get_model_feature_columns(delta)
+
+    if mode == 'per-device':
+        device_windows = [_iter_device_windows(packets[ip_address], ip_address, delta, window_start, stop_time, position, columns)
+                          for ip_address in device_ip_addresses]
+        device_results = [evaluation_module.classify_device_windows(windows, delta) for windows in device_windows]
+        file_results = evaluation_module.merge_device_results(device_results)
+        return len(file_results), file_results
+
+    windows = iter_window_features(packets, device_ip_addresses, delta, overlap, evaluation_module.feature_engine,
+                                   evaluation_module.batch_size, window_start, stop_time, columns)
+    pending_windows = []
+    windows_number = 0
+
+    for idx, (window, flow_features) in enumerate(windows):
+        windows_number += 1
+        count('windows')
+
+        if flow_features is None:
+            count('skipped_windows')
+        else:
+            pending_windows.append((idx, convert_timestamp_to_mdt(window['start_time']),
+                                    convert_timestamp_to_mdt(window['end_time']), flow_features))
+
+    file_results = []
+    for first in range(0, len(pending_windows), evaluation_module.batch_size):
+        file_results.extend(evaluation_module.classify_pending_windows(pending_windows[first:first + evaluation_module.batch_size], delta, verbose=False))
+
+    return windows_number, file_results
+
+
+# This function yields the windows of a device in a shard, numbered from the origin of the capture
+def _iter_device_windows(packets, ip_address, delta, window_start, stop_time, position, columns=None):
+    windows = iter_window_features(packets, [ip_address], delta, evaluation_module.overlap, evaluation_module.feature_engine,
+                                   evaluation_module.batch_size, window_start, stop_time, columns)
+
+    for window, flow_features in windows:
+        window['position'] += position
+        yield window, flow_features
+
+
+# This function merges the results of the shards of a file, numbering the windows as the serial evaluation does
+def _merge_shard_results(shard_results, mode):
+    file_results = []
+    windows_before = 0
+
+    for windows_number, results in shard_results:
+        # In 'merged' mode the windows are numbered by the windows with packets of the previous shards
+        if mode != 'per-device':
+            for result in results:
+                result['window_index'] += windows_before
+        windows_before += windows_number
+        file_results.extend(results)
+
+    return file_results
+
+
+# This function prints the predictions of the windows of a file
+def _print_file_results(file_results):
+    for window in file_results:
+        print(f"\nWindow {window['window_index'] + 1}: {Fore.YELLOW}{window['start_time_mdt']} - {window['end_time_mdt']}{Style.RESET_ALL}")
+
+        for activity in window.get('activities', [window]):
+            device = f"{activity['device']} " if 'device' in activity else ''
+            print(f"{Fore.YELLOW}{device}Random Forest prediction: {Style.RESET_ALL}{activity['rf_prediction']}")
+            print(f"{Fore.YELLOW}{device}XGBoost prediction: {Style.RESET_ALL}{activity['xgb_prediction']}")
@@ -0,0 +1,340 @@
+# This module classifies the device activities continuously, while the packets are captured.
+# The packets are read from a growing .pcapng / .pcap file or from the standard input (e.g. piped from tcpdump),
+# and the windows are classified as soon as they are complete.
+#
+# Usage (from the project root, with the trained models of the chosen delta in rf_models/ and xgb_models/):
+#   python -m evaluation_modules.stream_classifier capture.pcapng --delta 5
+#   tcpdump -i eth0 -U -w - | python -m evaluation_modules.stream_classifier - --delta 5
+
+import sys
+import time
+import argparse
+from collections import deque
+import numpy as np
+from colorama import Fore, Style
+from common_modules.model_registry import load_model, get_model_feature_columns
+from common_modules.packet_table import PacketTable, ip_to_int
+from common_modules.pcap_reader import CaptureParser
+from common_modules.utilities import convert_timestamp_to_mdt
+from evaluation_modules.evaluation_module import overlap, device_names, evaluation_mode, get_device_ip_addresses, \
+    classify_pending_windows, merge_device_results
+from evaluation_modules.evaluation_utilities import compute_window_flow_features
+
+# Define the number of bytes read from the capture at a time
+chunk_size = 1 << 16
+
+# Define the time in seconds between two checks of a growing capture file for new packets
+poll_interval = 0.2
+
+# Define the number of recent latencies kept to compute the latency percentiles
+latency_history = 10000
+
+
+class StreamClassifier:
+    """
+    Classifies the windows of a packet stream as soon as they are complete. A window [start, start + delta) is complete
+    when a packet captured after its end is received, so the windows and their predictions are the same as the ones of
+    evaluate_user_scenarios on the complete capture. Only the packets of the current window are kept in a ring buffer,
+    so memory stays bounded however long the stream is.
+    In 'per-device' mode, the packets are demultiplexed into one ring buffer per device, as DevicePacketTableBuilder
+    does, and the windows of all the devices start at the first packet of the stream, as in evaluate_device_streams:
+    each result lists the activities of the devices active in the window.
+    """
+
+    def __init__(self, device_ip_addresses, delta, overlap=2, on_result=None, verbose=True, mode=None, names=None):
+        """
+        :param device_ip_addresses: list of IP addresses of the devices to be filtered.
+        :param delta: duration of each window in seconds.
+        :param overlap: overlapping time between windows in seconds (default: 2).
+        :param on_result: optional function called with the result dictionary of each classified window.
+        :param verbose: if True, the windows and their predictions are printed.
+        :param mode: 'per-device' or 'merged' (default: evaluation_mode).
+        :param names: the names of the devices, in the order of their IP addresses (default: device_names).
+        """
+
+        # Ensure delta is greater than overlap
+        if delta <= overlap:
+            print(f"\n{Fore.RED}ERROR: Delta must be greater than the overlap value to avoid infinite loops!{Style.RESET_ALL}")
+            sys.exit(1)
+
+        self.device_ip_addresses = device_ip_addresses
+        self.delta = delta
+        self.step = delta - overlap
+        self.on_result = on_result
+        self.verbose = verbose
+        self.mode = mode or evaluation_mode
+        self.names = names or device_names
+
+        # The parser appends the packets of the devices to this object (see append)
+        self.parser = CaptureParser(device_ip_addresses, builder=self)
+        self.pending_bytes = bytearray()
+
+        # Packets of the current window of each stream (all the devices, or each device): list of tuples
+        # (IP addresses of the stream, deque of tuples (timestamp, length, source, destination, arrival time))
+        # and, in 'per-device' mode, the dictionary mapping the IP address of each device (as an integer) to its deque
+        if self.mode == 'per-device':
+            self.streams = [([ip_address], deque()) for ip_address in device_ip_addresses]
+            self.device_streams = {ip_to_int(ip_address): packets for [ip_address], packets in self.streams}
+        else:
+            self.streams = [(device_ip_addresses, deque())]
+            self.device_streams = None
+        self.arrival_time = None
+        self.last_timestamp = None
+
+        # Index of the current window (the number of steps from the origin in 'per-device' mode,
+        # the number of windows with packets in 'merged' mode, as in evaluate_user_scenarios)
+        self.window_start = None
+        self.window_index = 0
+
+        # Latency between the arrival of the packet that completes a window and its prediction
+        self.latencies = deque(maxlen=latency_history)
+        self.windows_classified = 0
+        self.packets_received = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    # This method receives the packets of the devices from the capture parser
+    def append(self, timestamp, length, src, dst):
+        if self.window_start is None:
+            self.window_start = timestamp
+
+        packet = (timestamp, length, src, dst, self.arrival_time)
+
+        if self.device_streams is None:
+            self.streams[0][1].append(packet)
+        else:
+            # A packet exchanged between two of the devices belongs to both streams, as in DevicePacketTableBuilder
+            packets = self.device_streams.get(src)
+            if packets is not None:
+                packets.append(packet)
+
+            packets = self.device_streams.get(dst)
+            if packets is not None and dst != src:
+                packets.append(packet)
+
+        self.last_timestamp = timestamp
+        self.packets_received += 1
+
+    # This method parses the received bytes and classifies the windows completed by the new packets
+    def feed(self, data):
+        """
+        :param data: the bytes received from the capture.
+        :return: the list of results of the classified windows.
+        """
+        self.arrival_time = time.perf_counter()
+
+        self.pending_bytes += data
+        parsed_bytes = self.parser.parse(self.pending_bytes)
+        del self.pending_bytes[:parsed_bytes]
+
+        return self._classify_complete_windows(final=False)
+
+    # This method classifies the remaining windows at the end of the stream
+    def finish(self):
+        return self._classify_complete_windows(final=True)
+
+    # This method classifies the windows that cannot receive more packets
+    def _classify_complete_windows(self, final):
+        # Valid windows waiting to be classified, for each stream
+        pending_windows = [[] for _ in self.streams]
+        arrival_times = {}
+
+        while self.window_start is not None and self.window_start <= self.last_timestamp:
+            window_end = self.window_start + self.delta
+
+            # A window is complete once a packet captured after its end was received (or at the end of the stream)
+            if not final and self.last_timestamp < window_end:
+                break
+
+            has_packets = False
+
+            for stream_windows, (ip_addresses, packets) in zip(pending_windows, self.streams):
+                window_packets = list(self._iter_window_packets(packets, window_end))
+
+                # Windows without packets are skipped, as in iter_windows
+                if window_packets:
+                    has_packets = True
+                    pending_window = self._prepare_window(window_packets, window_end, ip_addresses)
+                    if pending_window is not None:
+                        stream_windows.append(pending_window)
+                        arrival_times[self.window_index] = self._closing_arrival_time(window_end)
+
+            if has_packets or self.device_streams is not None:
+                self.window_index += 1
+
+            # Move to the next window and drop the packets that are before it
+            self.window_start += self.step
+            for _, packets in self.streams:
+                while packets and packets[0][0] < self.window_start:
+                    packets.popleft()
+
+        if not any(pending_windows):
+            return []
+
+        if self.device_streams is None:
+            results = classify_pending_windows(pending_windows[0], self.delta, self.verbose)
+        else:
+            device_results = [classify_pending_windows(stream_windows, self.delta, verbose=False) if stream_windows else []
+                              for stream_windows in pending_windows]
+            results = merge_device_results(device_results, self.names, self.verbose)
+        prediction_time = time.perf_counter()
+
+        for result in results:
+            self._record_latency(result, prediction_time - arrival_times[result['window_index']])
+
+            if self.on_result is not None:
+                self.on_result(result)
+
+        return results
+
+    # This method yields the buffered packets of a stream in the window ending at window_end
+    def _iter_window_packets(self, packets, window_end):
+        for packet in packets:
+            if packet[0] >= window_end:
+                break
+            yield packet
+
+    # This method returns the window of a stream to classify, or None if the window is not valid
+    def _prepare_window(self, window_packets, window_end, ip_addresses):
+        idx = self.window_index
+        # The windows of the devices are printed with their activities, once classified (see merge_device_results)
+        verbose = self.verbose and self.device_streams is None
+        timestamps, lengths, sources, destinations, _ = zip(*window_packets)
+        window = PacketTable(np.array(timestamps, dtype=np.float64), np.array(lengths, dtype=np.uint32),
+                             np.array(sources, dtype=np.uint32), np.array(destinations, dtype=np.uint32))
+
+        # Convert window start and end times to MDT format
+        start_mdt = convert_timestamp_to_mdt(self.window_start)
+        end_mdt = convert_timestamp_to_mdt(window_end)
+
+        if verbose:
+            print(f"\nProcessing window {idx + 1}\n")
+            print(f"{Fore.YELLOW}Window start time: {Style.RESET_ALL}{start_mdt}")
+            print(f"{Fore.YELLOW}Window end time: {Style.RESET_ALL}{end_mdt}")
+
+        # Only the features used by the models are computed
+        flow_features = compute_window_flow_features(window, ip_addresses, get_model_feature_columns(self.delta))
+
+        if flow_features is None:
+            if verbose:
+                print(f"{Fore.RED}Window {idx + 1} is not valid!\nNo incoming or outgoing packets to analyze!{Style.RESET_ALL}")
+            return None
+
+        return idx, start_mdt, end_mdt, flow_features
+
+    # This method returns the arrival time of the first packet after the window (the last packet at the end of the stream)
+    def _closing_arrival_time(self, window_end):
+        closing_times = [next((packet[4] for packet in packets if packet[0] >= window_end), None) for _, packets in self.streams]
+        closing_times = [arrival_time for arrival_time in closing_times if arrival_time is not None]
+
+        if closing_times:
+            return min(closing_times)
+        return max(packets[-1][4] for _, packets in self.streams if packets)
+
+    # This method records the latency of a classified window
+    def _record_latency(self, result, latency):
+        result['latency'] = latency
+
+        self.latencies.append(latency)
+        self.windows_classified += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+        if self.verbose:
+            print(f'{Fore.YELLOW}Window {result["window_index"] + 1} latency: {Style.RESET_ALL}{latency * 1000:.1f} ms')
+
+    # This method returns the latency statistics of the classified windows
+    def latency_report(self):
+        """
+        :return: dictionary with the number of received packets and classified windows and the mean, median,
+                 95th percentile and maximum latency in seconds (percentiles of the most recent windows).
+        """
+        if not self.windows_classified:
+            return {'packets': self.packets_received, 'windows': 0}
+
+        return {
+            'packets': self.packets_received,
+            'windows': self.windows_classified,
+            'mean': self.total_latency / self.windows_classified,
+            'median': float(np.percentile(self.latencies, 50)),
+            'p95': float(np.percentile(self.latencies, 95)),
+            'max': self.max_latency
+        }
+
+
+# This function streams a capture into the classifier until the end of the stream
+def stream_capture(source, classifier, follow=True):
+    """
+    Reads the capture in chunks and feeds them to the classifier.
+
+    :param source: binary file object of the capture (a regular file or a pipe).
+    :param classifier: the StreamClassifier.
+    :param follow: if True, keep waiting for new packets at the end of the file, as 'tail -f' does
+                   (a pipe always ends when the writer closes it).
+    """
+    read = getattr(source, 'read1', source.read)
+
+    try:
+        while True:
+            data = read(chunk_size)
+
+            if data:
+                classifier.feed(data)
+            elif follow and source.seekable():
+                time.sleep(poll_interval)
+            else:
+                break
+    except KeyboardInterrupt:
+        print(f'\n{Fore.YELLOW}Stream interrupted{Style.RESET_ALL}')
+    except (ValueError, IndexError) as error:
+        print(f'{Fore.RED}\nERROR: Invalid capture stream: {Style.RESET_ALL}{error}')
+        sys.exit(1)
+
+    classifier.finish()
+
+
+# This function prints the latency statistics of the stream
+def print_latency_report(report):
+    print(f'\n{Fore.MAGENTA}Packets received: {Style.RESET_ALL}{report["packets"]}')
+    print(f'{Fore.MAGENTA}Windows classified: {Style.RESET_ALL}{report["windows"]}')
+
+    if report['windows']:
+        print(f'{Fore.MAGENTA}Latency from packet arrival to prediction: {Style.RESET_ALL}'
+              f'mean = {report["mean"] * 1000:.1f} ms, median = {report["median"] * 1000:.1f} ms, '
+              f'p95 = {report["p95"] * 1000:.1f} ms, max = {report["max"] * 1000:.1f} ms')
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Classify the device activities of a live capture.')
+    parser.add_argument('capture', nargs='?', default='-', help='growing .pcapng / .pcap file, or - to read from the standard input (default)')
+    parser.add_argument('--delta', type=float, default=5, help='window duration in seconds, used to load the models (default: 5)')
+    parser.add_argument('--overlap', type=float, default=overlap, help=f'overlap between windows in seconds (default: {overlap})')
+    parser.add_argument('--devices', nargs='+', default=device_names, help='names of the devices to classify')
+    parser.add_argument('--evaluation-mode', choices=['per-device', 'merged'], default=evaluation_mode,
+                        help=f'classify the windows of each device or of all the devices together (default: {evaluation_mode})')
+    parser.add_argument('--no-follow', action='store_true', help='stop at the end of the file instead of waiting for new packets')
+    arguments = parser.parse_args(arguments)
+
+    # Models are saved with the delta in their file name (e.g. 5, not 5.0)
+    delta = int(arguments.delta) if float(arguments.delta).is_integer() else arguments.delta
+
+    classifier = StreamClassifier(get_device_ip_addresses(arguments.devices), delta, arguments.overlap,
+                                  mode=arguments.evaluation_mode, names=arguments.devices)
+
+    # Load the models before the first packet arrives, so that loading them does not delay the first predictions
+    load_model('rf', delta)
+    load_model('xgb', delta)
+
+    print(f'\n{Fore.BLUE}Classifying packets from: {Style.RESET_ALL}{"standard input" if arguments.capture == "-" else arguments.capture}')
+
+    if arguments.capture == '-':
+        stream_capture(sys.stdin.buffer, classifier, follow=False)
+    else:
+        with open(arguments.capture, 'rb') as capture:
+            stream_capture(capture, classifier, follow=not arguments.no_follow)
+
+    print_latency_report(classifier.latency_report())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,21 @@
 import os
 import sys
 from colorama import Fore, Style
+from common_modules.instrumentation import stage, emit_metrics_summary
+from common_modules.model_registry import get_model_path
 from sklearn.model_selection import train_test_split
-from evaluation_modules.evaluation_module import evaluate_user_scenarios
+from evaluation_modules.evaluation_module import iter_user_scenarios
 from evaluation_modules.evaluation_utilities import write_window_results
-from training_test_modules.classifier_module import train_and_test_rf_classifier, train_and_test_xgb_classifier
-from training_test_modules.dataset_formatter import read_training_files
+from training_test_modules.classifier_module import train_and_test_classifiers, write_training_results
+from training_test_modules.dataset_formatter import read_training_files_multi_delta
 
 # Define the delta value
 # The delta value is the time window used to split the packets into smaller windows for analysis.
 delta = 5
 
-# Get dataset folder path from command line
-if len(sys.argv) < 2:
-    print(f'\n{Fore.RED}ERROR: You must provide the dataset folder path as a command line argument!{Style.RESET_ALL}')
-    print(f'{Fore.YELLOW}Usage: python {sys.argv[0]} <dataset folder path>{Style.RESET_ALL}')
-    sys.exit(1)
-
-# Dataset folder path and name
-main_folder_path = str(sys.argv[1])
-main_folder_name = main_folder_path.split('/')[-1]
-
-# Define folder paths for training and output
-training_folder_path = os.path.join(main_folder_path, 'training - test set')
-output_training_folder_path = os.path.join(training_folder_path, 'classification_results')
-
-# Define model file paths in their respective folders
-rf_model_path = os.path.join('rf_models', f'trained_rf_classifier_{delta}.pkl')
-xgb_model_path = os.path.join('xgb_models', f'trained_xgb_classifier_{delta}.pkl')
+# Define the delta values for which a model is trained (e.g. [20, 10, 5, 1] to sweep several values)
+# Each training capture is read only once for all the delta values; the models of 'delta' are used for the evaluation.
+training_deltas = [delta]
 
 # General function to ask the user a yes/no question
 def ask_user(question):
@@ -47,92 +35,113 @@ def ask_for_retraining():
     return ask_user("Pre-trained models found! Do you want to retrain the models?")
 
 # Function to perform training and writing of results
-def run_training():
+def run_training(training_folder_path, output_training_folder_path, main_folder_name):
     # Start the analysis of the training dataset
     print(
-        f'\n{Fore.CYAN}No models found!{Style.RESET_ALL}\n\n{Fore.YELLOW}Starting analysis for folder: {Style.RESET_ALL}{main_folder_name}{Fore.YELLOW} with{Style.RESET_ALL} delta = {delta}')
+        f'\n{Fore.CYAN}No models found!{Style.RESET_ALL}\n\n{Fore.YELLOW}Starting analysis for folder: {Style.RESET_ALL}{main_folder_name}{Fore.YELLOW} with{Style.RESET_ALL} delta = {", ".join(map(str, training_deltas))}')
 
-    # Read data from dataset (The same dataset is used to train and test the model)
-    X, y = read_training_files(training_folder_path, f'{main_folder_name}/training - test set', delta)
+    # Read data from dataset for all the delta values at once (The same dataset is used to train and test the model)
+    with stage('read_training_set'):
+        datasets = read_training_files_multi_delta(training_folder_path, f'{main_folder_name}/training - test set', training_deltas)
+
+    # Train, test and save the models of each delta value
+    for training_delta, (X, y) in datasets.items():
+        run_training_for_delta(X, y, training_delta, output_training_folder_path, main_folder_name)
 
-    # Split the dataset into training and testing set
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.25, random_state=None)
 
-    # Train and evaluate the Random Forest classifier
-    print(f'\n{Fore.MAGENTA}Training and testing the Random Forest classifier...{Style.RESET_ALL}')
-    accuracyRF, reportRF = train_and_test_rf_classifier(X_train, y_train, X_test, y_test, delta)
-    print(f'\n{Fore.GREEN}Model successfully trained and tested!{Style.RESET_ALL}')
+# Function to train and test the models of a delta value and write the results
+def run_training_for_delta(X, y, training_delta, output_training_folder_path, main_folder_name):
+    print(f'\n{Fore.YELLOW}Training the models with delta = {Style.RESET_ALL}{training_delta}')
 
-    # Train and evaluate the XGBoost classifier
-    print(f'\n{Fore.MAGENTA}Training and evaluating the XGBoost classifier...{Style.RESET_ALL}')
-    accuracyXGB, reportXGB = train_and_test_xgb_classifier(X_train, y_train, X_test, y_test, delta)
-    print(f'\n{Fore.GREEN}Model successfully trained and tested!{Style.RESET_ALL}')
+    # Split the dataset into training and testing set
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.25, random_state=None)
 
-    # Create the output folder if it doesn't exist
-    os.makedirs(output_training_folder_path, exist_ok=True)
+    # Train and evaluate the Random Forest and XGBoost classifiers at the same time
+    print(f'\n{Fore.MAGENTA}Training and testing the Random Forest and XGBoost classifiers...{Style.RESET_ALL}')
+    with stage('train_and_test'):
+        results = train_and_test_classifiers(X_train, y_train, X_test, y_test, training_delta)
+    print(f'\n{Fore.GREEN}Models successfully trained and tested!{Style.RESET_ALL}')
 
     # Write results to the output file
-    with open(f'{output_training_folder_path}/training_{main_folder_name}_{delta}_results.txt', 'w') as file:
-        print(f'\n{Fore.YELLOW}Writing results for folder: {Style.RESET_ALL}{main_folder_name}/training - test set')
+    write_training_results(output_training_folder_path, main_folder_name, training_delta, results)
 
-        # Write results to file
-        file.write(f'Results for folder {main_folder_name} are:\n')
-        file.write(f'\nRandom Forest Accuracy: {accuracyRF:.3f}\n')
-        file.write(f'\nRandom Forest Classification Report: \n\n{reportRF}\n\n')
 
-        file.write(f'\nXGBoost Accuracy: {accuracyXGB:.3f}\n')
-        file.write(f'\nXGBoost Classification Report: \n\n{reportXGB}')
+# The pool processes of the training and of the parallel evaluation import this module again when they are started
+# with the 'spawn' method (the default on macOS and Windows), so the pipeline only runs from the main process
+def main():
+    # Get dataset folder path from command line
+    if len(sys.argv) < 2:
+        print(f'\n{Fore.RED}ERROR: You must provide the dataset folder path as a command line argument!{Style.RESET_ALL}')
+        print(f'{Fore.YELLOW}Usage: python {sys.argv[0]} <dataset folder path>{Style.RESET_ALL}')
+        sys.exit(1)
 
-        print(f'\n{Fore.GREEN}Results successfully written!{Style.RESET_ALL}')
+    # Dataset folder path and name
+    main_folder_path = str(sys.argv[1])
+    main_folder_name = main_folder_path.split('/')[-1]
+
+    # Define folder paths for training and output
+    training_folder_path = os.path.join(main_folder_path, 'training - test set')
+    output_training_folder_path = os.path.join(training_folder_path, 'classification_results')
+
+    # Define model file paths in their respective folders
+    rf_model_path = get_model_path('rf', delta)
+    xgb_model_path = get_model_path('xgb', delta)
+
+    # Variables to decide if training and evaluation should be performed
+    perform_training = False
+    perform_evaluation = False
+
+    # Check if the model files already exist
+    if os.path.exists(rf_model_path) and os.path.exists(xgb_model_path):
+        # Ask the user if they want to retrain the models
+        if ask_for_retraining():
+            perform_training = True
+        else:
+            print(f'\n{Fore.GREEN}Using pre-trained models!{Style.RESET_ALL}')
+    else:
+        # If models do not exist, training starts automatically
+        perform_training = True
 
+    # Run training if required
+    if perform_training:
+        run_training(training_folder_path, output_training_folder_path, main_folder_name)
 
-# Variables to decide if training and evaluation should be performed
-perform_training = False
-perform_evaluation = False
+    # Ask the user if they want to perform model evaluation
+    if ask_for_evaluation():
+        perform_evaluation = True
 
-# Check if the model files already exist
-if os.path.exists(rf_model_path) and os.path.exists(xgb_model_path):
-    # Ask the user if they want to retrain the models
-    if ask_for_retraining():
-        perform_training = True
-    else:
-        print(f'\n{Fore.GREEN}Using pre-trained models!{Style.RESET_ALL}')
-else:
-    # If models do not exist, training starts automatically
-    perform_training = True
+    # If evaluation is requested, perform analysis on the evaluation set
+    if perform_evaluation:
 
-# Run training if required
-if perform_training:
-    run_training()
+        evaluation_folder_path = os.path.join(main_folder_path, 'evaluation set')
 
-# Ask the user if they want to perform model evaluation
-if ask_for_evaluation():
-    perform_evaluation = True
+        if not os.path.exists(evaluation_folder_path):
+            print(f'\n{Fore.RED}Evaluation folder not found: {evaluation_folder_path}{Style.RESET_ALL}')
+            sys.exit(1)
 
-# If evaluation is requested, perform analysis on the evaluation set
-if perform_evaluation:
+        # Create test set folder
+        output_evaluation_folder_path = os.path.join(evaluation_folder_path, 'evaluation_results')
 
-    evaluation_folder_path = os.path.join(main_folder_path, 'evaluation set')
+        # Create the output folder if it doesn't exist
+        os.makedirs(output_evaluation_folder_path, exist_ok=True)
 
-    if not os.path.exists(evaluation_folder_path):
-        print(f'\n{Fore.RED}Evaluation folder not found: {evaluation_folder_path}{Style.RESET_ALL}')
-        sys.exit(1)
+        print(f'\n{Fore.YELLOW}Starting evaluation for folder:{Style.RESET_ALL} {main_folder_name}{Fore.YELLOW} with delta = {Style.RESET_ALL}{delta}')
+        classification_results = iter_user_scenarios(evaluation_folder_path, delta)
 
-    # Create test set folder
-    output_evaluation_folder_path = os.path.join(evaluation_folder_path, 'evaluation_results')
+        # The windows are classified while their results are written, so the results of long captures are never held in memory
+        with stage('evaluation'):
+            files_written = write_window_results(output_evaluation_folder_path, main_folder_name, delta, classification_results)
 
-    # Create the output folder if it doesn't exist
-    os.makedirs(output_evaluation_folder_path, exist_ok=True)
+        if not files_written:
+            print(f'\n{Fore.RED}No classification results available!{Style.RESET_ALL}')
+        else:
+            print(f'\n{Fore.GREEN}Evaluation successfully completed!{Style.RESET_ALL}')
+    else:
+        print(f'\n{Fore.GREEN}Operation finished without model evaluation.{Style.RESET_ALL}')
 
-    print(f'\n{Fore.YELLOW}Starting evaluation for folder:{Style.RESET_ALL} {main_folder_name}{Fore.YELLOW} with delta = {Style.RESET_ALL}{delta}')
-    classification_results = evaluate_user_scenarios(evaluation_folder_path, delta)
+    # Write the metrics of the run, if they are enabled (see common_modules/instrumentation.py)
+    emit_metrics_summary('main')
 
-    print(f'\n{Fore.GREEN}Evaluation successfully completed!{Style.RESET_ALL}')
 
-    if classification_results == {} or classification_results is None:
-        print(f'\n{Fore.RED}No classification results available!{Style.RESET_ALL}')
-    else:
-        # Write evaluation results to the output file
-        write_window_results(output_evaluation_folder_path, main_folder_name, delta, classification_results)
-else:
-    print(f'\n{Fore.GREEN}Operation finished without model evaluation.{Style.RESET_ALL}')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+# This script runs the pipeline without any prompt, configured by a JSON file and / or command line arguments, so that
+# it can be scheduled (e.g. a nightly retraining). A checkpoint is saved after each stage (training features, trained
+# models of each delta value, evaluation results of each capture): when a run is interrupted, running the same
+# command again resumes from the last completed stage or capture. A checkpoint is reused only while its inputs
+# (dataset files, delta values, feature schema, models, evaluation settings) are unchanged.
+#
+# Usage:
+#   python pipeline_runner.py --dataset ./dataset --delta 5 --stages features training evaluation
+#   python pipeline_runner.py --config nightly.json
+# where nightly.json contains any of the options, e.g. {"dataset": "./dataset", "training_deltas": [10, 5], "training_workers": 8}
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import numpy as np
+from colorama import Fore, Style
+from sklearn.model_selection import train_test_split
+from common_modules.feature_extraction import feature_schema_id
+from common_modules.instrumentation import stage, emit_metrics_summary
+from common_modules.model_registry import get_model_path
+from common_modules.utilities import list_pcapng_files
+import evaluation_modules.evaluation_module as evaluation_module
+from evaluation_modules.evaluation_utilities import write_window_results
+import training_test_modules.classifier_module as classifier_module
+from training_test_modules.dataset_formatter import read_training_files_multi_delta
+
+# Define the stages of the pipeline, in the order in which they run
+pipeline_stages = ['features', 'training', 'evaluation']
+
+# Define the name of the checkpoint state file, saved in the checkpoint folder
+checkpoint_file_name = 'checkpoint.json'
+
+# Define the default options (the keys of the configuration file)
+default_options = {
+    'dataset': None,
+    'delta': 5,
+    'training_deltas': None,
+    'overlap': evaluation_module.overlap,
+    'stages': pipeline_stages,
+    'training_workers': None,
+    'training_cores': classifier_module.training_cores,
+    'retrain_mode': classifier_module.retrain_mode,
+    'feature_selection': classifier_module.feature_selection,
+    'evaluation_mode': evaluation_module.evaluation_mode,
+    'evaluation_workers': evaluation_module.evaluation_workers,
+    'device_workers': evaluation_module.device_workers,
+    'test_size': 0.25,
+    'checkpoint_dir': None,
+    'restart': False
+}
+
+
+class Checkpoint:
+    """
+    State of the completed stages, saved as JSON in the checkpoint folder after every step. Each entry stores the key
+    of the inputs it was computed from, and is ignored when the key changes.
+    """
+
+    def __init__(self, checkpoint_dir, restart=False):
+        """
+        :param checkpoint_dir: the folder of the checkpoint (created if it does not exist).
+        :param restart: if True, the previous checkpoint is ignored and overwritten.
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.state_path = os.path.join(checkpoint_dir, checkpoint_file_name)
+        self.state = {}
+
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        if not restart and os.path.exists(self.state_path):
+            try:
+                with open(self.state_path) as file:
+                    self.state = json.load(file)
+            except ValueError:
+                print(f'{Fore.YELLOW}Invalid checkpoint, starting from scratch: {Style.RESET_ALL}{self.state_path}')
+
+    # This method returns the value saved for the given step if it was computed from the same inputs, or None
+    def get(self, step, key):
+        entry = self.state.get(step)
+        return entry['value'] if entry is not None and entry['key'] == key else None
+
+    # This method saves the value of a completed step
+    def put(self, step, key, value):
+        self.state[step] = {'key': key, 'value': value}
+
+        # Written to a temporary file first, so that an interrupted write never corrupts the checkpoint
+        temporary_path = self.state_path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump(self.state, file, indent=2)
+        os.replace(temporary_path, self.state_path)
+
+    # This method returns the path of a file stored in the checkpoint folder
+    def path(self, file_name):
+        return os.path.join(self.checkpoint_dir, file_name)
+
+
+# This function returns a key identifying the given inputs
+def compute_key(*inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# This function returns the (path, size, modification time) stamps of the given files
+def file_stamps(file_paths):
+    stamps = []
+    for file_path in sorted(file_paths):
+        file_stat = os.stat(file_path)
+        stamps.append((file_path, file_stat.st_size, file_stat.st_mtime_ns))
+    return stamps
+
+
+# This function returns the captures and timestamp files of the training set, without the results written in it
+def list_training_inputs(training_folder_path):
+    input_files = []
+
+    for root, dirs, files in os.walk(training_folder_path):
+        dirs[:] = [directory for directory in dirs if directory != 'classification_results']
+        input_files.extend(os.path.join(root, file_name) for file_name in files if file_name.endswith(('.pcapng', '.txt')))
+
+    return input_files
+
+
+# This function reads the features of the training set, or loads them from the checkpoint
+def run_features_stage(options, checkpoint, training_folder_path, main_folder_name, training_deltas):
+    """
+    :return: a dictionary mapping each delta value to a tuple (X, y), and the key of the features.
+    """
+    key = compute_key(file_stamps(list_training_inputs(training_folder_path)), training_deltas, feature_schema_id)
+    saved_files = checkpoint.get('features', key)
+
+    if saved_files is not None and all(os.path.exists(checkpoint.path(file_name)) for file_name in saved_files.values()):
+        print(f'\n{Fore.GREEN}Training features loaded from the checkpoint{Style.RESET_ALL}')
+        datasets = {}
+        for delta in training_deltas:
+            with np.load(checkpoint.path(saved_files[str(delta)])) as arrays:
+                datasets[delta] = (arrays['X'], arrays['y'])
+        return datasets, key
+
+    print(f'\n{Fore.YELLOW}Reading the training set for delta = {Style.RESET_ALL}{", ".join(map(str, training_deltas))}')
+
+    with stage('read_training_set'):
+        datasets = read_training_files_multi_delta(training_folder_path, f'{main_folder_name}/training - test set',
+                                                   training_deltas, options['training_workers'])
+
+    saved_files = {}
+    for delta, (X, y) in datasets.items():
+        saved_files[str(delta)] = f'features_{delta}.npz'
+        np.savez(checkpoint.path(saved_files[str(delta)]), X=X, y=y)
+    checkpoint.put('features', key, saved_files)
+
+    return datasets, key
+
+
+# This function trains and tests the models of each delta value, skipping the ones already trained from the same features
+def run_training_stage(options, checkpoint, datasets, features_key, output_training_folder_path, main_folder_name):
+    classifier_module.retrain_mode = options['retrain_mode']
+    classifier_module.training_cores = options['training_cores']
+    classifier_module.feature_selection = options['feature_selection']
+
+    for delta, (X, y) in datasets.items():
+        step = f'training_{delta}'
+        key = compute_key(features_key, options['retrain_mode'], options['test_size'], options['feature_selection'])
+        trained = checkpoint.get(step, key)
+
+        # The models of the checkpoint must still be the ones trained in that step
+        if trained is not None and trained == _model_stamps(delta):
+            print(f'\n{Fore.GREEN}Models with delta = {delta} already trained, skipping{Style.RESET_ALL}')
+            continue
+
+        print(f'\n{Fore.YELLOW}Training the models with delta = {Style.RESET_ALL}{delta}')
+
+        # Split the dataset into training and testing set
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=options['test_size'], random_state=None)
+
+        with stage('train_and_test'):
+            results = classifier_module.train_and_test_classifiers(X_train, y_train, X_test, y_test, delta)
+        print(f'\n{Fore.GREEN}Models successfully trained and tested!{Style.RESET_ALL}')
+
+        classifier_module.write_training_results(output_training_folder_path, main_folder_name, delta, results)
+        checkpoint.put(step, key, _model_stamps(delta))
+
+
+# This function returns the stamps of the model files of a delta value (None if a model is missing)
+def _model_stamps(delta):
+    model_paths = [get_model_path(classifier_type, delta) for classifier_type in ('rf', 'xgb')]
+
+    if not all(os.path.exists(model_path) for model_path in model_paths):
+        return None
+
+    return [list(stamp) for stamp in file_stamps(model_paths)]
+
+
+# This function evaluates the captures of the evaluation set, skipping the ones already evaluated with the same settings
+def run_evaluation_stage(options, checkpoint, evaluation_folder_path, main_folder_name):
+    delta = options['delta']
+    model_stamps = _model_stamps(delta)
+
+    if model_stamps is None:
+        print(f'\n{Fore.RED}ERROR: No trained models found for delta = {delta}: run the training stage first!{Style.RESET_ALL}')
+        sys.exit(1)
+
+    if not os.path.exists(evaluation_folder_path):
+        print(f'\n{Fore.RED}Evaluation folder not found: {evaluation_folder_path}{Style.RESET_ALL}')
+        sys.exit(1)
+
+    evaluation_module.overlap = options['overlap']
+    evaluation_module.device_workers = options['device_workers']
+
+    # The results of each capture are stored in their own file, so that a capture is never evaluated twice
+    os.makedirs(checkpoint.path('evaluation'), exist_ok=True)
+    settings = (delta, options['overlap'], options['evaluation_mode'], model_stamps, evaluation_module.device_names)
+
+    pcapng_files = sorted(list_pcapng_files(evaluation_folder_path))
+    file_keys = {file_path: compute_key(file_stamps([file_path]), settings) for file_path in pcapng_files}
+    results_files = {file_path: checkpoint.get(f'evaluation:{file_path}', file_keys[file_path]) for file_path in pcapng_files}
+
+    missing_files = [file_path for file_path in pcapng_files
+                     if results_files[file_path] is None or not os.path.exists(checkpoint.path(results_files[file_path]))]
+
+    if len(missing_files) < len(pcapng_files):
+        print(f'\n{Fore.GREEN}Evaluation results of {len(pcapng_files) - len(missing_files)} captures loaded from the checkpoint{Style.RESET_ALL}')
+
+    if missing_files:
+        print(f'\n{Fore.YELLOW}Starting evaluation for folder:{Style.RESET_ALL} {main_folder_name}{Fore.YELLOW} with delta = {Style.RESET_ALL}{delta}')
+
+        scenarios = evaluation_module.iter_user_scenarios(evaluation_folder_path, delta, options['evaluation_mode'],
+                                                          options['evaluation_workers'], missing_files)
+
+        with stage('evaluation'):
+            for file_path, windows in scenarios:
+                results_file = f'evaluation/{os.path.basename(file_path)}.json'
+
+                # The results of the capture are saved only once all its windows are classified
+                with open(checkpoint.path(results_file) + '.tmp', 'w') as file:
+                    json.dump(list(windows), file)
+                os.replace(checkpoint.path(results_file) + '.tmp', checkpoint.path(results_file))
+
+                results_files[file_path] = results_file
+                checkpoint.put(f'evaluation:{file_path}', file_keys[file_path], results_file)
+
+    # The results file of the evaluation set is written from the results of all the captures
+    window_results = {}
+    for file_path in pcapng_files:
+        with open(checkpoint.path(results_files[file_path])) as file:
+            window_results[file_path] = json.load(file)
+
+    output_evaluation_folder_path = os.path.join(evaluation_folder_path, 'evaluation_results')
+    os.makedirs(output_evaluation_folder_path, exist_ok=True)
+
+    if not write_window_results(output_evaluation_folder_path, main_folder_name, delta, window_results):
+        print(f'\n{Fore.RED}No classification results available!{Style.RESET_ALL}')
+    else:
+        print(f'\n{Fore.GREEN}Evaluation successfully completed!{Style.RESET_ALL}')
+
+
+# This function returns the options of the run: the defaults, overridden by the configuration file and then by the arguments
+def read_options(arguments):
+    options = dict(default_options)
+
+    if arguments.config is not None:
+        try:
+            with open(arguments.config) as file:
+                configuration = json.load(file)
+        except (OSError, ValueError) as error:
+            print(f'{Fore.RED}\nERROR: unable to read the configuration file {arguments.config}: {Style.RESET_ALL}{error}')
+            sys.exit(1)
+
+        unknown_options = set(configuration) - set(default_options)
+        if unknown_options:
+            print(f'{Fore.RED}\nERROR: unknown options in {arguments.config}: {Style.RESET_ALL}{", ".join(sorted(unknown_options))}')
+            sys.exit(1)
+
+        options.update(configuration)
+
+    options.update({name: value for name, value in vars(arguments).items() if name in default_options and value is not None})
+
+    if options['dataset'] is None:
+        print(f'\n{Fore.RED}ERROR: You must provide the dataset folder path (--dataset or "dataset" in the configuration file)!{Style.RESET_ALL}')
+        sys.exit(1)
+
+    unknown_stages = set(options['stages']) - set(pipeline_stages)
+    if unknown_stages:
+        print(f'{Fore.RED}\nERROR: unknown stages: {Style.RESET_ALL}{", ".join(sorted(unknown_stages))}')
+        sys.exit(1)
+
+    # Ensure delta is greater than overlap
+    if options['delta'] <= options['overlap']:
+        print(f"\n{Fore.RED}ERROR: Delta must be greater than the overlap value to avoid infinite loops!{Style.RESET_ALL}")
+        sys.exit(1)
+
+    options['training_deltas'] = sorted(set(options['training_deltas'] or [options['delta']]))
+    options['checkpoint_dir'] = options['checkpoint_dir'] or os.path.join(options['dataset'], 'pipeline_checkpoint')
+
+    return options
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Run the training and evaluation pipeline without prompts, resuming from the last checkpoint.')
+    parser.add_argument('--config', help='JSON file with the options (the command line arguments override it)')
+    parser.add_argument('--dataset', help='path of the dataset folder')
+    parser.add_argument('--delta', type=int, help=f'window duration in seconds of the evaluated models (default: {default_options["delta"]})')
+    parser.add_argument('--training-deltas', type=int, nargs='+', help='delta values of the trained models (default: --delta)')
+    parser.add_argument('--overlap', type=float, help=f'overlap between windows in seconds (default: {default_options["overlap"]})')
+    parser.add_argument('--stages', nargs='+', choices=pipeline_stages, help='stages to run (default: all)')
+    parser.add_argument('--training-workers', type=int, help='processes reading the training captures (default: number of cores)')
+    parser.add_argument('--training-cores', type=int, help='cores used to tune and train the models (default: all)')
+    parser.add_argument('--retrain-mode', choices=['full', 'fast', 'neighborhood'], help=f'hyperparameter search of the retrained models (default: {default_options["retrain_mode"]})')
+    parser.add_argument('--feature-selection', action='store_true', default=None,
+                        help='train the models again on a reduced feature set, computing only its statistics during the evaluation')
+    parser.add_argument('--evaluation-mode', choices=['per-device', 'merged'], help=f'evaluation mode (default: {default_options["evaluation_mode"]})')
+    parser.add_argument('--evaluation-workers', type=int, help=f'processes evaluating the captures, 0 for one per core (default: {default_options["evaluation_workers"]})')
+    parser.add_argument('--device-workers', type=int, help='threads running the per-device pipelines (default: one per device)')
+    parser.add_argument('--test-size', type=float, help=f'fraction of the training set used to test the models (default: {default_options["test_size"]})')
+    parser.add_argument('--checkpoint-dir', help='folder of the checkpoint (default: <dataset>/pipeline_checkpoint)')
+    parser.add_argument('--restart', action='store_true', default=None, help='ignore the checkpoint and run every stage again')
+    options = read_options(parser.parse_args(arguments))
+
+    # 0 evaluation workers means one per core, as None does for the evaluation module
+    if options['evaluation_workers'] == 0:
+        options['evaluation_workers'] = None
+
+    main_folder_path = options['dataset'].rstrip('/')
+    main_folder_name = main_folder_path.split('/')[-1]
+    training_folder_path = os.path.join(main_folder_path, 'training - test set')
+
+    checkpoint = Checkpoint(options['checkpoint_dir'], options['restart'])
+    print(f'\n{Fore.MAGENTA}Running stages {", ".join(options["stages"])} on {Style.RESET_ALL}{main_folder_name}'
+          f'{Fore.MAGENTA} (checkpoint: {Style.RESET_ALL}{options["checkpoint_dir"]}{Fore.MAGENTA}){Style.RESET_ALL}')
+
+    try:
+        datasets = features_key = None
+
+        # The training stage needs the features, read again only if they are not in the checkpoint
+        if 'features' in options['stages'] or 'training' in options['stages']:
+            datasets, features_key = run_features_stage(options, checkpoint, training_folder_path, main_folder_name,
+                                                        options['training_deltas'])
+
+        if 'training' in options['stages']:
+            run_training_stage(options, checkpoint, datasets, features_key,
+                               os.path.join(training_folder_path, 'classification_results'), main_folder_name)
+
+        if 'evaluation' in options['stages']:
+            run_evaluation_stage(options, checkpoint, os.path.join(main_folder_path, 'evaluation set'), main_folder_name)
+
+    except KeyboardInterrupt:
+        print(f'\n{Fore.YELLOW}Run interrupted: run the same command again to resume from the last checkpoint{Style.RESET_ALL}')
+        sys.exit(1)
+
+    print(f'\n{Fore.GREEN}Pipeline successfully completed!{Style.RESET_ALL}')
+
+    # Write the metrics of the run, if they are enabled (see common_modules/instrumentation.py)
+    emit_metrics_summary('pipeline_runner')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,124 @@
 # This file contains the code of the Random Forest and XGBoost classifiers
 
 import os
+import json
+import time
+import hashlib
 import joblib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from colorama import Fore, Style
 from sklearn.ensemble import RandomForestClassifier
 from xgboost import XGBClassifier
 from sklearn.metrics import accuracy_score, classification_report
-from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import StratifiedKFold
+from common_modules.feature_extraction import feature_schema_id
+from common_modules.instrumentation import stage, run_with_metrics, merge_metrics
+from common_modules.compact_models import export_random_forest, export_xgboost
+from common_modules.model_registry import compact_model_extensions, get_model_metadata_path
+from training_test_modules.hyperparameter_tuning import search_hyperparameters
+
+# Define how the hyperparameters are chosen when the models are trained again:
+# 'full' searches them from scratch, 'fast' reuses the hyperparameters saved with the previous models and only trains
+# the final models, 'neighborhood' searches only the grid values next to the previous best hyperparameters.
+# The previous hyperparameters are reused only if the feature schema did not change, otherwise the search starts from scratch.
+retrain_mode = 'full'
+
+# Define the hyperparameter search strategy: 'grid' (exhaustive), 'halving', 'halving-random' or 'time-budget'
+tuning_strategy = 'grid'
+
+# Define the maximum search time in seconds of each classifier (used by the 'time-budget' strategy)
+tuning_time_budget = 300
+
+# Define if the exhaustive grid search is also run to report the time saved and the accuracy difference of the strategy
+compare_with_grid = False
+
+# Define the number of cores shared by the Random Forest and XGBoost tuning, which run at the same time (default: all the cores)
+training_cores = None
+
+# Define if a reduced feature set is selected after training: the models are trained again on the most important
+# features and only the statistics they use are computed during the evaluation (see feature_selection.py)
+feature_selection = False
+
+# Define the number of cross-validation folds, computed once and shared by both classifiers
+cv_folds = 5
+
+# Define the number of rounds without improvement on the validation fold after which XGBoost stops adding trees
+# (not used by the 'grid' strategy, which searches the number of trees)
+xgb_early_stopping_rounds = 20
+
+# Hyperparameter grids of the classifiers
+rf_param_grid = {
+    'n_estimators': [100, 200, 400],
+    'max_depth': [10, 20, None],
+    'min_samples_split': [2, 5, 10],
+    'min_samples_leaf': [1, 2, 4],
+    'random_state': [42]
+}
+
+xgb_param_grid = {
+    'n_estimators': [100, 200, 400],
+    'learning_rate': [0.01, 0.1, 0.2],
+    'max_depth': [3, 6, 10],
+    'subsample': [0.8, 1.0],
+    'colsample_bytree': [0.8, 1.0],
+    'random_state': [42]
+}
+
+# Classifier type -> (estimator class, hyperparameter grid, display name)
+classifiers = {
+    'rf': (RandomForestClassifier, rf_param_grid, 'Random Forest'),
+    'xgb': (XGBClassifier, xgb_param_grid, 'XGBoost')
+}
+
+
+# This function is used to train and evaluate the Random Forest and XGBoost classifiers at the same time
+def train_and_test_classifiers(X_train, y_train, X_test, y_test, delta):
+    """
+    Trains and evaluates both classifiers in two concurrent processes. The cross-validation folds are computed once
+    and shared by both searches, and the cores (training_cores) are split between them, so that the processes do not
+    compete for more cores than available.
+
+    :param X_train: Array-like or matrix of shape (n_samples, n_features) representing the features. (from the training set of the dataset)
+    :param y_train: Array-like of shape (n_samples) representing the class labels associated with the features in X. (from the training set of the dataset)
+    :param X_test: Array-like or matrix of shape (n_samples, n_features) representing the features. (from the test set of the dataset)
+    :param y_test: Array-like of shape (n_samples) representing the class labels associated with the features in X. (from the test set of the dataset)
+    :param delta: The delta value used for the analysis.
+
+    :return: A dictionary mapping each classifier type ('rf', 'xgb') to a tuple with its accuracy and classification report,
+             and 'feature_selection' to the report of the feature selection if it is enabled.
+    """
+
+    folds = list(StratifiedKFold(n_splits=cv_folds).split(X_train, y_train))
+
+    cores = training_cores or os.cpu_count() or 1
+    rf_cores = max(1, cores // 2)
+    xgb_cores = max(1, cores - rf_cores)
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        rf_result = executor.submit(run_with_metrics, train_and_test_rf_classifier, X_train, y_train, X_test, y_test, delta, rf_cores, folds)
+        xgb_result = executor.submit(run_with_metrics, train_and_test_xgb_classifier, X_train, y_train, X_test, y_test, delta, xgb_cores, folds)
+
+        results = {'rf': rf_result.result(), 'xgb': xgb_result.result()}
+
+    # The metrics recorded by the training processes are added to the ones of this process
+    for _, metrics in results.values():
+        merge_metrics(metrics)
+
+    results = {classifier_type: result for classifier_type, (result, _) in results.items()}
+
+    if feature_selection:
+        # Imported here because the feature selection module imports this module
+        from training_test_modules.feature_selection import select_features
+
+        with stage('select_features'):
+            results['feature_selection'] = select_features(X_train, y_train, X_test, y_test, delta, n_jobs=cores)
+
+    return results
 
 
 # This function is used to train and evaluate the Random Forest classifier
-def train_and_test_rf_classifier(X_train, y_train, X_test, y_test, delta):
+def train_and_test_rf_classifier(X_train, y_train, X_test, y_test, delta, n_jobs=-1, cv=None):
     """
     Trains a classifier using the training set and evaluates its performance using the test set.
 
@@ -18,21 +127,25 @@ def train_and_test_rf_classifier(X_train, y_train, X_test, y_test, delta):
     :param X_test: Array-like or matrix of shape (n_samples, n_features) representing the features. (from the test set of the dataset)
     :param y_test: Array-like of shape (n_samples) representing the class labels associated with the features in X. (from the test set of the dataset)
     :param delta: The delta value used for the analysis.
+    :param n_jobs: The number of cores used to tune and train the classifier.
+    :param cv: The list of (train, test) cross-validation fold indexes (default: cv_folds stratified folds).
 
     :return: A tuple containing the model's accuracy and the classification report.
     """
 
-    # Initialize the Random Forest classifier and find the best hyperparameters
-    model = tune_rf_hyperparameters(X_train, y_train)
-
-    # Train the final model with the training data
-    model.fit(X_train, y_train)
+    # Initialize the Random Forest classifier and find the best hyperparameters (or reuse the previous ones)
+    # The returned model is already trained on the whole training set
+    with stage('tune_rf'):
+        model, tuning_report = choose_hyperparameters('rf', X_train, y_train, delta, n_jobs=n_jobs, cv=cv)
 
-    # Save the trained model to a file
-    save_model(model, 'rf_models', f'trained_rf_classifier_{delta}.pkl')
+    # Save the trained model to a file, with the hyperparameters used to train it
+    with stage('save_model'):
+        save_model(model, 'rf_models', f'trained_rf_classifier_{delta}.pkl')
+        save_model_metadata(create_model_metadata(tuning_report, X_train, y_train, delta), get_model_metadata_path('rf', delta))
 
     # Make predictions
-    predictions = model.predict(X_test)
+    with stage('test_rf'):
+        predictions = model.predict(X_test)
 
     # Evaluate the model performance and print the results
     accuracy = accuracy_score(y_test, predictions)
@@ -43,32 +156,22 @@ def train_and_test_rf_classifier(X_train, y_train, X_test, y_test, delta):
 
 
 # This function is used to tune the hyperparameters of the Random Forest classifier
-def tune_rf_hyperparameters(X_train, y_train):
+def tune_rf_hyperparameters(X_train, y_train, strategy=None):
     """
-    Performs hyperparameter tuning for Random Forest using GridSearchCV.
+    Performs hyperparameter tuning for Random Forest with the selected search strategy.
+    The halving strategies use the number of trees as budget, growing it up to the largest value of the grid.
 
     :param X_train: Feature matrix for training.
     :param y_train: Labels for training data.
+    :param strategy: The search strategy (default: tuning_strategy).
     :return: Best trained model with optimized hyperparameters.
     """
-    param_grid = {
-        'n_estimators': [100, 200, 400],
-        'max_depth': [10, 20, None],
-        'min_samples_split': [2, 5, 10],
-        'min_samples_leaf': [1, 2, 4],
-        'random_state': [42]
-    }
 
-    model = RandomForestClassifier()
-    grid_search = GridSearchCV(estimator=model, param_grid=param_grid, cv=5, scoring='accuracy', n_jobs=-1)
-    grid_search.fit(X_train, y_train)
-
-    print("Best parameters for Random Forest:", grid_search.best_params_)
-    return grid_search.best_estimator_
+    return _tune_hyperparameters('rf', X_train, y_train, strategy)[0]
 
 
 # This function is used to train and evaluate the XGBoost classifier
-def train_and_test_xgb_classifier(X_train, y_train, X_test, y_test, delta):
+def train_and_test_xgb_classifier(X_train, y_train, X_test, y_test, delta, n_jobs=-1, cv=None):
     """
     Trains a classifier using the training set and evaluates its performance using the test set.
 
@@ -77,21 +180,25 @@ def train_and_test_xgb_classifier(X_train, y_train, X_test, y_test, delta):
     :param X_test: Array-like or matrix of shape (n_samples, n_features) representing the features. (from the test set of the dataset)
     :param y_test: Array-like of shape (n_samples) representing the class labels associated with the features in X. (from the test set of the dataset)
     :param delta: The delta value used for the analysis.
+    :param n_jobs: The number of cores used to tune and train the classifier.
+    :param cv: The list of (train, test) cross-validation fold indexes (default: cv_folds stratified folds).
 
     :return: A tuple containing the model's accuracy and the classification report.
     """
 
-    # Initialize the XGBoost classifier and find the best hyperparameters
-    model = tune_xgb_hyperparameters(X_train, y_train)
-
-    # Train the final model with the training data
-    model.fit(X_train, y_train)
+    # Initialize the XGBoost classifier and find the best hyperparameters (or reuse the previous ones)
+    # The returned model is already trained on the whole training set
+    with stage('tune_xgb'):
+        model, tuning_report = choose_hyperparameters('xgb', X_train, y_train, delta, n_jobs=n_jobs, cv=cv)
 
-    # Save the trained model to a file
-    save_model(model, 'xgb_models', f'trained_xgb_classifier_{delta}.pkl')
+    # Save the trained model to a file, with the hyperparameters used to train it
+    with stage('save_model'):
+        save_model(model, 'xgb_models', f'trained_xgb_classifier_{delta}.pkl')
+        save_model_metadata(create_model_metadata(tuning_report, X_train, y_train, delta), get_model_metadata_path('xgb', delta))
 
     # Make predictions
-    predictions = model.predict(X_test)
+    with stage('test_xgb'):
+        predictions = model.predict(X_test)
 
     # Evaluate the model performance and print the results
     accuracy = accuracy_score(y_test, predictions)
@@ -102,35 +209,172 @@ def train_and_test_xgb_classifier(X_train, y_train, X_test, y_test, delta):
 
 
 # This function is used to tune the hyperparameters of the XGBoost classifier
-def tune_xgb_hyperparameters(X_train, y_train):
+def tune_xgb_hyperparameters(X_train, y_train, strategy=None):
     """
-    Performs hyperparameter tuning for XGBoost using GridSearchCV.
+    Performs hyperparameter tuning for XGBoost with the selected search strategy.
+    Except for the 'grid' strategy, the number of trees is found with early stopping on a validation fold.
 
     :param X_train: Feature matrix for training.
     :param y_train: Labels for training data.
+    :param strategy: The search strategy (default: tuning_strategy).
     :return: Best trained model with optimized hyperparameters.
     """
-    param_grid = {
-        'n_estimators': [100, 200, 400],
-        'learning_rate': [0.01, 0.1, 0.2],
-        'max_depth': [3, 6, 10],
-        'subsample': [0.8, 1.0],
-        'colsample_bytree': [0.8, 1.0],
-        'random_state': [42]
-    }
 
-    model = XGBClassifier()
-    grid_search = GridSearchCV(estimator=model, param_grid=param_grid, cv=5, scoring='accuracy', n_jobs=-1)
-    grid_search.fit(X_train, y_train)
+    return _tune_hyperparameters('xgb', X_train, y_train, strategy)[0]
+
+
+# This function searches the best hyperparameters of a classifier and returns the model and the search report
+def _tune_hyperparameters(classifier_type, X_train, y_train, strategy=None, param_grid=None, n_jobs=-1, cv=None):
+    estimator_class, default_param_grid, classifier_name = classifiers[classifier_type]
+
+    # The Random Forest halving searches grow the number of trees, XGBoost finds it with early stopping.
+    # XGBoost uses a single thread per fit, since the search already runs n_jobs fits in parallel.
+    if classifier_type == 'rf':
+        estimator, options = estimator_class(), {'resource': 'n_estimators'}
+    else:
+        estimator, options = estimator_class(n_jobs=1), {'early_stopping_rounds': xgb_early_stopping_rounds}
+
+    model, report = search_hyperparameters(estimator, param_grid or default_param_grid, X_train, y_train,
+                                           strategy=strategy or tuning_strategy, time_budget=tuning_time_budget,
+                                           compare_with_grid=compare_with_grid, cv=cv or cv_folds, n_jobs=n_jobs, **options)
+
+    # The saved model predicts with the default number of threads
+    model.set_params(n_jobs=None)
+
+    print(f"Best parameters for {classifier_name}:", report['best_params'])
+    return model, report
+
+
+# This function chooses the hyperparameters of a classifier according to the retrain mode
+def choose_hyperparameters(classifier_type, X_train, y_train, delta, mode=None, n_jobs=-1, cv=None):
+    """
+    Returns the classifier trained on the whole training set, with hyperparameters searched from scratch or reused
+    from the previous model of the same delta value (see retrain_mode).
+
+    :param classifier_type: The type of classifier ('rf' or 'xgb').
+    :param X_train: Feature matrix for training.
+    :param y_train: Labels for training data.
+    :param delta: The delta value used for the analysis.
+    :param mode: The retrain mode: 'full', 'fast' or 'neighborhood' (default: retrain_mode).
+    :param n_jobs: The number of cores used to tune and train the classifier.
+    :param cv: The list of (train, test) cross-validation fold indexes (default: cv_folds stratified folds).
+
+    :return: A tuple (model, report), where report contains the chosen hyperparameters and their CV accuracy.
+    """
+
+    mode = mode or retrain_mode
+    estimator_class, param_grid, classifier_name = classifiers[classifier_type]
+    metadata = None
+
+    if mode != 'full':
+        metadata = load_model_metadata(get_model_metadata_path(classifier_type, delta))
+
+        if metadata is None:
+            print(f'{Fore.YELLOW}No previous hyperparameters found for {classifier_name}, searching them from scratch{Style.RESET_ALL}')
+        elif metadata['feature_schema'] != feature_schema_id:
+            print(f'{Fore.YELLOW}The feature schema changed since the previous {classifier_name} model, searching the hyperparameters from scratch{Style.RESET_ALL}')
+            metadata = None
+
+    if metadata is None:
+        return _tune_hyperparameters(classifier_type, X_train, y_train, n_jobs=n_jobs, cv=cv)
+
+    previous_params = metadata['best_params']
+
+    if mode == 'fast':
+        # Only the final model is trained, with the previous hyperparameters and CV accuracy
+        print(f"Reusing the previous parameters for {classifier_name}:", previous_params)
+        report = {'strategy': 'fast', 'best_params': previous_params, 'cv_accuracy': metadata['cv_accuracy'], 'search_time': 0.0}
+
+        model = estimator_class(**previous_params, n_jobs=n_jobs)
+        model.fit(X_train, y_train)
+        model.set_params(n_jobs=None)
+
+        return model, report
+
+    # Search the previous optimum and the grid values next to it, one hyperparameter at a time
+    model, report = _tune_hyperparameters(classifier_type, X_train, y_train, 'grid', neighborhood_grid(param_grid, previous_params),
+                                          n_jobs=n_jobs, cv=cv)
+    report['strategy'] = 'neighborhood'
+
+    return model, report
+
+
+# This function returns the grids of the neighborhood of the given hyperparameters
+def neighborhood_grid(param_grid, best_params):
+    """
+    Builds the neighborhood of a previous optimum: the optimum itself and, for each hyperparameter, the optimum with
+    that hyperparameter moved to one of the adjacent values of the grid.
+
+    :param param_grid: Dictionary mapping each hyperparameter to the list of its candidate values.
+    :param best_params: The previous best hyperparameters.
 
-    print("Best parameters for XGBoost:", grid_search.best_params_)
-    return grid_search.best_estimator_
+    :return: A list of grids that can be searched by GridSearchCV.
+    """
+
+    # Hyperparameters missing from the previous optimum (e.g. added to the grid afterwards) are searched on the whole grid
+    optimum = {name: [best_params[name]] if name in best_params else values for name, values in param_grid.items()}
+    grids = [optimum]
+
+    for name, values in param_grid.items():
+        if name not in best_params:
+            continue
+
+        best_value = best_params[name]
+
+        if best_value in values:
+            index = values.index(best_value)
+            adjacent_values = values[max(0, index - 1):index] + values[index + 1:index + 2]
+        else:
+            # A value outside of the grid (e.g. a number of trees found with early stopping) is moved to the
+            # closest grid values below and above it
+            numeric_values = [value for value in values if value is not None]
+            adjacent_values = [value for value in numeric_values if value < best_value][-1:] + \
+                              [value for value in numeric_values if value > best_value][:1]
+
+        grids.extend({**optimum, name: [value]} for value in adjacent_values)
+
+    return grids
+
+
+# This function writes the accuracy and the classification report of the classifiers of a delta value to a file
+def write_training_results(output_training_folder_path, main_folder_name, delta, results):
+    """
+    :param output_training_folder_path: The folder where the results file is written (created if it does not exist).
+    :param main_folder_name: The name of the dataset folder.
+    :param delta: The delta value used for the analysis.
+    :param results: The dictionary returned by train_and_test_classifiers.
+    """
+    accuracyRF, reportRF = results['rf']
+    accuracyXGB, reportXGB = results['xgb']
+
+    # Create the output folder if it doesn't exist
+    os.makedirs(output_training_folder_path, exist_ok=True)
+
+    # Write results to the output file
+    with open(f'{output_training_folder_path}/training_{main_folder_name}_{delta}_results.txt', 'w') as file:
+        print(f'\n{Fore.YELLOW}Writing results for folder: {Style.RESET_ALL}{main_folder_name}/training - test set')
+
+        # Write results to file
+        file.write(f'Results for folder {main_folder_name} are:\n')
+        file.write(f'\nRandom Forest Accuracy: {accuracyRF:.3f}\n')
+        file.write(f'\nRandom Forest Classification Report: \n\n{reportRF}\n\n')
+
+        file.write(f'\nXGBoost Accuracy: {accuracyXGB:.3f}\n')
+        file.write(f'\nXGBoost Classification Report: \n\n{reportXGB}')
+
+        if 'feature_selection' in results:
+            # Imported here because the feature selection module imports this module
+            from training_test_modules.feature_selection import write_feature_selection_report
+            write_feature_selection_report(file, results['feature_selection'])
+
+        print(f'\n{Fore.GREEN}Results successfully written!{Style.RESET_ALL}')
 
 
 # This function is used to save the trained model to a file
 def save_model(model, directory_name, file_name):
     """
-    Saves the trained model to a file.
+    Saves the trained model to a file, together with its compact export (flat NumPy arrays for the Random Forest,
+    native booster for XGBoost), which can be loaded without the scikit-learn model objects.
 
     :param model: The trained model to be saved.
     :param directory_name: The name of the directory where the model will be saved.
@@ -143,4 +387,88 @@ def save_model(model, directory_name, file_name):
     # Full path for saving the model
     file_path = os.path.join(directory_name, file_name)
 
-    joblib.dump(model, file_path)
\ No newline at end of file
+    joblib.dump(model, file_path)
+
+    # Export the model in the compact format, next to the model file
+    compact_path = os.path.splitext(file_path)[0]
+    if isinstance(model, RandomForestClassifier):
+        export_random_forest(model, compact_path + compact_model_extensions['rf'])
+    elif isinstance(model, XGBClassifier):
+        export_xgboost(model, compact_path + compact_model_extensions['xgb'])
+
+
+# This function returns a fingerprint of the training data
+def compute_dataset_fingerprint(X_train, y_train):
+    """
+    Computes the SHA-256 digest of the training data, used to know if a model was trained on the same data.
+
+    :param X_train: Feature matrix for training.
+    :param y_train: Labels for training data.
+    :return: The hexadecimal digest.
+    """
+
+    X_train = np.ascontiguousarray(X_train, dtype=np.float64)
+    y_train = np.ascontiguousarray(y_train, dtype=np.int64)
+
+    digest = hashlib.sha256(str(X_train.shape).encode())
+    digest.update(X_train.tobytes())
+    digest.update(y_train.tobytes())
+
+    return digest.hexdigest()
+
+
+# This function returns the metadata saved next to a trained model
+def create_model_metadata(tuning_report, X_train, y_train, delta):
+    """
+    Collects the hyperparameters of a trained model with the information needed to reuse them.
+
+    :param tuning_report: The report of the hyperparameter search.
+    :param X_train: Feature matrix for training.
+    :param y_train: Labels for training data.
+    :param delta: The delta value used for the analysis.
+    :return: A dictionary that can be serialized to JSON.
+    """
+
+    return {
+        'delta': delta,
+        'best_params': tuning_report['best_params'],
+        'cv_accuracy': tuning_report['cv_accuracy'],
+        'tuning_strategy': tuning_report['strategy'],
+        'search_time': tuning_report['search_time'],
+        'dataset_fingerprint': compute_dataset_fingerprint(X_train, y_train),
+        'n_samples': len(y_train),
+        'feature_schema': feature_schema_id,
+        'trained_at': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    }
+
+
+# This function is used to save the metadata of a trained model to a JSON file
+def save_model_metadata(metadata, file_path):
+    """
+    Saves the metadata of a trained model.
+
+    :param metadata: The metadata dictionary.
+    :param file_path: The path of the JSON file, next to the model file.
+    """
+
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+
+    with open(file_path, 'w') as file:
+        # NumPy scalars (e.g. from the searched grids) are converted to Python numbers
+        json.dump(metadata, file, indent=4, default=lambda value: value.item())
+
+
+# This function is used to load the metadata of a trained model
+def load_model_metadata(file_path):
+    """
+    Loads the metadata of a trained model.
+
+    :param file_path: The path of the JSON file.
+    :return: The metadata dictionary, or None if the file does not exist or cannot be read.
+    """
+
+    try:
+        with open(file_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
\ No newline at end of file
@@ -4,15 +4,18 @@ import os
 import re
 import sys
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from colorama import Fore, Style
-from scapy.layers.inet import IP
 from common_modules.flow_labeling import get_flow_label
+from common_modules.instrumentation import stage, count, run_with_metrics, merge_metrics
 from common_modules.ip_addresses import get_ip_address
-from common_modules.utilities import read_timestamp_files, convert_timestamp, read_training_pcapng_files, compute_statistical_features
+from common_modules.packet_table import ip_to_int
+from common_modules.utilities import read_timestamp_files, convert_timestamp, convert_timestamps, read_training_pcapng_files, compute_statistical_features
+from training_test_modules.feature_cache import FeatureCache, cache_file_name
 
 
 # This function analyzes .pcapng files and reads .timestamps files in a folder and related subfolders
-def read_training_files(folder_path, folder_name, delta):
+def read_training_files(folder_path, folder_name, delta, workers=None, use_cache=True):
     """
         This function iterates over all the files in the given directory, identifies pcap (.pcapng) and
         timestamps (.timestamps) files, and reads their contents. It then returns two NumPy arrays that are
@@ -21,16 +24,100 @@ def read_training_files(folder_path, folder_name, delta):
         :param folder_path: The path to the folder containing pcap and timestamps files.
         :param folder_name: The name of the folder containing the dataset
         :param delta: The delta value used for filtering packets.
+        :param workers: The number of processes used to read the .pcapng files (default: number of cores).
+        :param use_cache: If True, the features are stored in an on-disk cache and unchanged files are not parsed again.
 
         :return: A tuple of NumPy arrays representing data and target for the classifier.
     """
 
-    dataset_features = []
-    dataset_labels = []
+    return read_training_files_multi_delta(folder_path, folder_name, [delta], workers, use_cache)[delta]
+
+
+# This function analyzes the training set once and returns the data and target for several delta values
+def read_training_files_multi_delta(folder_path, folder_name, deltas, workers=None, use_cache=True):
+    """
+        This function reads each .pcapng file of the training set only once, up to the largest delta value,
+        and extracts the features of every requested delta value from the same packets.
+
+        :param folder_path: The path to the folder containing pcap and timestamps files.
+        :param folder_name: The name of the folder containing the dataset
+        :param deltas: The list of delta values used for filtering packets.
+        :param workers: The number of processes used to read the .pcapng files (default: number of cores).
+        :param use_cache: If True, the features are stored in an on-disk cache and unchanged files are not parsed again.
+
+        :return: A dictionary mapping each delta value to a tuple of NumPy arrays representing data and target for the classifier.
+    """
+
+    deltas = sorted(set(deltas))
+    dataset_features = {delta: [] for delta in deltas}
+    dataset_labels = {delta: [] for delta in deltas}
 
     print(f'\n{Fore.MAGENTA}Reading training set in folder: {Style.RESET_ALL}{folder_name}')
 
-    timestamps_cache = read_timestamp_files(folder_path)
+    with stage('read_timestamps'):
+        timestamps_cache = read_timestamp_files(folder_path)
+
+    # Collect the .pcapng files to read, in a deterministic order
+    with stage('list_training_files'):
+        training_files = list_training_files(folder_path, timestamps_cache)
+    count('training_files', len(training_files))
+
+    # The files are independent, so they are read in parallel by a pool of processes (results keep the file order)
+    with stage('extract_training_features'):
+        if use_cache:
+            with FeatureCache(os.path.join(folder_path, cache_file_name)) as cache:
+                features = _read_cached_training_files(training_files, deltas, workers, cache)
+        else:
+            features = _read_training_files(training_files, deltas, workers)
+
+    for (file_path, _, _), file_features in zip(training_files, features):
+
+        print(f'\n{Fore.BLUE}Reading packets from file: {Style.RESET_ALL}{file_path.split("/")[-1]}')
+
+        # Get the label of the current flow
+        activity_name = file_path.split('/')[-3]
+        label = get_flow_label(activity_name)
+
+        for delta, flow_features in zip(deltas, file_features):
+
+            # Check if the flow is valid
+            if flow_features is None:
+                count('invalid_flows')
+                continue
+
+            # Append label to dataset labels only if a label was found
+            if label != -1:
+                dataset_labels[delta].append(label)
+            else:
+                print(f'{Fore.RED}\nERROR: No label found for flow: {Style.RESET_ALL}{activity_name}')
+                sys.exit(1)
+
+            # Append flow features to dataset features
+            dataset_features[delta].extend(flow_features)
+            count('training_flows')
+
+        print(f'{Fore.GREEN}Packets successfully read!{Style.RESET_ALL}')
+
+    print(f'\n{Fore.GREEN}Training set successfully read!{Style.RESET_ALL}')
+
+    return {delta: (np.array(dataset_features[delta]), np.array(dataset_labels[delta])) for delta in deltas}
+
+
+# This function returns the list of .pcapng files of the training set with the information needed to read them
+def list_training_files(folder_path, timestamps_cache):
+    """
+        Walks the training set folder and returns, for each .pcapng file, the information used to extract its features.
+
+        :param folder_path: The path to the folder containing pcap and timestamps files.
+        :param timestamps_cache: Dictionary mapping each activity to the list of its timestamps.
+
+        :return: A list of tuples (file path, device IP address, activity timestamp), sorted by file path.
+    """
+
+    training_files = []
+
+    # Convert the timestamps of each activity at once
+    converted_timestamps = {activity: convert_timestamps(timestamps) for activity, timestamps in timestamps_cache.items()}
 
     # Iterate over all the files in directory 'folder_path' to search for .pcap files
     for root, dirs, files in os.walk(folder_path):
@@ -43,10 +130,10 @@ def read_training_files(folder_path, folder_name, delta):
 
                 # Retrieve current activity timestamps from timestamps cache
                 activity_timestamps = timestamps_cache[file_path.split("/")[-3]]
+                activity_times = converted_timestamps[file_path.split("/")[-3]]
 
-                # Extract device name, activity name and index from the file name
+                # Extract device name and index from the file name
                 device_name = file_path.split('/')[-4]
-                activity_name = file_path.split('/')[-3]
                 file_index = re.match(r"(.+?)(\d+)\.pcapng", file_name).group(2)
                 file_index = int(file_index)
                 device_ip_address = get_ip_address(device_name)
@@ -56,49 +143,118 @@ def read_training_files(folder_path, folder_name, delta):
                     print(f'{Fore.RED}\nERROR: No ip address found for device: {Style.RESET_ALL}{device_name}')
                     sys.exit(1)
 
-                print(f'\n{Fore.BLUE}Reading packets from file: {Style.RESET_ALL}{file_name}')
-
                 # Find the timestamp of the current analyzed file
-                file_timestamp = activity_timestamps[file_index - 1]
+                formatted_timestamp = float(activity_times[file_index - 1])
 
-                # Obtain formatted timestamp
-                formatted_timestamp = convert_timestamp(file_timestamp)
+                # A timestamp that could not be converted is reported as convert_timestamp does
+                if np.isnan(formatted_timestamp):
+                    formatted_timestamp = convert_timestamp(activity_timestamps[file_index - 1])
 
-                # Read packet flow from the .pcapng file
-                filtered_packets = read_training_pcapng_files(file_path, device_ip_address, formatted_timestamp, delta)
+                training_files.append((file_path, device_ip_address, formatted_timestamp))
 
-                # Check if the packets are empty
-                if len(filtered_packets) != 0:
+    # Sort the files, so that the dataset rows (and therefore the train / test split) do not depend on the file system order
+    return sorted(training_files)
 
-                    # Filter packets for out flow
-                    outgoing_packets = list(
-                        filter(lambda packet: packet[IP].src == device_ip_address, filtered_packets))
 
-                    # Filter packets for in flow
-                    incoming_packets = list(
-                        filter(lambda packet: packet[IP].dst == device_ip_address, filtered_packets))
+# This function reads the .pcapng files and returns, for each file, the list of its features for each delta value
+def _read_training_files(training_files, deltas, workers=None):
+    workers = workers or os.cpu_count() or 1
+    jobs = [(file_path, device_ip_address, formatted_timestamp, tuple(deltas))
+            for file_path, device_ip_address, formatted_timestamp in training_files]
 
-                    if len(outgoing_packets) != 0 and len(incoming_packets) != 0:
+    if workers == 1 or len(jobs) <= 1:
+        return [extract_training_features(job) for job in jobs]
 
-                        # Compute the features for this flow
-                        flow_features = compute_statistical_features(filtered_packets, incoming_packets,
-                                                                     outgoing_packets)
+    # The metrics recorded by the workers are added to the ones of this process
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(run_with_metrics, [extract_training_features] * len(jobs), jobs,
+                                    chunksize=max(1, len(jobs) // (4 * workers))))
 
-                        # Get the label of the current flow
-                        label = get_flow_label(activity_name)
+    for _, metrics in results:
+        merge_metrics(metrics)
 
-                        # Append label to dataset labels only if a label was found
-                        if label != -1:
-                            dataset_labels.append(label)
-                        else:
-                            print(f'{Fore.RED}\nERROR: No label found for flow: {Style.RESET_ALL}{activity_name}')
-                            sys.exit(1)
+    return [file_features for file_features, _ in results]
 
-                        # Append flow features to dataset features
-                        dataset_features.extend(flow_features)
-                                
-                print(f'{Fore.GREEN}Packets successfully read!{Style.RESET_ALL}')
 
-    print(f'\n{Fore.GREEN}Training set successfully read!{Style.RESET_ALL}')
+# This function returns the features of the training files, reading only the files missing from the cache
+def _read_cached_training_files(training_files, deltas, workers, cache):
+    features = []
+    missing_files = {}
+
+    for file_index, (file_path, device_ip_address, formatted_timestamp) in enumerate(training_files):
+        file_features = []
+        for delta in deltas:
+            found, flow_features = cache.get((file_path, device_ip_address, formatted_timestamp, delta))
+            file_features.append(flow_features)
+
+            # A file is read again with all the delta values missing from the cache
+            if not found:
+                missing_files.setdefault(file_index, []).append(delta)
+        features.append(file_features)
+
+    count('cached_files', len(training_files) - len(missing_files))
+
+    if missing_files:
+        print(f'\n{Fore.YELLOW}Feature cache: {Style.RESET_ALL}{len(training_files) - len(missing_files)} files cached, '
+              f'{len(missing_files)} files to read')
+
+    # Files missing the same delta values are read together
+    for missing_deltas in sorted(set(map(tuple, missing_files.values()))):
+        file_indexes = [file_index for file_index, file_deltas in missing_files.items() if tuple(file_deltas) == missing_deltas]
+        new_features = _read_training_files([training_files[file_index] for file_index in file_indexes], missing_deltas, workers)
+
+        for file_index, file_features in zip(file_indexes, new_features):
+            file_path, device_ip_address, formatted_timestamp = training_files[file_index]
+            label = get_flow_label(file_path.split('/')[-3])
+
+            for delta, flow_features in zip(missing_deltas, file_features):
+                cache.put((file_path, device_ip_address, formatted_timestamp, delta), label, flow_features)
+                features[file_index][deltas.index(delta)] = flow_features
+
+    return features
+
+
+# This function reads a .pcapng file of the training set and returns the features of its flow for each delta value
+def extract_training_features(job):
+    """
+        Reads the packets of a training file once, from the activity timestamp t up to the largest delta value, and
+        computes the features of the device flow in [t, t + delta] for each delta value.
+
+        :param job: A tuple (file path, device IP address, activity timestamp, delta values).
+
+        :return: A list with, for each delta value, a NumPy array of shape (1, 39) with the flow features,
+                 or None if the flow is not valid.
+    """
+
+    file_path, device_ip_address, formatted_timestamp, deltas = job
+
+    # Read packet flow from the .pcapng file
+    packets = read_training_pcapng_files(file_path, device_ip_address, formatted_timestamp, max(deltas))
+
+    # For each delta, keep the packets captured in [t, t + delta]
+    flows = [packets[packets.time - formatted_timestamp <= delta] for delta in deltas]
+
+    device_ip_integer = ip_to_int(device_ip_address)
+    file_features = []
+
+    for filtered_packets in flows:
+
+        # Check if the packets are empty
+        if len(filtered_packets) == 0:
+            file_features.append(None)
+            continue
+
+        # Filter packet lengths for out flow
+        outgoing_packets = filtered_packets.length[filtered_packets.src == device_ip_integer]
+
+        # Filter packet lengths for in flow
+        incoming_packets = filtered_packets.length[filtered_packets.dst == device_ip_integer]
+
+        if len(outgoing_packets) == 0 or len(incoming_packets) == 0:
+            file_features.append(None)
+            continue
+
+        # Compute the features for this flow
+        file_features.append(compute_statistical_features(filtered_packets.length, incoming_packets, outgoing_packets))
 
-    return np.array(dataset_features), np.array(dataset_labels)
+    return file_features
@@ -0,0 +1,98 @@
+# This file contains the on-disk cache of the features extracted from the training set captures
+
+import os
+import sqlite3
+import numpy as np
+from common_modules.feature_extraction import feature_schema_id
+
+# Name of the cache file, created in the training set folder
+cache_file_name = 'feature_cache.sqlite'
+
+
+class FeatureCache:
+    """
+    Persistent store of the features of each training capture, kept in a small SQLite database.
+    An entry is identified by the capture path, the device IP address, the activity timestamp and delta, and it is
+    valid only while the capture size and modification time and the feature schema are unchanged.
+    Flows without valid features are stored too, so that their capture is not parsed again either.
+    """
+
+    def __init__(self, cache_path):
+        """
+        :param cache_path: path of the SQLite database file (created if it does not exist).
+        """
+        self.connection = sqlite3.connect(cache_path)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS features (
+                file_path TEXT NOT NULL,
+                device_ip_address TEXT NOT NULL,
+                activity_timestamp REAL NOT NULL,
+                delta REAL NOT NULL,
+                file_size INTEGER NOT NULL,
+                file_mtime_ns INTEGER NOT NULL,
+                schema_version TEXT NOT NULL,
+                label INTEGER NOT NULL,
+                features BLOB,
+                PRIMARY KEY (file_path, device_ip_address, activity_timestamp, delta)
+            )
+        ''')
+        self.schema_version = feature_schema_id
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # This method returns the (size, modification time) stamp of a capture file
+    @staticmethod
+    def _file_stamp(file_path):
+        file_stat = os.stat(file_path)
+        return file_stat.st_size, file_stat.st_mtime_ns
+
+    # This method returns the cached features of a training job
+    def get(self, job):
+        """
+        Looks up the features of a training job.
+
+        :param job: A tuple (file path, device IP address, activity timestamp, delta).
+        :return: A tuple (found, features), where features is None for flows without valid features.
+        """
+        file_path, device_ip_address, activity_timestamp, delta = job
+        file_size, file_mtime_ns = self._file_stamp(file_path)
+
+        row = self.connection.execute(
+            'SELECT features FROM features WHERE file_path = ? AND device_ip_address = ? AND activity_timestamp = ? '
+            'AND delta = ? AND file_size = ? AND file_mtime_ns = ? AND schema_version = ?',
+            (file_path, device_ip_address, activity_timestamp, delta, file_size, file_mtime_ns, self.schema_version)
+        ).fetchone()
+
+        if row is None:
+            return False, None
+
+        features = None if row[0] is None else np.frombuffer(row[0], dtype=np.float64).reshape(1, -1)
+        return True, features
+
+    # This method stores the features of a training job
+    def put(self, job, label, features):
+        """
+        Stores the features of a training job, replacing any stale entry of the same capture.
+
+        :param job: A tuple (file path, device IP address, activity timestamp, delta).
+        :param label: The label of the flow.
+        :param features: A NumPy array of shape (1, n_features), or None if the flow is not valid.
+        """
+        file_path, device_ip_address, activity_timestamp, delta = job
+        file_size, file_mtime_ns = self._file_stamp(file_path)
+        blob = None if features is None else np.ascontiguousarray(features, dtype=np.float64).tobytes()
+
+        self.connection.execute(
+            'INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (file_path, device_ip_address, activity_timestamp, delta, file_size, file_mtime_ns, self.schema_version,
+             int(label), blob)
+        )
+
+    # This method saves the pending changes and closes the database
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
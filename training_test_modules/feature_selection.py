@@ -0,0 +1,236 @@
+# This file contains the selection of a reduced feature set for the trained models
+# After the models are trained on all the features, the features are ranked by the impurity importance of the
+# Random Forest and XGBoost models and by their permutation importance (the accuracy lost when a feature is shuffled).
+# The models are trained again on the top-k features for growing k, and the smallest set whose accuracy stays within
+# feature_selection_tolerance of all the features is kept: the pruned models replace the full ones, and the names of
+# their features are saved in their metadata, so that the evaluation only computes the statistics they use.
+
+import time
+import numpy as np
+from colorama import Fore, Style
+from sklearn.inspection import permutation_importance
+from sklearn.metrics import accuracy_score, classification_report
+from sklearn.model_selection import train_test_split
+from common_modules.feature_extraction import feature_names, compute_window_features
+from common_modules.model_registry import model_locations, get_model_metadata_path
+from training_test_modules.classifier_module import classifiers, save_model, save_model_metadata, load_model_metadata
+
+# Define the maximum accuracy loss (on the validation split, for both classifiers) accepted for a reduced feature set
+feature_selection_tolerance = 0.01
+
+# Define the numbers of top-ranked features tried, from the smallest (all the features are always tried)
+feature_selection_sizes = [3, 5, 8, 12, 16, 20, 25, 30]
+
+# Define the fraction of the training set held out to rank the features and compare the feature sets
+feature_selection_validation_size = 0.25
+
+# Define the number of times each feature is shuffled to measure its permutation importance
+permutation_repeats = 5
+
+# Define the number of windows whose feature extraction is timed to measure the latency of each feature set
+latency_windows = 500
+
+
+# This function selects the reduced feature set of the models of a delta value and saves the pruned models
+def select_features(X_train, y_train, X_test, y_test, delta, n_jobs=-1):
+    """
+    Must run after the models of the delta value are trained and saved on all the features (see train_and_test_classifiers).
+    The features are ranked and the feature sets compared on a validation split of the training set, so that the test
+    set only measures the accuracy of the chosen models.
+
+    :param X_train: Feature matrix for training, with all the features.
+    :param y_train: Labels for training data.
+    :param X_test: Feature matrix for testing, with all the features.
+    :param y_test: Labels for testing data.
+    :param delta: The delta value used for the analysis.
+    :param n_jobs: The number of cores used to train the models.
+
+    :return: A dictionary with the ranking of the features, the validation accuracy and the extraction latency of each
+             feature set, the selected features and the test accuracy and classification report of the pruned models.
+    """
+
+    print(f'\n{Fore.YELLOW}Selecting the features of the models with delta = {Style.RESET_ALL}{delta}')
+
+    # The features are ranked with models trained on the training set without the validation split
+    X_fit, X_validation, y_fit, y_validation = train_test_split(X_train, y_train, test_size=feature_selection_validation_size,
+                                                                stratify=y_train, random_state=42)
+    metadata = {classifier_type: load_model_metadata(get_model_metadata_path(classifier_type, delta)) for classifier_type in classifiers}
+
+    full_models = {classifier_type: _train_model(classifier_type, metadata[classifier_type], X_fit, y_fit, n_jobs)
+                   for classifier_type in classifiers}
+    ranking, scores = rank_features(full_models, X_validation, y_validation, n_jobs)
+
+    # Compare the top-k feature sets, from the smallest, with all the features
+    latency_segments = sample_latency_segments(X_test)
+    sizes = [size for size in feature_selection_sizes if size < len(feature_names)] + [len(feature_names)]
+    candidates = []
+
+    for size in sizes:
+        # The columns keep the order of the feature schema
+        column_indexes = sorted(ranking[:size])
+        models = full_models if size == len(feature_names) else \
+            {classifier_type: _train_model(classifier_type, metadata[classifier_type], X_fit[:, column_indexes], y_fit, n_jobs)
+             for classifier_type in classifiers}
+
+        candidate = {'features': size, 'column_indexes': column_indexes,
+                     'latency_us': measure_extraction_latency(latency_segments, [feature_names[index] for index in column_indexes])}
+        for classifier_type, model in models.items():
+            candidate[f'{classifier_type}_accuracy'] = accuracy_score(y_validation, model.predict(X_validation[:, column_indexes]))
+        candidates.append(candidate)
+
+    # The smallest feature set within the tolerance of all the features, for both classifiers
+    full_candidate = candidates[-1]
+    selected = next(candidate for candidate in candidates
+                    if all(candidate[f'{classifier_type}_accuracy'] >= full_candidate[f'{classifier_type}_accuracy'] - feature_selection_tolerance
+                           for classifier_type in classifiers))
+
+    report = {
+        'ranking': [(feature_names[index], scores[index]) for index in ranking],
+        'candidates': [{name: value for name, value in candidate.items() if name != 'column_indexes'} for candidate in candidates],
+        'selected_features': selected['features'],
+        'feature_columns': None
+    }
+
+    if selected is full_candidate:
+        print(f'{Fore.YELLOW}No reduced feature set is within the tolerance, the models keep all the features{Style.RESET_ALL}')
+        return report
+
+    # Train the pruned models on the whole training set and replace the full ones
+    column_indexes = selected['column_indexes']
+    report['feature_columns'] = [feature_names[index] for index in column_indexes]
+
+    for classifier_type, (_, _, classifier_name) in classifiers.items():
+        model = _train_model(classifier_type, metadata[classifier_type], X_train[:, column_indexes], y_train, n_jobs)
+        predictions = model.predict(X_test[:, column_indexes])
+
+        report[classifier_type] = (accuracy_score(y_test, predictions), classification_report(y_test, predictions))
+
+        directory_name, file_name = model_locations[classifier_type]
+        save_model(model, directory_name, file_name.format(delta=delta))
+        save_model_metadata({**metadata[classifier_type], 'feature_columns': report['feature_columns'],
+                             'feature_selection': {'tolerance': feature_selection_tolerance,
+                                                   'validation_accuracy': selected[f'{classifier_type}_accuracy'],
+                                                   'full_validation_accuracy': full_candidate[f'{classifier_type}_accuracy'],
+                                                   'test_accuracy': report[classifier_type][0]}},
+                            get_model_metadata_path(classifier_type, delta))
+
+        print(f'{classifier_name} trained on {selected["features"]} of {len(feature_names)} features, '
+              f'test accuracy: {report[classifier_type][0]:.3f}')
+
+    return report
+
+
+# This function trains a model with the hyperparameters saved in the metadata of the model trained on all the features
+def _train_model(classifier_type, metadata, X, y, n_jobs):
+    estimator_class = classifiers[classifier_type][0]
+
+    model = estimator_class(**metadata['best_params'], n_jobs=n_jobs)
+    model.fit(X, y)
+    model.set_params(n_jobs=None)
+
+    return model
+
+
+# This function ranks the features by their importance for the given models
+def rank_features(models, X_validation, y_validation, n_jobs=-1):
+    """
+    Each importance measure (the impurity importance and the permutation importance of each model) is normalized to
+    sum to one, negative permutation importances counting as zero, and the score of a feature is their average.
+
+    :param models: Dictionary mapping each classifier type to its model trained on all the features.
+    :param X_validation: Feature matrix of the validation split.
+    :param y_validation: Labels of the validation split.
+    :param n_jobs: The number of cores used to compute the permutation importance.
+
+    :return: A tuple (indexes of the features from the most to the least important, array of the scores of the features).
+    """
+
+    measures = []
+
+    for classifier_type, model in models.items():
+        permutation = permutation_importance(model, X_validation, y_validation, n_repeats=permutation_repeats,
+                                             random_state=42, n_jobs=n_jobs)
+        measures.extend([model.feature_importances_, permutation.importances_mean])
+
+    normalized_measures = []
+    for measure in measures:
+        measure = np.clip(np.asarray(measure, dtype=np.float64), 0, None)
+        normalized_measures.append(measure / measure.sum() if measure.sum() > 0 else measure)
+
+    scores = np.mean(normalized_measures, axis=0)
+
+    # Ties keep the order of the feature schema
+    return [int(index) for index in np.argsort(-scores, kind='stable')], scores
+
+
+# This function returns random packet lengths for windows with the packet counts of the given feature rows
+def sample_latency_segments(X, seed=42):
+    """
+    The extraction time of a window only depends on its numbers of packets and on the computed statistics, so the
+    windows are rebuilt from the packet counts of the feature rows, with random packet lengths.
+
+    :param X: Feature matrix with all the features.
+    :param seed: The seed of the random generator.
+
+    :return: A list of tuples (complete lengths, incoming lengths, outgoing lengths), one per window.
+    """
+
+    rng = np.random.default_rng(seed)
+    rows = X[rng.choice(len(X), size=min(latency_windows, len(X)), replace=False)]
+    count_indexes = [feature_names.index(f'{flow} Number of packets') for flow in ('Complete', 'Incoming', 'Outgoing')]
+
+    return [tuple(rng.integers(40, 1500, size=max(1, int(row[index])), dtype=np.int64) for index in count_indexes)
+            for row in rows]
+
+
+# This function returns the mean time in microseconds to compute the given features of a window
+def measure_extraction_latency(segments, columns, repeats=3):
+    """
+    Each window is computed on its own, as the stream classifier does, and the best of the repeats is kept.
+
+    :param segments: The windows returned by sample_latency_segments.
+    :param columns: The names of the features to compute.
+    :param repeats: The number of times the windows are computed.
+
+    :return: The mean extraction time of a window, in microseconds.
+    """
+
+    best_time = float('inf')
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for complete_lengths, incoming_lengths, outgoing_lengths in segments:
+            compute_window_features(complete_lengths, [0, len(complete_lengths)], incoming_lengths, [0, len(incoming_lengths)],
+                                    outgoing_lengths, [0, len(outgoing_lengths)], columns=columns)
+        best_time = min(best_time, time.perf_counter() - start)
+
+    return best_time / len(segments) * 1e6
+
+
+# This function writes the feature selection report to an open results file
+def write_feature_selection_report(file, report):
+    """
+    :param file: The open results file.
+    :param report: The dictionary returned by select_features.
+    """
+
+    file.write('\n\nFeature selection (accuracy on the validation split, extraction latency of one window):\n\n')
+    file.write(f'{"Features":>8}  {"RF accuracy":>11}  {"XGB accuracy":>12}  {"Latency (us)":>12}\n')
+
+    for candidate in report['candidates']:
+        marker = '  <- selected' if candidate['features'] == report['selected_features'] else ''
+        file.write(f'{candidate["features"]:>8}  {candidate["rf_accuracy"]:>11.3f}  {candidate["xgb_accuracy"]:>12.3f}  '
+                   f'{candidate["latency_us"]:>12.1f}{marker}\n')
+
+    if report['feature_columns'] is None:
+        file.write('\nThe models keep all the features.\n')
+    else:
+        file.write(f'\nPruned Random Forest Accuracy: {report["rf"][0]:.3f}\n')
+        file.write(f'\nPruned Random Forest Classification Report: \n\n{report["rf"][1]}\n')
+        file.write(f'\nPruned XGBoost Accuracy: {report["xgb"][0]:.3f}\n')
+        file.write(f'\nPruned XGBoost Classification Report: \n\n{report["xgb"][1]}\n')
+        file.write(f'\nSelected features: {", ".join(report["feature_columns"])}\n')
+
+    file.write('\nFeature ranking:\n')
+    for name, score in report['ranking']:
+        file.write(f'{score:.4f}  {name}\n')
@@ -0,0 +1,202 @@
+# This file contains the hyperparameter search strategies used to tune the Random Forest and XGBoost classifiers
+
+import time
+import numpy as np
+from colorama import Fore, Style
+from sklearn.base import clone
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401 (enables the halving searches)
+from sklearn.model_selection import GridSearchCV, HalvingGridSearchCV, HalvingRandomSearchCV, ParameterGrid, \
+    ParameterSampler, cross_val_score, train_test_split
+
+# Available search strategies:
+# 'grid' evaluates every combination of the grid on every fold (exhaustive, slowest),
+# 'halving' evaluates every combination with a small budget and keeps only the best third at each round (successive halving),
+# 'halving-random' is like 'halving', but starts from a random third of the combinations,
+# 'time-budget' evaluates random combinations until the time budget (in seconds) is over.
+tuning_strategies = ('grid', 'halving', 'halving-random', 'time-budget')
+
+
+# This function searches the best hyperparameters of an estimator with the given strategy
+def search_hyperparameters(estimator, param_grid, X_train, y_train, strategy='grid', resource='n_samples',
+                           time_budget=None, early_stopping_rounds=None, compare_with_grid=False, cv=5, n_jobs=-1,
+                           random_state=42):
+    """
+    Performs hyperparameter tuning with the given search strategy.
+
+    :param estimator: The estimator to tune.
+    :param param_grid: Dictionary mapping each hyperparameter to the list of its candidate values
+                       (or a list of such dictionaries, with the 'grid' strategy only).
+    :param X_train: Feature matrix for training.
+    :param y_train: Labels for training data.
+    :param strategy: The search strategy, one of tuning_strategies.
+    :param resource: The budget increased by the halving strategies at each round: 'n_samples' or a hyperparameter
+                     of the grid (e.g. 'n_estimators', whose largest value becomes the maximum budget).
+    :param time_budget: The maximum search time in seconds of the 'time-budget' strategy.
+    :param early_stopping_rounds: If set (XGBoost only, not with the 'grid' strategy), the number of trees is not searched:
+                                  each fit stops when the accuracy on a held-out validation fold stops improving.
+    :param compare_with_grid: If True, the exhaustive grid search is also run to report the time saved and the accuracy difference.
+    :param cv: The number of cross-validation folds, or the list of (train, test) fold indexes of the training set
+               (with early stopping, the validation fold is removed from them).
+    :param n_jobs: The number of parallel jobs of the search.
+    :param random_state: The seed of the random strategies and of the validation split.
+
+    :return: A tuple (best model trained on the whole training set, report dictionary).
+    """
+
+    if strategy not in tuning_strategies:
+        raise ValueError(f'unknown tuning strategy {strategy!r}, expected one of {tuning_strategies}')
+
+    # A list of grids is searched as a whole by the 'grid' strategy (e.g. the neighborhood of a previous optimum)
+    search_grid = dict(param_grid) if isinstance(param_grid, dict) else param_grid
+    fit_params = {}
+    X_search, y_search = X_train, y_train
+
+    # The folds of the search; the exhaustive grid comparison keeps the folds of the whole training set
+    search_cv = cv
+
+    # With early stopping, the number of trees is found on a validation fold instead of being searched
+    use_early_stopping = early_stopping_rounds is not None and strategy != 'grid'
+    if use_early_stopping:
+        search_indexes, validation_indexes = _split_validation_fold(y_train, random_state)
+        X_search, y_search = X_train[search_indexes], y_train[search_indexes]
+        X_validation, y_validation = X_train[validation_indexes], y_train[validation_indexes]
+        # A generator of folds is read once, since the comparison with the grid search uses the folds again
+        if not isinstance(cv, int) and hasattr(cv, '__iter__'):
+            cv = list(cv)
+        search_cv = _restrict_folds(cv, search_indexes, len(y_train))
+        estimator = clone(estimator).set_params(n_estimators=max(search_grid.pop('n_estimators')),
+                                                early_stopping_rounds=early_stopping_rounds)
+        fit_params = {'eval_set': [(X_validation, y_validation)], 'verbose': False}
+
+    start_time = time.perf_counter()
+
+    if strategy == 'grid':
+        search = GridSearchCV(estimator=estimator, param_grid=search_grid, cv=search_cv, scoring='accuracy', n_jobs=n_jobs)
+        search.fit(X_search, y_search, **fit_params)
+        best_params, best_score, best_model = search.best_params_, search.best_score_, search.best_estimator_
+        evaluated_candidates = len(search.cv_results_['params'])
+
+    elif strategy in ('halving', 'halving-random'):
+        halving_options = {'cv': search_cv, 'scoring': 'accuracy', 'n_jobs': n_jobs, 'random_state': random_state, 'factor': 3}
+
+        # A hyperparameter used as resource is removed from the grid and grows up to its largest value,
+        # starting from a budget that leaves room for three rounds
+        if resource != 'n_samples':
+            max_resources = max(search_grid.pop(resource))
+            halving_options.update(resource=resource, max_resources=max_resources, min_resources=max(1, max_resources // 9))
+
+        if strategy == 'halving':
+            search = HalvingGridSearchCV(estimator=estimator, param_grid=search_grid, **halving_options)
+        else:
+            # Start from a random third of the combinations
+            n_candidates = max(3, len(ParameterGrid(search_grid)) // 3)
+            if resource == 'n_samples':
+                halving_options['min_resources'] = 'exhaust'
+            search = HalvingRandomSearchCV(estimator=estimator, param_distributions=search_grid, n_candidates=n_candidates,
+                                           **halving_options)
+
+        search.fit(X_search, y_search, **fit_params)
+        best_params, best_score, best_model = search.best_params_, search.best_score_, search.best_estimator_
+        evaluated_candidates = len(search.cv_results_['params'])
+
+        if resource != 'n_samples':
+            best_params = {**best_params, resource: best_model.get_params()[resource]}
+
+    else:
+        best_params, best_score, best_model, evaluated_candidates = _time_budget_search(
+            estimator, search_grid, X_search, y_search, time_budget, fit_params, search_cv, n_jobs, random_state)
+
+    # The number of trees found with early stopping is used to train the final model on the whole training set
+    if use_early_stopping:
+        best_params = {**best_params, 'n_estimators': best_model.best_iteration + 1}
+        best_model = clone(estimator).set_params(**best_params, early_stopping_rounds=None)
+        best_model.fit(X_train, y_train)
+
+    search_time = time.perf_counter() - start_time
+
+    report = {
+        'strategy': strategy,
+        'best_params': best_params,
+        'cv_accuracy': best_score,
+        'search_time': search_time,
+        'evaluated_candidates': evaluated_candidates,
+        'grid_candidates': len(ParameterGrid(param_grid))
+    }
+
+    print(f'{Fore.YELLOW}Tuning strategy: {Style.RESET_ALL}{strategy} ({search_time:.1f} s, CV accuracy = {best_score:.3f}, '
+          f'{evaluated_candidates} candidate evaluations vs {report["grid_candidates"]} for the full grid)')
+
+    # Run the exhaustive grid search to measure what the faster strategy saved and lost
+    if compare_with_grid and strategy != 'grid':
+        grid_start_time = time.perf_counter()
+        grid_estimator = clone(estimator)
+        if use_early_stopping:
+            grid_estimator.set_params(early_stopping_rounds=None)
+
+        grid_search = GridSearchCV(estimator=grid_estimator, param_grid=param_grid, cv=cv, scoring='accuracy', n_jobs=n_jobs)
+        grid_search.fit(X_train, y_train)
+        grid_time = time.perf_counter() - grid_start_time
+
+        report.update(grid_time=grid_time, time_saved=grid_time - search_time,
+                      grid_cv_accuracy=grid_search.best_score_, accuracy_difference=best_score - grid_search.best_score_)
+
+        print(f'{Fore.YELLOW}Exhaustive grid search: {Style.RESET_ALL}{grid_time:.1f} s, CV accuracy = {grid_search.best_score_:.3f}')
+        print(f'{Fore.YELLOW}Time saved: {Style.RESET_ALL}{report["time_saved"]:.1f} s, '
+              f'{Fore.YELLOW}accuracy difference: {Style.RESET_ALL}{report["accuracy_difference"]:+.3f}')
+
+    return best_model, report
+
+
+# This function evaluates random combinations of the grid until the time budget is over
+def _time_budget_search(estimator, param_grid, X_train, y_train, time_budget, fit_params, cv, n_jobs, random_state):
+    if time_budget is None:
+        raise ValueError('the time-budget strategy requires a time budget in seconds')
+
+    deadline = time.perf_counter() + time_budget
+    best_params, best_score = None, -np.inf
+    evaluated_candidates = 0
+
+    # Visit the whole grid in random order, stopping when the budget is over (at least one combination is evaluated)
+    candidates = ParameterSampler(param_grid, n_iter=len(ParameterGrid(param_grid)), random_state=random_state)
+    for params in candidates:
+        model = clone(estimator).set_params(**params)
+        score = cross_val_score(model, X_train, y_train, cv=cv, scoring='accuracy', n_jobs=n_jobs, params=fit_params).mean()
+        evaluated_candidates += 1
+
+        if score > best_score:
+            best_params, best_score = params, score
+
+        if time.perf_counter() >= deadline:
+            break
+
+    best_model = clone(estimator).set_params(**best_params)
+    best_model.fit(X_train, y_train, **fit_params)
+
+    return best_params, best_score, best_model, evaluated_candidates
+
+
+# This function splits the training set indexes into a search set and a validation fold used for early stopping
+def _split_validation_fold(y_train, random_state):
+    # Stratify the split only if every class has at least two samples
+    _, class_counts = np.unique(y_train, return_counts=True)
+    stratify = y_train if class_counts.min() >= 2 else None
+
+    return train_test_split(np.arange(len(y_train)), test_size=0.2, stratify=stratify, random_state=random_state)
+
+
+# This function restricts precomputed cross-validation folds to a subset of the training set
+def _restrict_folds(cv, subset_indexes, n_samples):
+    # A number of folds is split again on the subset
+    if isinstance(cv, int) or not hasattr(cv, '__iter__'):
+        return cv
+
+    # Position of each training sample in the subset (-1 if it is not in the subset)
+    positions = np.full(n_samples, -1, dtype=np.int64)
+    positions[subset_indexes] = np.arange(len(subset_indexes))
+
+    restricted_folds = []
+    for train_indexes, test_indexes in cv:
+        train_positions, test_positions = positions[train_indexes], positions[test_indexes]
+        restricted_folds.append((train_positions[train_positions >= 0], test_positions[test_positions >= 0]))
+
+    return restricted_folds